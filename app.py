@@ -1,78 +1,273 @@
-from flask_restful import Resource, marshal_with
-from flask import request
-from sqlalchemy import func
-from models import UserModel, ActivityModel, ScanModel
+from flask_restful import Resource, marshal
+from flask import Response, request, stream_with_context
+from werkzeug.http import quote_etag
+from models import (
+    UserModel,
+    ActivityModel,
+    ScanModel,
+    ScanRollupModel,
+    UserScanCountModel,
+)
 from extensions import api, app, db
 from datetime import datetime
+from urllib.parse import urlencode
+import hashlib
+import exports
+import metrics
+import migrations
+import repository
+import serializers
+from caches import badge_cache, scans_cache
+from write_behind import ScanQueueFull, scan_queue
+
+
+def make_etag(*parts):
+    """Build a strong ETag from the values that determine a response body.
+
+    The request's query string is always included, since it changes the body.
+    """
+    parts = (*parts, request.query_string.decode())
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def parse_time(value: str):
+    """Parse an ISO 8601 time as a naive local time, like the times the server
+    records. A time with a UTC offset is converted to local time.
+
+    Raises:
+        ValueError: If `value` isn't an ISO 8601 time.
+    """
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    return time
+
+
+def parse_time_range():
+    """Parse the optional ISO 8601 start and end query parameters.
+
+    Returns:
+        tuple: (start, end), each a naive local datetime or None.
+
+    Raises:
+        ValueError: If either isn't an ISO 8601 time.
+    """
+    return tuple(
+        parse_time(request.args[name]) if name in request.args else None
+        for name in ["start", "end"]
+    )
+
+
+def parse_activity(data):
+    """Parse the activity_name and activity_category of a scan.
+
+    Args:
+        data (dict): The scan from the request body.
+
+    Returns:
+        tuple: (activity_name, activity_category).
+
+    Raises:
+        KeyError: If either is missing.
+        ValueError: If either isn't a non-empty string.
+    """
+    activity = data["activity_name"], data["activity_category"]
+    if not all(isinstance(value, str) and value for value in activity):
+        raise ValueError(
+            "activity_name and activity_category must be non-empty strings"
+        )
+    return activity
+
+
+def parse_scan_options(data):
+    """Parse the optional scanned_at and client_scan_id of a scan.
+
+    Args:
+        data (dict): The scan from the request body.
+
+    Returns:
+        tuple: (scanned_at, client_scan_id), each None when not given. A
+            scanned_at with a UTC offset is converted to local time, like the
+            times the server records.
+
+    Raises:
+        ValueError: If scanned_at isn't an ISO 8601 time or client_scan_id
+            isn't a string of 1 to 64 characters.
+    """
+    scanned_at, client_scan_id = data.get("scanned_at"), data.get("client_scan_id")
+    if scanned_at is not None:
+        if not isinstance(scanned_at, str):
+            raise ValueError("scanned_at must be a string")
+        scanned_at = parse_time(scanned_at)
+    if client_scan_id is not None and (
+        not isinstance(client_scan_id, str) or not 1 <= len(client_scan_id) <= 64
+    ):
+        raise ValueError("client_scan_id must be a string of 1 to 64 characters")
+    return scanned_at, client_scan_id
+
+
+def wait_for_queued_scans(user_id):
+    """Wait for a user's queued scans when the request asks to be consistent.
+
+    Args:
+        user_id (int): The user whose scans should be visible.
+
+    Returns:
+        tuple | None: A 503 response with Retry-After if the scans weren't
+            written within SCAN_CONSISTENT_TIMEOUT seconds, else None.
+    """
+    if request.args.get("consistent") != "true" or not scan_queue.enabled:
+        return None
+    if scan_queue.wait_for_user(user_id, app.config["SCAN_CONSISTENT_TIMEOUT"]):
+        return None
+    return (
+        {"message": "Queued scans haven't been written yet, retry later"},
+        503,
+        {"Retry-After": str(app.config["SCAN_QUEUE_RETRY_AFTER"])},
+    )
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already has `etag`, else None."""
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": quote_etag(etag)})
+    return None
 
 
 class Users(Resource):
     """Resource for handling operations on multiple users."""
 
-    @marshal_with(UserModel.fields)
     def get(self):
-        """Retrieve all users with their scan history.
-
-        Returns:
-            list: List of all users with their associated scans.
-        """
-        users = UserModel.query.all()
-        for user in users:
-            scans = ScanModel.query.filter_by(user_id=user.id).all()
-            user.scans = []
-            for scan in scans:
-                activity = ActivityModel.query.get(scan.activity_id)
-                user.scans.append(
-                    {
-                        "activity_name": activity.name if activity else "Unknown",
-                        "activity_category": (
-                            activity.category if activity else "Unknown"
-                        ),
-                        "scanned_at": scan.scanned_at,
-                    }
-                )
-        return users
+        """Retrieve users with their scan history.
+
+        Query Parameters:
+            limit (int, optional): Maximum number of users to return
+            after (int, optional): Only return users with an ID greater than this
+            format (str, optional): "ndjson" to stream one user per line
+
+        Returns:
+            list: List of users with their associated scans. When the page is
+                full, the cursor for the next page is sent in the X-Next-Cursor
+                and Link headers. 304 if the If-None-Match ETag is current.
+        """
+        limit = request.args.get("limit", type=int)
+        after = request.args.get("after", type=int)
+        if limit is not None and limit < 1:
+            return {"message": "limit must be a positive integer"}, 400
+
+        etag = make_etag(repository.get_users_version())
+        response = not_modified(etag)
+        if response:
+            return response
+
+        if request.args.get("format") == "ndjson":
+            return self.stream(etag, limit, after)
+
+        users = repository.get_users(limit=limit, after=after)
+        headers = {"ETag": quote_etag(etag)}
+        if limit is not None and len(users) == limit:
+            next_cursor = users[-1].id
+            headers["X-Next-Cursor"] = str(next_cursor)
+            headers["Link"] = f'</users?limit={limit}&after={next_cursor}>; rel="next"'
+        return serializers.respond(users, UserModel.fields, headers=headers)
+
+    def stream(self, etag, limit=None, after=None):
+        """Stream users as newline-delimited JSON.
+
+        Args:
+            etag (str): ETag of the current state of the users.
+            limit (int, optional): Maximum number of users to stream.
+            after (int, optional): Only stream users with a greater ID.
+
+        Returns:
+            Response: Chunked response with one marshalled user per line.
+        """
+
+        def generate():
+            for user in repository.iter_users(limit=limit, after=after):
+                yield serializers.encode(user, UserModel.fields) + "\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson",
+            headers={"ETag": quote_etag(etag)},
+        )
 
 
 class User(Resource):
     """Resource for handling operations on a single user."""
 
     def get_scans(self, user):
-        """Helper method to fetch and format scan history for a user.
+        """Helper method to load the scan history for a user.
 
         Args:
             user (UserModel): User object to fetch scans for.
+
+        Returns:
+            UserModel: The user with scans and activities eagerly loaded.
         """
-        scans = ScanModel.query.filter_by(user_id=user.id).all()
-        user.scans = []
-        for scan in scans:
-            activity = ActivityModel.query.get(scan.activity_id)
-            user.scans.append(
-                {
-                    "activity_name": activity.name if activity else "Unknown",
-                    "activity_category": activity.category if activity else "Unknown",
-                    "scanned_at": scan.scanned_at,
-                }
-            )
+        return repository.get_user(user.id)
 
-    @marshal_with(UserModel.fields)
     def get(self, user_id):
         """Retrieve a specific user by ID with their scan history.
 
         Args:
             user_id (int): The ID of the user to retrieve.
 
+        Query Parameters:
+            consistent (bool, optional): "true" to wait until scans queued for
+                the user by write-behind mode have been written
+            scans_limit (int, optional): Only embed the user's latest scans by
+                scanned_at, up to this many. 0 leaves the scans out
+
         Returns:
-            dict: User data with scan history if found, 404 error otherwise.
+            dict: User data with scan history if found, 304 if the
+                If-None-Match ETag is current, 404 error otherwise.
         """
-        user = UserModel.query.filter_by(id=user_id).first()
+        scans_limit = request.args.get("scans_limit", type=int)
+        if scans_limit is not None and scans_limit < 0:
+            return {"message": "scans_limit must not be negative"}, 400
+        response = wait_for_queued_scans(user_id)
+        if response:
+            return response
+
+        updated_at = repository.get_user_updated_at(user_id)
+        if updated_at is None:
+            return {"message": "User not found"}, 404
+
+        response = not_modified(make_etag(user_id, updated_at))
+        if response:
+            return response
+
+        if scans_limit is None:
+            user = data = repository.get_user(user_id)
+        else:
+            user = db.session.get(UserModel, user_id)
+            data = user and self.with_latest_scans(user, scans_limit)
         if not user:
             return {"message": "User not found"}, 404
 
-        self.get_scans(user)
-        return user
+        etag = make_etag(user_id, user.updated_at)
+        return serializers.respond(
+            data, UserModel.fields, headers={"ETag": quote_etag(etag)}
+        )
+
+    def with_latest_scans(self, user, limit):
+        """Helper method to pair a user with only their latest scans.
+
+        Args:
+            user (UserModel): User object to fetch scans for.
+            limit (int): Maximum number of scans to include.
+
+        Returns:
+            dict: The user's fields, with the latest scans by scanned_at,
+                oldest first.
+        """
+        data = {key: getattr(user, key) for key in UserModel.fields if key != "scans"}
+        scans = repository.get_user_scans(user.id, limit) if limit else []
+        data["scans"] = scans[::-1]
+        return data
 
-    @marshal_with(UserModel.fields)
     def put(self, user_id):
         """Update a specific user's information.
 
@@ -100,19 +295,205 @@ class User(Resource):
             user.email = data["email"]
         if "phone" in data:
             user.phone = data["phone"]
-        if "badge_code" in data:
+        if "badge_code" in data and data["badge_code"] != user.badge_code:
+            if user.badge_code:
+                badge_cache.invalidate(user.badge_code)
+            if data["badge_code"]:
+                badge_cache.invalidate(data["badge_code"])
             user.badge_code = data["badge_code"]
 
         user.updated_at = datetime.now()
         db.session.commit()
-        self.get_scans(user)
-        return user
+        return serializers.respond(self.get_scans(user), UserModel.fields)
+
+
+class UserScans(Resource):
+    """Resource for paging through a user's scan history."""
+
+    max_limit = 100
+
+    def get(self, user_id):
+        """Retrieve a page of a user's scans, newest first.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Query Parameters:
+            limit (int, optional): Maximum number of scans to return, at most
+                100. Defaults to 20
+            cursor (str, optional): X-Next-Cursor of the previous page
+            start (str, optional): ISO 8601 time to include scans from
+            end (str, optional): ISO 8601 time to include scans until
+            activity_category (str, optional): Filter by activity category
+            consistent (bool, optional): "true" to wait until scans queued for
+                the user by write-behind mode have been written
+
+        Returns:
+            list: Scans if the user is found, 304 if the If-None-Match ETag is
+                current, 404 error otherwise. When the page is full, the
+                cursor for the next page is sent in the X-Next-Cursor and Link
+                headers.
+        """
+        limit = request.args.get("limit", 20, type=int)
+        if not 1 <= limit <= self.max_limit:
+            return {"message": f"limit must be between 1 and {self.max_limit}"}, 400
+        try:
+            start, end = parse_time_range()
+        except ValueError:
+            return {"message": "start and end must be ISO 8601 times"}, 400
+        try:
+            before = self.parse_cursor(request.args.get("cursor"))
+        except ValueError:
+            return {"message": "Invalid cursor"}, 400
+        response = wait_for_queued_scans(user_id)
+        if response:
+            return response
+
+        updated_at = repository.get_user_updated_at(user_id)
+        if updated_at is None:
+            return {"message": "User not found"}, 404
+        etag = make_etag(user_id, updated_at)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        scans = repository.get_user_scans(
+            user_id,
+            limit,
+            before=before,
+            start=start,
+            end=end,
+            activity_category=request.args.get("activity_category") or None,
+        )
+        headers = {"ETag": quote_etag(etag)}
+        if len(scans) == limit:
+            next_cursor = f"{scans[-1].scanned_at.isoformat()}_{scans[-1].id}"
+            next_page = urlencode({**request.args.to_dict(), "cursor": next_cursor})
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Link"] = f'</users/{user_id}/scans?{next_page}>; rel="next"'
+        return serializers.respond(scans, ScanModel.fields, headers=headers)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Parse a "<scanned_at>_<id>" cursor into a (scanned_at, id) tuple.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        if not cursor:
+            return None
+        scanned_at, _, scan_id = cursor.rpartition("_")
+        return datetime.fromisoformat(scanned_at), int(scan_id)
+
+
+class UserByBadge(Resource):
+    """Resource for looking up a single user by badge code."""
+
+    def get(self, badge_code):
+        """Retrieve a specific user by badge code with their scan history.
+
+        Args:
+            badge_code (str): The badge code of the user to retrieve.
+
+        Returns:
+            dict: User data with scan history if found, 404 error otherwise.
+        """
+        user = repository.get_user_by_badge(badge_code)
+        if not user:
+            return {"message": "User not found"}, 404
+
+        return serializers.respond(user, UserModel.fields)
+
+
+class UserSearch(Resource):
+    """Resource for finding users by name, email or phone number."""
+
+    max_limit = 100
+
+    def get(self):
+        """Search users with the full-text index.
+
+        Query Parameters:
+            q (str): Words to match, each as a prefix of a word in the user's
+                name, email or phone number
+            limit (int, optional): Maximum number of users to return, at most
+                100. Defaults to 20
+            offset (int, optional): Number of ranked users to skip
+
+        Returns:
+            list: Best matching users first, without their scan history. When
+                the page is full, the next page is linked in the Link header.
+        """
+        query = request.args.get("q", "").strip()
+        limit = request.args.get("limit", 20, type=int)
+        offset = request.args.get("offset", 0, type=int)
+        if not query:
+            return {"message": "q is required"}, 400
+        if not 1 <= limit <= self.max_limit or offset < 0:
+            return {
+                "message": f"limit must be between 1 and {self.max_limit} "
+                "and offset must not be negative"
+            }, 400
+
+        users = repository.search_users(query, limit=limit, offset=offset)
+        headers = {}
+        if len(users) == limit:
+            next_page = urlencode(
+                {"q": query, "limit": limit, "offset": offset + limit}
+            )
+            headers["Link"] = f'</users/search?{next_page}>; rel="next"'
+        return serializers.respond(users, UserModel.search_fields, headers=headers)
+
+
+def scan_response(result):
+    """Commit a recorded scan and respond with it.
+
+    The response is built before the commit so the scan doesn't have to be
+    reloaded once the commit expires it.
+
+    Args:
+        result (ScanResult | None): The recorded scan, or None if there was no
+            such user.
+
+    Returns:
+        Response: The scan, with an Idempotent-Replayed header if it was a
+            duplicate, or a 404 error.
+    """
+    if not result:
+        return {"message": "User not found"}, 404
+
+    headers = {"Idempotent-Replayed": "true"} if result.duplicate else None
+    response = serializers.respond(result.scan, ScanModel.fields, headers=headers)
+    db.session.commit()
+    return response
+
+
+def enqueue_scan(entry):
+    """Queue a scan for the write-behind writer.
+
+    Args:
+        entry (ScanEntry): The scan to record, for a user known to exist.
+
+    Returns:
+        dict: The scan that will be written with a 202, or 429 with
+            Retry-After if the queue is full.
+    """
+    entry = entry._replace(scanned_at=entry.scanned_at or datetime.now())
+    try:
+        scan_queue.submit(entry)
+    except ScanQueueFull:
+        retry_after = app.config["SCAN_QUEUE_RETRY_AFTER"]
+        return (
+            {"message": "Too many scans queued, retry later"},
+            429,
+            {"Retry-After": str(retry_after)},
+        )
+    return serializers.respond(entry._asdict(), ScanModel.fields, status=202)
 
 
 class Scan(Resource):
     """Resource for handling individual scan operations."""
 
-    @marshal_with(ScanModel.fields)
     def put(self, user_id):
         """Create a new scan entry for a user.
 
@@ -121,48 +502,157 @@ class Scan(Resource):
 
         Returns:
             dict: Created scan data if successful, error message otherwise.
+                If client_scan_id was already recorded, the original scan is
+                returned with an Idempotent-Replayed header instead.
 
         Request body must contain:
             - activity_name (str): Name of the activity
             - activity_category (str): Category of the activity
+
+        Request body can also contain:
+            - scanned_at (str): ISO 8601 time the scan was taken
+            - client_scan_id (str): Idempotency key so a replayed scan is only
+              recorded once
         """
-        user = UserModel.query.filter_by(id=user_id).first()
-        if not user:
-            return {"message": "User not found"}, 404
+        data = request.get_json()
+        try:
+            activity_name, activity_category = parse_activity(data)
+            scanned_at, client_scan_id = parse_scan_options(data)
+        except (KeyError, TypeError):
+            return {"message": "Missing activity_name or activity_category"}, 400
+        except ValueError as error:
+            return {"message": str(error)}, 400
 
-        user.updated_at = datetime.now()
-        db.session.commit()
+        entry = repository.ScanEntry(
+            user_id, activity_name, activity_category, scanned_at, client_scan_id
+        )
+        if scan_queue.enabled:
+            if repository.get_user_updated_at(user_id) is None:
+                return {"message": "User not found"}, 404
+            return enqueue_scan(entry)
+
+        (result,) = repository.record_scans([entry])
+        return scan_response(result)
+
+
+class ScanByBadge(Resource):
+    """Resource for scanning a badge by its badge code."""
+
+    def put(self, badge_code):
+        """Create a new scan entry for the holder of a badge.
+
+        Args:
+            badge_code (str): The badge code that was scanned.
+
+        Returns:
+            dict: Created scan data if successful, error message otherwise.
+                If client_scan_id was already recorded, the original scan is
+                returned with an Idempotent-Replayed header instead.
 
+        Request body must contain:
+            - activity_name (str): Name of the activity
+            - activity_category (str): Category of the activity
+
+        Request body can also contain scanned_at and client_scan_id, as for
+        PUT /scan/<user_id>.
+        """
         data = request.get_json()
         try:
-            activity_name, activity_category = (
-                data["activity_name"],
-                data["activity_category"],
-            )
-        except KeyError:
+            activity_name, activity_category = parse_activity(data)
+            scanned_at, client_scan_id = parse_scan_options(data)
+        except (KeyError, TypeError):
             return {"message": "Missing activity_name or activity_category"}, 400
+        except ValueError as error:
+            return {"message": str(error)}, 400
+
+        if scan_queue.enabled:
+            user_id = repository.get_badge_holder(badge_code)
+            if user_id is None:
+                return {"message": "User not found"}, 404
+            return enqueue_scan(
+                repository.ScanEntry(
+                    user_id,
+                    activity_name,
+                    activity_category,
+                    scanned_at,
+                    client_scan_id,
+                )
+            )
 
-        activity = ActivityModel.query.filter_by(
-            name=activity_name, category=activity_category
-        ).first()
-        if not activity:
-            activity = ActivityModel(name=activity_name, category=activity_category)  # type: ignore
-            db.session.add(activity)
-            db.session.commit()
+        result = repository.record_badge_scan(
+            badge_code, activity_name, activity_category, scanned_at, client_scan_id
+        )
+        return scan_response(result)
 
-        scan = ScanModel(user_id=user_id, activity_id=activity.id)  # type: ignore
-        db.session.add(scan)
-        db.session.commit()
 
-        scan.activity_name = activity.name  # type: ignore
-        scan.activity_category = activity.category  # type: ignore
-        return scan
+class ScanBatch(Resource):
+    """Resource for recording many scans at once."""
+
+    max_batch_size = 1000
+
+    def post(self):
+        """Create scan entries for many users in a single transaction.
+
+        Returns:
+            list: Per-item results in request order. Each result has a
+                "status" of "created" with the created "scan", "duplicate"
+                with the "scan" first recorded with its client_scan_id, or
+                "error" with a "message".
+
+        Request body must be a list of objects containing:
+            - user_id (int): The ID of the user being scanned
+            - activity_name (str): Name of the activity
+            - activity_category (str): Category of the activity
+
+        Each object can also contain scanned_at and client_scan_id, as for
+        PUT /scan/<user_id>.
+        """
+        data = request.get_json()
+        if not isinstance(data, list):
+            return {"message": "Request body must be a list of scans"}, 400
+        if len(data) > self.max_batch_size:
+            return {
+                "message": f"At most {self.max_batch_size} scans can be sent at once"
+            }, 400
+
+        results = [None] * len(data)
+        entries, indexes = [], []
+        for index, item in enumerate(data):
+            try:
+                entry = repository.ScanEntry(
+                    item["user_id"], *parse_activity(item), *parse_scan_options(item)
+                )
+            except ValueError as error:
+                results[index] = {"status": "error", "message": str(error)}
+                continue
+            except (KeyError, TypeError):
+                results[index] = {
+                    "status": "error",
+                    "message": "Missing user_id, activity_name or activity_category",
+                }
+                continue
+            if not isinstance(entry.user_id, int):
+                results[index] = {"status": "error", "message": "Invalid scan"}
+                continue
+            entries.append(entry)
+            indexes.append(index)
+
+        for index, result in zip(indexes, repository.record_scans(entries)):
+            if result:
+                results[index] = {
+                    "status": "duplicate" if result.duplicate else "created",
+                    "scan": marshal(result.scan, ScanModel.fields),
+                }
+            else:
+                results[index] = {"status": "error", "message": "User not found"}
+
+        db.session.commit()
+        return results
 
 
 class Scans(Resource):
     """Resource for querying scan statistics."""
 
-    @marshal_with(ActivityModel.fields)
     def get(self):
         """Retrieve scan statistics with optional filtering.
 
@@ -173,42 +663,334 @@ class Scans(Resource):
 
         Returns:
             list: List of activities with their scan counts matching the criteria.
+                Results are cached until the next scan is recorded or the
+                cache TTL expires; the X-Cache header says whether it was hit.
         """
         min_frequency = request.args.get("min_frequency", type=int)
         max_frequency = request.args.get("max_frequency", type=int)
         activity_category = request.args.get("activity_category")
 
-        query = (
-            db.session.query(
-                ActivityModel.name,
-                ActivityModel.category,
-                func.count(ScanModel.id).label("frequency"),
+        params = [
+            min_frequency or None,
+            max_frequency or None,
+            activity_category or None,
+        ]
+
+        def compute():
+            return [
+                {
+                    "activity_name": name,
+                    "activity_category": category,
+                    "scan_count": count,
+                }
+                for name, category, count in repository.get_activity_scan_counts(
+                    *params
+                )
+            ]
+
+        result, cached = scans_cache.get_or_compute(params, compute)
+        headers = {"X-Cache": "HIT" if cached else "MISS"}
+        return serializers.respond(result, ActivityModel.fields, headers=headers)
+
+
+class ScanTimeseries(Resource):
+    """Resource for querying scan counts over time."""
+
+    bucket_sizes = {
+        "5m": 300,
+        "15m": 900,
+        "30m": 1800,
+        "1h": 3600,
+        "6h": 21600,
+        "1d": 86400,
+    }
+
+    def get(self):
+        """Retrieve per-activity scan counts in time buckets.
+
+        Counts come from the pre-aggregated scan rollups, so time bounds are
+        applied at the rollups' 5 minute resolution.
+
+        Query Parameters:
+            bucket (str, optional): One of 5m, 15m, 30m, 1h, 6h or 1d. Defaults to 1h
+            start (str, optional): ISO 8601 time to count scans from
+            end (str, optional): ISO 8601 time to count scans until
+            activity_category (str, optional): Filter by activity category
+
+        Returns:
+            list: Activities with the start of each bucket and its scan count.
+        """
+        bucket_size = self.bucket_sizes.get(request.args.get("bucket", "1h"))
+        if not bucket_size:
+            return {
+                "message": f"bucket must be one of {', '.join(self.bucket_sizes)}"
+            }, 400
+        try:
+            start, end = parse_time_range()
+        except ValueError:
+            return {"message": "start and end must be ISO 8601 times"}, 400
+
+        rows = repository.get_scan_timeseries(
+            bucket_size, start, end, request.args.get("activity_category")
+        )
+        return serializers.respond(
+            [
+                {
+                    "activity_name": name,
+                    "activity_category": category,
+                    "bucket_start": bucket_start,
+                    "scan_count": count,
+                }
+                for name, category, bucket_start, count in rows
+            ],
+            ScanRollupModel.fields,
+        )
+
+
+class ActivityAttendees(Resource):
+    """Resource for listing the users who scanned into an activity."""
+
+    max_limit = 100
+
+    def get(self, activity_id):
+        """Retrieve a page of an activity's attendees.
+
+        Args:
+            activity_id (int): The ID of the activity.
+
+        Query Parameters:
+            limit (int, optional): Maximum number of users to return, at most
+                100. Defaults to 50
+            after (int, optional): Only return users with an ID greater than this
+
+        Returns:
+            list: Users who scanned into the activity, ordered by ID, if it is
+                found, 404 error otherwise. The number of distinct attendees is
+                sent in the X-Total-Count header, and when the page is full,
+                the cursor for the next page in the X-Next-Cursor and Link
+                headers.
+        """
+        limit = request.args.get("limit", 50, type=int)
+        after = request.args.get("after", type=int)
+        if not 1 <= limit <= self.max_limit:
+            return {"message": f"limit must be between 1 and {self.max_limit}"}, 400
+        if not db.session.get(ActivityModel, activity_id):
+            return {"message": "Activity not found"}, 404
+
+        attendee_ids = repository.get_attendee_ids(activity_id)
+        users = repository.get_attendees(activity_id, limit, after)
+        headers = {"X-Total-Count": str(len(attendee_ids))}
+        if len(users) == limit:
+            next_cursor = users[-1].id
+            headers["X-Next-Cursor"] = str(next_cursor)
+            headers["Link"] = (
+                f"</activities/{activity_id}/attendees?limit={limit}"
+                f'&after={next_cursor}>; rel="next"'
             )
-            .join(ScanModel, ActivityModel.id == ScanModel.activity_id)
-            .group_by(ActivityModel.id)
+        return serializers.respond(users, UserModel.search_fields, headers=headers)
+
+
+class ActivityAttendee(Resource):
+    """Resource for checking whether a user scanned into an activity."""
+
+    def get(self, activity_id, user_id):
+        """Check a user's attendance of an activity.
+
+        Args:
+            activity_id (int): The ID of the activity.
+            user_id (int): The ID of the user.
+
+        Returns:
+            dict: Whether the user attended and the activity's number of
+                distinct attendees, 404 error if either isn't found.
+        """
+        if not db.session.get(ActivityModel, activity_id):
+            return {"message": "Activity not found"}, 404
+
+        attendee_ids = repository.get_attendee_ids(activity_id)
+        attended = user_id in attendee_ids
+        if not attended and not db.session.get(UserModel, user_id):
+            return {"message": "User not found"}, 404
+
+        return serializers.respond(
+            {
+                "activity_id": activity_id,
+                "user_id": user_id,
+                "attended": attended,
+                "attendee_count": len(attendee_ids),
+            },
+            ActivityModel.attendance_fields,
         )
 
-        if min_frequency:
-            query = query.having(func.count(ScanModel.id) >= min_frequency)
-        if max_frequency:
-            query = query.having(func.count(ScanModel.id) <= max_frequency)
-        if activity_category:
-            query = query.filter(ActivityModel.category == activity_category)
 
-        return [
+class Leaderboard(Resource):
+    """Resource for ranking users by how many scans they have."""
+
+    max_limit = 100
+
+    def get(self):
+        """Retrieve the users with the most scans.
+
+        Query Parameters:
+            limit (int, optional): Number of users to return, at most 100.
+                Defaults to 10
+            activity_category (str, optional): Rank by scans in this category
+
+        Returns:
+            list: Users with their rank and scan count, best first. Users with
+                the same scan count share a rank.
+        """
+        limit = request.args.get("limit", 10, type=int)
+        if not 1 <= limit <= self.max_limit:
+            return {"message": f"limit must be between 1 and {self.max_limit}"}, 400
+
+        leaderboard = repository.get_leaderboard(
+            limit, request.args.get("activity_category") or None
+        )
+        return serializers.respond(leaderboard, UserScanCountModel.fields)
+
+
+class LeaderboardRank(Resource):
+    """Resource for a single user's position on the leaderboard."""
+
+    def get(self, user_id):
+        """Retrieve a user's rank and scan count.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Query Parameters:
+            activity_category (str, optional): Rank by scans in this category
+
+        Returns:
+            dict: The user's rank and scan count, 404 error if not found.
+        """
+        user = db.session.get(UserModel, user_id)
+        if not user:
+            return {"message": "User not found"}, 404
+
+        rank, scan_count = repository.get_user_rank(
+            user_id, request.args.get("activity_category") or None
+        )
+        return serializers.respond(
             {
-                "activity_name": name,
-                "activity_category": category,
-                "scan_count": count,
-            }
-            for name, category, count in query.all()
-        ]
+                "rank": rank,
+                "user_id": user_id,
+                "name": user.name,
+                "scan_count": scan_count,
+            },
+            UserScanCountModel.fields,
+        )
+
+
+class Export(Resource):
+    """Base resource for streaming an export of flat rows.
+
+    Subclasses set the file `name`, the `columns`, and `rows`, a function that
+    takes the filters and returns an iterator of row tuples for `columns`.
+    """
+
+    name = ""
+    columns = []
+    rows = None
+
+    def get(self):
+        """Stream the export as CSV or NDJSON.
+
+        Rows are streamed from the database cursor as they are encoded, so
+        exports run in constant memory. The response is gzip compressed when
+        the client sends Accept-Encoding: gzip.
+
+        Query Parameters:
+            format (str, optional): "csv" (default) or "ndjson"
+            activity_category (str, optional): Filter by activity category
+            activity_name (str, optional): Filter by activity name
+            start (str, optional): ISO 8601 time to include scans from
+            end (str, optional): ISO 8601 time to include scans until
+
+        Returns:
+            Response: Chunked export, downloaded as an attachment.
+        """
+        export_format = request.args.get("format", "csv")
+        if export_format not in exports.FORMATS:
+            return {
+                "message": f"format must be one of {', '.join(exports.FORMATS)}"
+            }, 400
+        try:
+            start, end = parse_time_range()
+        except ValueError:
+            return {"message": "start and end must be ISO 8601 times"}, 400
+
+        rows = self.rows(
+            activity_category=request.args.get("activity_category"),
+            activity_name=request.args.get("activity_name"),
+            start=start,
+            end=end,
+        )
+        chunks = exports.encode(export_format, self.columns, rows)
+        headers = {
+            "Content-Disposition": f'attachment; filename="{self.name}.{export_format}"',
+            "Vary": "Accept-Encoding",
+        }
+        if request.accept_encodings["gzip"]:
+            chunks = exports.gzip(chunks)
+            headers["Content-Encoding"] = "gzip"
+        return Response(
+            stream_with_context(chunks),
+            mimetype=exports.FORMATS[export_format],
+            headers=headers,
+        )
+
+
+class ScanExport(Export):
+    """Resource for exporting scans along with their user and activity."""
+
+    name = "scans"
+    columns = repository.SCAN_EXPORT_COLUMNS
+    rows = staticmethod(repository.iter_scan_rows)
+
+
+class UserExport(Export):
+    """Resource for exporting users, optionally only those with matching scans."""
+
+    name = "users"
+    columns = repository.USER_EXPORT_COLUMNS
+    rows = staticmethod(repository.iter_user_rows)
 
 
 api.add_resource(Users, "/users")
 api.add_resource(User, "/users/<int:user_id>")
+api.add_resource(UserScans, "/users/<int:user_id>/scans")
+api.add_resource(UserByBadge, "/users/badge/<badge_code>")
+api.add_resource(UserSearch, "/users/search")
 api.add_resource(Scan, "/scan/<int:user_id>")
+api.add_resource(ScanByBadge, "/scan/badge/<badge_code>")
 api.add_resource(Scans, "/scans")
+api.add_resource(ScanBatch, "/scans/batch")
+api.add_resource(ScanTimeseries, "/scans/timeseries")
+api.add_resource(ActivityAttendees, "/activities/<int:activity_id>/attendees")
+api.add_resource(
+    ActivityAttendee, "/activities/<int:activity_id>/attendees/<int:user_id>"
+)
+api.add_resource(Leaderboard, "/leaderboard")
+api.add_resource(LeaderboardRank, "/leaderboard/users/<int:user_id>")
+api.add_resource(ScanExport, "/export/scans")
+api.add_resource(UserExport, "/export/users")
+
+scans_cache.configure(app.config["SCANS_CACHE_URL"], app.config["SCANS_CACHE_TTL"])
+scan_queue.configure(
+    app,
+    app.config["SCAN_WRITE_BEHIND"],
+    app.config["SCAN_QUEUE_SIZE"],
+    app.config["SCAN_QUEUE_BATCH"],
+)
+metrics.init_app(app)
 
 if __name__ == "__main__":
+    with app.app_context():
+        migrations.upgrade()
+        repository.warm_activity_cache()
+        repository.recover_archive()
+    if scan_queue.enabled:
+        scan_queue.start()
     app.run(debug=True)
@@ -0,0 +1,300 @@
+"""Compressed, column-oriented snapshot files of archived scans.
+
+Each archive run writes one snapshot holding the scans it moved out of the
+database, split into segments of one activity and one day. A segment stores
+each column as its own zlib-compressed array of 64-bit little-endian integers:
+
+    id          scan IDs
+    user_id     user IDs
+    scanned_at  microseconds since the epoch, in time order, delta encoded
+
+The file ends with a JSON index, its length and a magic number. The index
+lists the activities and, for every segment, its activity, day, scan count,
+5 minute bucket counts and the offset and length of each column. Readers
+mmap the file, read the index, and only decompress the columns they need;
+counts come straight from the index.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import groupby
+from threading import Lock
+import zlib
+from extensions import app
+from models import ScanRollupModel
+
+MAGIC = b"SCANSNP1"
+FOOTER = struct.Struct("<Q8s")
+EPOCH = datetime(1970, 1, 1)
+SUFFIX = ".snap"
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _encode(values):
+    column = array("q", values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return zlib.compress(column.tobytes())
+
+
+def _decode(data):
+    column = array("q")
+    column.frombytes(zlib.decompress(data))
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+def _running_sum(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def write_snapshot(path: str, rows, activities):
+    """Write scans to a snapshot file and flush it to disk.
+
+    Args:
+        path (str): File to create.
+        rows (iterable): (id, user_id, activity_id, scanned_at) rows ordered
+            by activity ID and scanned_at. They're consumed a segment at a time.
+        activities (dict): Activity ID to (name, category) for every activity
+            in `rows`.
+
+    Returns:
+        int: The number of scans written.
+    """
+    segments = []
+    with open(path, "wb") as f:
+        for (activity_id, day), group in groupby(
+            rows, key=lambda row: (row[2], row[3].date())
+        ):
+            group = list(group)
+            micros = [(scanned_at - EPOCH) // _MICROSECOND for *_, scanned_at in group]
+            size = ScanRollupModel.bucket_size
+            buckets = Counter(value // 1_000_000 // size * size for value in micros)
+            columns = {}
+            for name, values in [
+                ("id", [row[0] for row in group]),
+                ("user_id", [row[1] for row in group]),
+                ("scanned_at", _deltas(micros)),
+            ]:
+                data = _encode(values)
+                columns[name] = [f.tell(), len(data)]
+                f.write(data)
+            segments.append(
+                {
+                    "activity_id": activity_id,
+                    "day": day.isoformat(),
+                    "count": len(group),
+                    "buckets": {
+                        str(bucket): count for bucket, count in buckets.items()
+                    },
+                    "columns": columns,
+                }
+            )
+
+        index = json.dumps(
+            {
+                "activities": {
+                    str(activity_id): list(activity)
+                    for activity_id, activity in activities.items()
+                },
+                "segments": segments,
+            }
+        ).encode()
+        f.write(index)
+        f.write(FOOTER.pack(len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    return sum(segment["count"] for segment in segments)
+
+
+def publish(partial: str, path: str):
+    """Give a written snapshot its final name and flush the rename to disk.
+
+    Args:
+        partial (str): The snapshot as written by write_snapshot.
+        path (str): Its final name, which readers pick up.
+    """
+    try:
+        os.replace(partial, path)
+    except FileNotFoundError:
+        # Already published, e.g. by recovery in another process.
+        if not os.path.exists(path):
+            raise
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class Snapshot:
+    """A memory-mapped snapshot file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self._map) - FOOTER.size
+        length, magic = FOOTER.unpack_from(self._map, end)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a scan snapshot")
+        index = json.loads(self._map[end - length : end])
+        self.activities = {
+            int(activity_id): tuple(activity)
+            for activity_id, activity in index["activities"].items()
+        }
+        self.segments = index["segments"]
+
+    def column(self, segment, name: str):
+        """Decompress one column of a segment.
+
+        Returns:
+            array: The column's values, with scanned_at as microseconds since
+                the epoch.
+        """
+        offset, length = segment["columns"][name]
+        values = _decode(self._map[offset : offset + length])
+        if name == "scanned_at":
+            values = array("q", _running_sum(values))
+        return values
+
+    def rows(self, activity_id: int | None = None):
+        """Yield archived scans, optionally only those of one activity.
+
+        Yields:
+            tuple: (id, user_id, activity_id, scanned_at) rows.
+        """
+        for segment in self.segments:
+            if activity_id is not None and segment["activity_id"] != activity_id:
+                continue
+            for scan_id, user_id, micros in zip(
+                self.column(segment, "id"),
+                self.column(segment, "user_id"),
+                self.column(segment, "scanned_at"),
+            ):
+                scanned_at = EPOCH + micros * _MICROSECOND
+                yield scan_id, user_id, segment["activity_id"], scanned_at
+
+    def close(self):
+        self._map.close()
+
+
+class Archive:
+    """The snapshots in the archive directory.
+
+    Snapshots are opened once and kept mapped; the directory is listed on each
+    use so snapshots written by another process are picked up. Attendee sets
+    read from them are cached until the set of snapshots changes.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self._snapshots = {}
+        self._attendees = {}
+        self._lock = Lock()
+
+    def configure(self, directory: str):
+        with self._lock:
+            self.directory = directory
+            self._close()
+
+    def new_path(self, before: datetime):
+        """Return an unused path for a snapshot of the scans before a cutoff."""
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        name = f"scans-before-{before:%Y%m%dT%H%M%S}-{stamp}{SUFFIX}"
+        return os.path.join(self.directory, name)
+
+    def snapshots(self):
+        """Return the open snapshots, ordered by file name."""
+        with self._lock:
+            names = []
+            if self.directory and os.path.isdir(self.directory):
+                names = sorted(
+                    name for name in os.listdir(self.directory) if name.endswith(SUFFIX)
+                )
+            if names != list(self._snapshots):
+                snapshots = {
+                    name: self._snapshots.pop(name, None)
+                    or Snapshot(os.path.join(self.directory, name))
+                    for name in names
+                }
+                self._close()
+                self._snapshots = snapshots
+            return list(self._snapshots.values())
+
+    def attendee_ids(self, activity_id: int):
+        """Return the IDs of the users with archived scans of an activity."""
+        snapshots = self.snapshots()
+        with self._lock:
+            user_ids = self._attendees.get(activity_id)
+        if user_ids is None:
+            user_ids = frozenset(
+                user_id
+                for snapshot in snapshots
+                for segment in snapshot.segments
+                if segment["activity_id"] == activity_id
+                for user_id in snapshot.column(segment, "user_id")
+            )
+            with self._lock:
+                self._attendees[activity_id] = user_ids
+        return user_ids
+
+    def activity_counts(self):
+        """Return archived scan counts keyed on activity ID."""
+        counts = Counter()
+        for snapshot in self.snapshots():
+            for segment in snapshot.segments:
+                counts[segment["activity_id"]] += segment["count"]
+        return counts
+
+    def bucket_counts(self):
+        """Return archived scan counts keyed on (activity ID, bucket start)."""
+        counts = Counter()
+        for snapshot in self.snapshots():
+            for segment in snapshot.segments:
+                for bucket, count in segment["buckets"].items():
+                    counts[(segment["activity_id"], int(bucket))] += count
+        return counts
+
+    def user_counts(self):
+        """Return archived scan counts keyed on user ID and on (user ID, category)."""
+        users, categories = Counter(), Counter()
+        for snapshot in self.snapshots():
+            for segment in snapshot.segments:
+                _, category = snapshot.activities[segment["activity_id"]]
+                for user_id in snapshot.column(segment, "user_id"):
+                    users[user_id] += 1
+                    categories[(user_id, category)] += 1
+        return users, categories
+
+    def _close(self):
+        for snapshot in self._snapshots.values():
+            snapshot.close()
+        self._snapshots = {}
+        self._attendees = {}
+
+    def clear(self):
+        with self._lock:
+            self._close()
+
+
+archive = Archive()
+archive.configure(app.config["ARCHIVE_DIR"])
@@ -0,0 +1,286 @@
+"""Reproducible load-test and benchmark harness for the API.
+
+Synthesizes a dataset shaped like data.json into a throwaway database, then
+drives the endpoints through the Flask test client and through a real local
+HTTP server. Latency percentiles, throughput and SQL queries per request are
+written to a JSON file that can be diffed between commits:
+
+    python bench.py --users 1000 --min-scans 10 --max-scans 100 -o bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ACTIVITIES = [
+    ("opening_ceremony", "activity"),
+    ("team_formation", "activity"),
+    ("closing_ceremony", "activity"),
+    ("giving_go_a_go", "workshop"),
+    ("web_development", "workshop"),
+    ("ai_workshop", "workshop"),
+    ("friday_dinner", "meal"),
+    ("midnight_snack", "meal"),
+    ("sunday_breakfast", "meal"),
+]
+WORDS = ["give", "seven", "food", "trade", "send", "here", "north", "to", "hack"]
+EVENT_START = datetime(2025, 1, 17)
+
+
+def generate_dataset(path: str, users: int, min_scans: int, max_scans: int, seed: int):
+    """Write a synthetic NDJSON export shaped like data.json.
+
+    Args:
+        path (str): File to write.
+        users (int): Number of users.
+        min_scans (int): Minimum scans per user.
+        max_scans (int): Maximum scans per user.
+        seed (int): Random seed, so the same arguments give the same data.
+
+    Returns:
+        int: Number of scans written.
+    """
+    rng = random.Random(seed)
+    scans = 0
+    with open(path, "w") as f:
+        for i in range(users):
+            record = {
+                "name": f"Hacker {rng.randrange(users)}",
+                "email": f"hacker{i}@example.org",
+                "phone": f"+1-555-{i:07}",
+                "badge_code": "-".join(rng.choices(WORDS, k=4)) + f"-{i}",
+                "scans": [],
+            }
+            for _ in range(rng.randint(min_scans, max_scans)):
+                name, category = rng.choice(ACTIVITIES)
+                scanned_at = EVENT_START + timedelta(seconds=rng.randrange(3 * 86400))
+                record["scans"].append(
+                    {
+                        "activity_name": name,
+                        "activity_category": category,
+                        "scanned_at": scanned_at.isoformat(),
+                    }
+                )
+            scans += len(record["scans"])
+            f.write(json.dumps(record) + "\n")
+    return scans
+
+
+def scenarios(users: int, requests: int, seed: int):
+    """Build the request mix for each endpoint.
+
+    Returns:
+        dict: Scenario name to a list of (method, path, body) requests.
+    """
+    rng = random.Random(seed)
+
+    def scan_body():
+        name, category = rng.choice(ACTIVITIES)
+        return {"activity_name": name, "activity_category": category}
+
+    return {
+        "GET /users": [("GET", "/users", None)] * max(1, requests // 50),
+        "GET /users?limit=100": [
+            ("GET", f"/users?limit=100&after={rng.randrange(users)}", None)
+            for _ in range(requests)
+        ],
+        "GET /users/<id>": [
+            ("GET", f"/users/{rng.randint(1, users)}", None) for _ in range(requests)
+        ],
+        "GET /scans": [
+            (
+                "GET",
+                rng.choice(
+                    [
+                        "/scans",
+                        "/scans?activity_category=meal",
+                        "/scans?min_frequency=10&activity_category=workshop",
+                    ]
+                ),
+                None,
+            )
+            for _ in range(requests)
+        ],
+        "PUT /scan/<id>": [
+            ("PUT", f"/scan/{rng.randint(1, users)}", scan_body())
+            for _ in range(requests)
+        ],
+    }
+
+
+def summarize(latencies, elapsed: float, queries: int):
+    """Summarize latencies in seconds into milliseconds and throughput."""
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "queries_per_request": round(queries / len(latencies), 2),
+    }
+
+
+class QueryCounter:
+    """Counts SQL statements executed on a set of engines."""
+
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def run_test_client(app, counter, requests):
+    client = app.test_client()
+    latencies = []
+    before = counter.count
+    started = time.perf_counter()
+    for method, path, body in requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code < 400, (path, response.status_code)
+    return summarize(latencies, time.perf_counter() - started, counter.count - before)
+
+
+def run_server(base_url, counter, requests, concurrency: int):
+    def send(request):
+        method, path, body = request
+        data = json.dumps(body).encode() if body is not None else None
+        http_request = urllib.request.Request(
+            base_url + path,
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        start = time.perf_counter()
+        with urllib.request.urlopen(http_request) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    before = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(send, requests))
+    return summarize(latencies, time.perf_counter() - started, counter.count - before)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args, workdir: str):
+    """Load a synthetic dataset into a database in `workdir` and measure it.
+
+    Returns:
+        dict: The report written to the output file.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    # Imported late so the app picks up the benchmark database.
+    from werkzeug.serving import make_server
+    from app import app
+    from extensions import db
+    import helpers
+
+    dataset = os.path.join(workdir, "data.ndjson")
+    scans = generate_dataset(
+        dataset, args.users, args.min_scans, args.max_scans, args.seed
+    )
+    helpers.create_db()
+    started = time.perf_counter()
+    helpers.populate_db(dataset)
+    load_seconds = time.perf_counter() - started
+
+    with app.app_context():
+        counter = QueryCounter(db.engines.values())
+
+    results = {"test_client": {}, "server": {}}
+    for name, requests in scenarios(args.users, args.requests, args.seed).items():
+        print(f"test client: {name}", file=sys.stderr)
+        results["test_client"][name] = run_test_client(app, counter, requests)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        for name, requests in scenarios(args.users, args.requests, args.seed).items():
+            print(f"server: {name}", file=sys.stderr)
+            results["server"][name] = run_server(
+                base_url, counter, requests, args.concurrency
+            )
+    finally:
+        server.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "dataset": {
+            "users": args.users,
+            "scans": scans,
+            "min_scans": args.min_scans,
+            "max_scans": args.max_scans,
+            "seed": args.seed,
+            "load_seconds": round(load_seconds, 3),
+        },
+        "requests_per_scenario": args.requests,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--min-scans", type=int, default=10)
+    parser.add_argument("--max-scans", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench.json")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the dataset and database"
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        report = benchmark(args, workdir)
+    finally:
+        if args.keep:
+            print(f"Kept the dataset and database in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(json.dumps(report["results"], indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+from collections import OrderedDict
+from threading import Lock, local
+import json
+import sqlite3
+import time
+
+
+class BadgeCache:
+    """Process-local map of badge codes to user IDs.
+
+    Entries are only hints: callers must confirm the badge still belongs to the
+    user (e.g. as part of the statement that uses the ID) and invalidate the
+    entry when it doesn't, since another worker may have reassigned the badge.
+    """
+
+    def __init__(self):
+        self._user_ids = {}
+
+    def get(self, badge_code: str):
+        return self._user_ids.get(badge_code)
+
+    def set(self, badge_code: str, user_id: int):
+        self._user_ids[badge_code] = user_id
+
+    def invalidate(self, badge_code: str):
+        self._user_ids.pop(badge_code, None)
+
+    def clear(self):
+        self._user_ids.clear()
+
+
+class ActivityCache:
+    """Bounded LRU map of (name, category) pairs to activity IDs.
+
+    The activity table is tiny and practically append-only, so once warmed
+    almost every lookup is a hit. Hit and miss counts are kept for metrics.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.warmed = False
+        self._ids = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, name: str, category: str):
+        with self._lock:
+            activity_id = self._ids.get((name, category))
+            if activity_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._ids.move_to_end((name, category))
+            return activity_id
+
+    def set(self, name: str, category: str, activity_id: int):
+        with self._lock:
+            self._ids[(name, category)] = activity_id
+            self._ids.move_to_end((name, category))
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def warm(self, rows):
+        """Fill the cache from (id, name, category) rows."""
+        for activity_id, name, category in rows:
+            self.set(name, category, activity_id)
+        self.warmed = True
+
+    def stats(self):
+        return {"size": len(self._ids), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self.hits = self.misses = 0
+            self.warmed = False
+
+
+class AttendeeCache:
+    """Bounded LRU map of activity IDs to the users who scanned into them.
+
+    Each entry is (version, scan_count, last_scan_id, user_ids): the activity's
+    scan counter version and value the set was built at, the highest scan ID it
+    includes, and a frozenset of user IDs. Callers compare version with the
+    current counter to tell whether the entry is stale, and can top it up with
+    just the scans after last_scan_id when only scans were added since.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, activity_id: int):
+        with self._lock:
+            entry = self._entries.get(activity_id)
+            if entry is not None:
+                self._entries.move_to_end(activity_id)
+            return entry
+
+    def set(
+        self,
+        activity_id: int,
+        version: int,
+        scan_count: int,
+        last_scan_id: int,
+        user_ids,
+    ):
+        """Store the attendees of an activity and return them as a frozenset."""
+        user_ids = frozenset(user_ids)
+        with self._lock:
+            self._entries[activity_id] = (version, scan_count, last_scan_id, user_ids)
+            self._entries.move_to_end(activity_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return user_ids
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+class MemoryBackend:
+    """In-process LRU store for QueryCache, private to each worker process."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def generation(self):
+        return self._generation
+
+    def bump_generation(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = 0
+
+
+class SQLiteBackend:
+    """Bounded store for QueryCache in a local SQLite file.
+
+    Every worker process opening the same file shares both the cached results
+    and the generation counter, so a write in one worker invalidates the cache
+    for all of them. Values must be JSON serializable.
+
+    Reads never write, so a cache hit doesn't take the file's write lock:
+    expired entries are skipped on read and evicted by set(), which also drops
+    the least recently written entries beyond maxsize.
+    """
+
+    def __init__(self, path: str, maxsize: int = 256):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                expires_at REAL NOT NULL, used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_entry_used_at ON entry (used_at);
+            CREATE TABLE IF NOT EXISTS generation (value INTEGER NOT NULL);
+            INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM generation);
+            """)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM entry WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now),
+        )
+        connection.execute("DELETE FROM entry WHERE expires_at < ?", (now,))
+        connection.execute(
+            "DELETE FROM entry WHERE key IN (SELECT key FROM entry "
+            "ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+    def generation(self):
+        return self._connection().execute("SELECT value FROM generation").fetchone()[0]
+
+    def bump_generation(self):
+        connection = self._connection()
+        connection.execute("UPDATE generation SET value = value + 1")
+        connection.execute("DELETE FROM entry")
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute("UPDATE generation SET value = 0")
+        connection.execute("DELETE FROM entry")
+
+
+class QueryCache:
+    """TTL and LRU bounded cache of query results keyed on their parameters.
+
+    Keys include the backend's generation counter, so bumping it through
+    invalidate() retires every cached result at once.
+    """
+
+    def __init__(self, backend, ttl: float = 5.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, url: str = "memory", ttl: float = 5.0, maxsize: int = 256):
+        """Select the backend, either "memory" or "sqlite:///<path>"."""
+        if url == "memory":
+            self.backend = MemoryBackend(maxsize)
+        elif url.startswith("sqlite:///"):
+            self.backend = SQLiteBackend(url.removeprefix("sqlite:///"), maxsize)
+        else:
+            raise ValueError(f"Unsupported query cache backend: {url}")
+        self.ttl = ttl
+
+    def get_or_compute(self, params, compute):
+        """Return the cached result for `params`, computing it on a miss.
+
+        Args:
+            params (list): JSON serializable, already normalized parameters.
+            compute (callable): Produces the result when it isn't cached.
+
+        Returns:
+            tuple: The result and whether it came from the cache.
+        """
+        key = json.dumps([self.backend.generation(), params])
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value, True
+
+        self.misses += 1
+        value = compute()
+        self.backend.set(key, value, self.ttl)
+        return value, False
+
+    def invalidate(self):
+        self.backend.bump_generation()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+
+badge_cache = BadgeCache()
+activity_cache = ActivityCache()
+attendee_cache = AttendeeCache()
+scans_cache = QueryCache(MemoryBackend())
@@ -0,0 +1,100 @@
+"""Chunked CSV and NDJSON encoding for streamed exports.
+
+Rows are encoded a chunk at a time as they come off the database cursor, and
+optionally gzip compressed as they go, so an export never holds more than one
+chunk in memory no matter how many rows it has.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _chunked(rows, chunk_rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv(columns, rows, chunk_rows: int = 500):
+    """Encode rows as CSV with a header line.
+
+    Args:
+        columns (list): Column names, in row order.
+        rows (iterable): Tuples of values.
+        chunk_rows (int): Number of rows encoded into each chunk.
+
+    Yields:
+        str: CSV text, a chunk of rows at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in _chunked(rows, chunk_rows):
+        writer.writerows([[_value(value) for value in row] for row in chunk])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_ndjson(columns, rows, chunk_rows: int = 500):
+    """Encode rows as one JSON object per line.
+
+    Args:
+        columns (list): Column names, in row order.
+        rows (iterable): Tuples of values.
+        chunk_rows (int): Number of rows encoded into each chunk.
+
+    Yields:
+        str: NDJSON text, a chunk of rows at a time.
+    """
+    for chunk in _chunked(rows, chunk_rows):
+        yield "".join(
+            json.dumps(dict(zip(columns, map(_value, row)))) + "\n" for row in chunk
+        )
+
+
+def encode(format: str, columns, rows, chunk_rows: int = 500):
+    """Encode rows in an export format, as UTF-8 bytes.
+
+    Args:
+        format (str): A key of FORMATS.
+        columns (list): Column names, in row order.
+        rows (iterable): Tuples of values.
+        chunk_rows (int): Number of rows encoded into each chunk.
+
+    Yields:
+        bytes: The encoded export, a chunk at a time.
+    """
+    encoder = iter_csv if format == "csv" else iter_ndjson
+    for text in encoder(columns, rows, chunk_rows):
+        yield text.encode()
+
+
+def gzip(chunks):
+    """Gzip compress a stream of byte chunks as it is consumed.
+
+    Yields:
+        bytes: Compressed output, skipping chunks that produced none.
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
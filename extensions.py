@@ -1,8 +1,121 @@
-from flask import Flask
+import os
+from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_restful import Api
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 
 app = Flask("HTN Badge Scanner")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "sqlite:///database.db"
+)
+# Applied to every new SQLite connection. WAL lets readers carry on while a
+# writer holds the write lock; it can't be switched on by read-only connections.
+app.config["SQLITE_PRAGMAS"] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+}
+# Serve GET requests from a separate engine that opens the database read-only.
+app.config["SQLITE_READ_ONLY_ENGINE"] = (
+    os.environ.get("SQLITE_READ_ONLY_ENGINE", "1") == "1"
+)
+# "memory" or "sqlite:///<path>" to share the cache between worker processes.
+app.config["SCANS_CACHE_URL"] = os.environ.get("SCANS_CACHE_URL", "memory")
+app.config["SCANS_CACHE_TTL"] = float(os.environ.get("SCANS_CACHE_TTL", "5.0"))
+# Request latency and SQL instrumentation, exported on /metrics.
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") == "1"
+app.config["METRICS_SAMPLE_RATE"] = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+app.config["SLOW_REQUEST_SECONDS"] = float(
+    os.environ.get("SLOW_REQUEST_SECONDS", "1.0")
+)
+# Queue PUT /scan/<id> writes and commit them in batches from a writer thread.
+app.config["SCAN_WRITE_BEHIND"] = os.environ.get("SCAN_WRITE_BEHIND", "0") == "1"
+app.config["SCAN_QUEUE_SIZE"] = int(os.environ.get("SCAN_QUEUE_SIZE", "10000"))
+app.config["SCAN_QUEUE_BATCH"] = int(os.environ.get("SCAN_QUEUE_BATCH", "500"))
+app.config["SCAN_QUEUE_RETRY_AFTER"] = int(
+    os.environ.get("SCAN_QUEUE_RETRY_AFTER", "1")
+)
+# Seconds a consistent=true read waits for the user's queued scans.
+app.config["SCAN_CONSISTENT_TIMEOUT"] = float(
+    os.environ.get("SCAN_CONSISTENT_TIMEOUT", "5.0")
+)
+# Snapshots of archived scans, written by `python helpers.py archive`.
+app.config["ARCHIVE_DIR"] = os.environ.get(
+    "ARCHIVE_DIR", os.path.join(app.instance_path, "archive")
+)
+
+
+def read_only_url(uri: str):
+    """Return a read-only URL for a SQLite database file, or None.
+
+    In-memory databases can't be shared between engines, and URLs that are
+    already SQLite URIs are left alone.
+    """
+    url = make_url(uri)
+    if (
+        url.get_backend_name() != "sqlite"
+        or url.database in (None, "", ":memory:")
+        or "uri" in url.query
+    ):
+        return None
+    return url.set(database=f"file:{url.database}", query={"mode": "ro", "uri": "true"})
+
+
+if app.config["SQLITE_READ_ONLY_ENGINE"]:
+    url = read_only_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url is not None:
+        app.config["SQLALCHEMY_BINDS"] = {
+            "read_only": url.render_as_string(hide_password=False)
+        }
+
+
+class RoutingSession(Session):
+    """Session that runs every statement on the read-only engine while it is
+    marked read-only."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("read_only"):
+            engine = db.engines.get("read_only")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
 api = Api(app)
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
+
+
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return set_pragmas
+
+
+with app.app_context():
+    for bind_key, engine in db.engines.items():
+        if engine.dialect.name != "sqlite":
+            continue
+        pragmas = dict(app.config["SQLITE_PRAGMAS"])
+        if bind_key == "read_only":
+            pragmas.pop("journal_mode", None)
+        event.listen(engine, "connect", _pragma_listener(pragmas))
+
+
+@app.before_request
+def route_reads():
+    """Send the queries of GET and HEAD requests to the read-only engine."""
+    if request.method in ("GET", "HEAD"):
+        db.session.info["read_only"] = True
+
+
+@app.teardown_request
+def end_read_routing(exc):
+    db.session.info.pop("read_only", None)
@@ -0,0 +1,38 @@
+# Prefork production server settings: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+import subprocess
+import sys
+
+wsgi_app = "wsgi:create_app()"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+# The write-behind queue lives in one process, so it needs a single worker.
+write_behind = os.environ.get("SCAN_WRITE_BEHIND", "0") == "1"
+workers = int(
+    os.environ.get(
+        "WEB_CONCURRENCY", 1 if write_behind else multiprocessing.cpu_count() * 2 + 1
+    )
+)
+threads = int(os.environ.get("WEB_THREADS", "4"))
+# Share the GET /scans cache between workers, so a scan recorded by one worker
+# invalidates the results cached by the others.
+instance_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance")
+os.environ.setdefault(
+    "SCANS_CACHE_URL", f"sqlite:///{os.path.join(instance_dir, 'scans_cache.db')}"
+)
+# Import the app in each worker, after the fork, never in the master.
+preload_app = False
+# Leave the write-behind queue time to drain on shutdown.
+graceful_timeout = 30
+timeout = 60
+
+
+def on_starting(server):
+    """Migrate the database once, before any worker starts."""
+    if write_behind and server.cfg.workers > 1:
+        raise RuntimeError(
+            "SCAN_WRITE_BEHIND=1 needs a single worker: queued scans and "
+            "consistent=true reads are tracked per process"
+        )
+    os.makedirs(instance_dir, exist_ok=True)
+    subprocess.run([sys.executable, "migrations.py"], check=True)
@@ -1,60 +1,227 @@
+import argparse
 import json
+import re
+import sys
+import time
+from sqlalchemy import insert
 from extensions import db, app
-from models import UserModel, ActivityModel, ScanModel
+from models import UserModel, ScanModel
+from migrations import upgrade
+from repository import (
+    archive_scans,
+    get_activity_ids,
+    mark_scans_written,
+    rebuild_activity_scan_counts,
+    rebuild_scan_rollups,
+    rebuild_user_scan_counts,
+    recover_archive,
+    warm_activity_cache,
+)
 from datetime import datetime
 
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
 
 def create_db():
     with app.app_context():
-        db.create_all()
+        upgrade()
 
 
-def insert_user(name: str, email: str, phone: str, badge_code: str | None = None):
-    user = UserModel(name=name, email=email, phone=phone, badge_code=badge_code)  # type: ignore
-    db.session.add(user)
-    db.session.commit()
-    return user
+def iter_records(f, chunk_size: int = 1 << 16):
+    """Incrementally parse user records from a JSON array or NDJSON file.
 
+    Only one chunk of the file plus the record being decoded is held in memory
+    at a time.
 
-def insert_activity(name: str, category: str):
-    activity = ActivityModel(name=name, category=category)  # type: ignore
-    db.session.add(activity)
-    db.session.commit()
-    return activity
+    Args:
+        f (file): Seekable text file containing a JSON array of user objects,
+            or one user object per line.
+        chunk_size (int): Number of characters to read at a time.
 
+    Yields:
+        dict: User records in file order.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    pos = _WHITESPACE.match(buffer).end()
 
-def insert_scan(user_id: int, activity_id: int, scanned_at: datetime):
-    scan = ScanModel(user_id=user_id, activity_id=activity_id, scanned_at=scanned_at)  # type: ignore
-    db.session.add(scan)
-    db.session.commit()
-    return scan
+    if buffer[pos : pos + 1] != "[":
+        f.seek(0)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+        return
 
+    pos += 1
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if buffer[pos : pos + 1] == "]":
+            return
+        if buffer[pos : pos + 1] == ",":
+            pos += 1
+            continue
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield record
 
-def populate_db():
-    # TODO: Populate with JSON data
-    with app.app_context():
-        with open("data.json", "r") as f:
-            data = json.load(f)
-
-        for element in data:
-            user = insert_user(
-                element["name"],
-                element["email"],
-                element["phone"],
-                element["badge_code"] if element["badge_code"] != "" else None,
+
+def insert_batch(records):
+    """Bulk insert a batch of user records and their scans.
+
+    Users and scans are each written with a single executemany, and activities
+    are resolved in memory through the activity cache. The caller commits.
+
+    Args:
+        records (list): User records shaped like the entries in data.json.
+
+    Returns:
+        tuple: Number of users and scans inserted.
+    """
+    user_ids = db.session.scalars(
+        insert(UserModel).returning(UserModel.id, sort_by_parameter_order=True),
+        [
+            {
+                "name": record["name"],
+                "email": record["email"],
+                "phone": record["phone"],
+                "badge_code": record["badge_code"] or None,
+            }
+            for record in records
+        ],
+    ).all()
+
+    activity_ids = get_activity_ids(
+        (scan["activity_name"], scan["activity_category"])
+        for record in records
+        for scan in record["scans"]
+    )
+    scans = [
+        {
+            "user_id": user_id,
+            "activity_id": activity_ids[
+                (scan["activity_name"], scan["activity_category"])
+            ],
+            "scanned_at": datetime.fromisoformat(scan["scanned_at"]),
+        }
+        for user_id, record in zip(user_ids, records)
+        for scan in record["scans"]
+    ]
+    if scans:
+        db.session.execute(insert(ScanModel), scans)
+        mark_scans_written()
+    return len(user_ids), len(scans)
+
+
+def populate_db(path: str = "data.json", batch_size: int = 5000, start_at: int = 0):
+    """Load user records from a JSON array or NDJSON file.
+
+    Records are committed in batches of `batch_size`. If a batch fails, nothing
+    from it is kept and the error reports the record to resume from.
+
+    Args:
+        path (str): File to load.
+        batch_size (int): Number of user records per transaction.
+        start_at (int): Number of leading records to skip, to resume a load.
+    """
+    with app.app_context(), open(path, "r") as f:
+        warm_activity_cache()
+        started = time.perf_counter()
+        loaded, rows = start_at, 0
+        batch = []
+
+        def flush():
+            nonlocal loaded, rows
+            try:
+                users, scans = insert_batch(batch)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                print(
+                    f"Failed in the batch starting at record {loaded}, "
+                    f"resume with --start-at {loaded}",
+                    file=sys.stderr,
+                )
+                raise
+            loaded += len(batch)
+            rows += users + scans
+            elapsed = time.perf_counter() - started
+            print(
+                f"Loaded {loaded} records, {rows} rows "
+                f"({rows / elapsed:.0f} rows/s)",
+                file=sys.stderr,
             )
-            for scan in element["scans"]:
-                activity = ActivityModel.query.filter_by(
-                    name=scan["activity_name"], category=scan["activity_category"]
-                ).first()
-                if activity is None:
-                    activity = insert_activity(
-                        scan["activity_name"], scan["activity_category"]
-                    )
-                scanned_at = datetime.fromisoformat(scan["scanned_at"])
-                insert_scan(user.id, activity.id, scanned_at)
+            batch.clear()
+
+        for index, record in enumerate(iter_records(f)):
+            if index < start_at:
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+
+def rebuild_counters():
+    with app.app_context():
+        recover_archive()
+        rebuild_activity_scan_counts()
+        rebuild_scan_rollups()
+        rebuild_user_scan_counts()
+
+
+def archive(before: datetime):
+    if before.tzinfo is not None:
+        before = before.astimezone().replace(tzinfo=None)
+    with app.app_context():
+        upgrade()
+        recover_archive()
+        path, scans = archive_scans(before)
+        if path is None:
+            print(f"No scans before {before.isoformat()}", file=sys.stderr)
+        else:
+            print(f"Archived {scans} scans to {path}", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    create_db()
-    populate_db()
+    parser = argparse.ArgumentParser(description="Database management helpers.")
+    commands = parser.add_subparsers(dest="command")
+    load = commands.add_parser(
+        "load", help="create the database and load a JSON or NDJSON export"
+    )
+    load.add_argument("path", nargs="?", default="data.json")
+    load.add_argument("--batch-size", type=int, default=5000)
+    load.add_argument(
+        "--start-at", type=int, default=0, help="skip this many leading records"
+    )
+    commands.add_parser(
+        "rebuild-counters",
+        help="recompute the scan counters and rollups from the scan table",
+    )
+    archive_command = commands.add_parser(
+        "archive", help="move old scans into a compressed snapshot file"
+    )
+    archive_command.add_argument(
+        "--before",
+        type=datetime.fromisoformat,
+        required=True,
+        help="ISO 8601 time; scans taken before it are archived",
+    )
+    args = parser.parse_args()
+
+    if args.command == "rebuild-counters":
+        rebuild_counters()
+    elif args.command == "archive":
+        archive(args.before)
+    elif args.command == "load":
+        create_db()
+        populate_db(args.path, args.batch_size, args.start_at)
+    else:
+        create_db()
+        populate_db()
@@ -0,0 +1,218 @@
+"""Per-request latency and SQL instrumentation exported in Prometheus format.
+
+When METRICS_ENABLED is set, Flask request hooks and SQLAlchemy cursor events
+record a latency histogram, a query count histogram and total SQL time per
+endpoint, for a METRICS_SAMPLE_RATE fraction of requests. Requests slower than
+SLOW_REQUEST_SECONDS are logged along with the slowest statements they ran. When
+disabled, no hooks are registered at all, so there is no per-request cost.
+
+GET /metrics serves the collected data, plus the cache and write-behind scan
+queue counters, in the Prometheus text exposition format.
+"""
+
+import heapq
+import random
+import time
+from threading import Lock
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from caches import activity_cache, attendee_cache, scans_cache
+from write_behind import scan_queue
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+MAX_LOGGED_STATEMENTS = 20
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    """Request metrics keyed on (method, endpoint)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.latency = {}
+        self.queries = {}
+        self.sql_seconds = {}
+
+    def record(self, labels, seconds: float, queries: int, sql_seconds: float):
+        with self._lock:
+            if labels not in self.latency:
+                self.latency[labels] = Histogram(LATENCY_BUCKETS)
+                self.queries[labels] = Histogram(QUERY_BUCKETS)
+                self.sql_seconds[labels] = 0.0
+            self.latency[labels].observe(seconds)
+            self.queries[labels].observe(queries)
+            self.sql_seconds[labels] += sql_seconds
+
+    def snapshot(self):
+        """Return copies of the metric dicts that are safe to iterate."""
+        with self._lock:
+            return dict(self.latency), dict(self.queries), dict(self.sql_seconds)
+
+    def reset(self):
+        with self._lock:
+            self.latency.clear()
+            self.queries.clear()
+            self.sql_seconds.clear()
+
+
+registry = Registry()
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        # Min-heap of the MAX_LOGGED_STATEMENTS slowest (elapsed, statement).
+        self.statements = []
+
+    def add(self, elapsed, statement):
+        self.queries += 1
+        self.sql_seconds += elapsed
+        if len(self.statements) < MAX_LOGGED_STATEMENTS:
+            heapq.heappush(self.statements, (elapsed, statement))
+        else:
+            heapq.heappushpop(self.statements, (elapsed, statement))
+
+    def slowest(self):
+        """Return the slowest statements, slowest first."""
+        return sorted(self.statements, reverse=True)
+
+
+def _current_stats():
+    return g.get("request_stats") if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    if stats is None or not conn.info.get("query_started"):
+        return
+    stats.add(time.perf_counter() - conn.info["query_started"].pop(), statement)
+
+
+def _handle_error(context):
+    # A statement that raises never reaches after_cursor_execute.
+    conn = context.connection
+    started = conn.info.get("query_started") if conn is not None else None
+    if started and context.statement is not None:
+        started.pop()
+
+
+def init_app(app):
+    """Register the /metrics endpoint and, if enabled, the instrumentation hooks."""
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    if not app.config["METRICS_ENABLED"]:
+        return
+
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+    @app.before_request
+    def start_request_stats():
+        sample_rate = app.config["METRICS_SAMPLE_RATE"]
+        if request.endpoint != "metrics" and random.random() < sample_rate:
+            g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop("request_stats", None)
+        if stats is None:
+            return response
+
+        seconds = time.perf_counter() - stats.started
+        endpoint = request.url_rule.rule if request.url_rule else "<unmatched>"
+        registry.record(
+            (request.method, endpoint), seconds, stats.queries, stats.sql_seconds
+        )
+        if seconds >= app.config["SLOW_REQUEST_SECONDS"]:
+            app.logger.warning(
+                "Slow request %s %s took %.3fs with %d queries (%.3fs in SQL):\n%s",
+                request.method,
+                request.full_path,
+                seconds,
+                stats.queries,
+                stats.sql_seconds,
+                "\n".join(
+                    f"  {elapsed * 1000:.1f}ms {statement}"
+                    for elapsed, statement in stats.slowest()
+                ),
+            )
+        return response
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(name, histograms):
+    for (method, endpoint), histogram in sorted(histograms.items()):
+        labels = f'method="{method}",endpoint="{_label_value(endpoint)}"'
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}'
+        yield f"{name}_sum{{{labels}}} {histogram.sum}"
+        yield f"{name}_count{{{labels}}} {histogram.count}"
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+    latency, queries, sql_seconds = registry.snapshot()
+    lines = [
+        "# HELP http_request_duration_seconds Request latency by endpoint.",
+        "# TYPE http_request_duration_seconds histogram",
+        *_histogram_lines("http_request_duration_seconds", latency),
+        "# HELP http_request_sql_queries SQL statements executed per request.",
+        "# TYPE http_request_sql_queries histogram",
+        *_histogram_lines("http_request_sql_queries", queries),
+        "# HELP http_request_sql_seconds_total Time spent executing SQL.",
+        "# TYPE http_request_sql_seconds_total counter",
+    ]
+    for (method, endpoint), seconds in sorted(sql_seconds.items()):
+        lines.append(
+            f'http_request_sql_seconds_total{{method="{method}",'
+            f'endpoint="{_label_value(endpoint)}"}} {seconds}'
+        )
+
+    for name, cache in [
+        ("activity", activity_cache),
+        ("attendee", attendee_cache),
+        ("scans", scans_cache),
+    ]:
+        stats = cache.stats()
+        for counter in ["hits", "misses"]:
+            lines.append(f"# TYPE {name}_cache_{counter}_total counter")
+            lines.append(f"{name}_cache_{counter}_total {stats[counter]}")
+    lines.append("# TYPE scans_cache_hit_ratio gauge")
+    lines.append(f"scans_cache_hit_ratio {scans_cache.stats()['hit_ratio']}")
+    lines.append("# TYPE scan_queue_depth gauge")
+    lines.append(f"scan_queue_depth {scan_queue.depth()}")
+    for counter in ["written", "failed"]:
+        lines.append(f"# TYPE scan_queue_{counter}_total counter")
+        lines.append(f"scan_queue_{counter}_total {getattr(scan_queue, counter)}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return Response(render(), content_type="text/plain; version=0.0.4")
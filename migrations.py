@@ -0,0 +1,424 @@
+"""Versioned schema migrations for existing databases.
+
+The schema version is stored in SQLite's `user_version` pragma. Each migration
+upgrades the schema by one version and is written to be safe to re-run, since
+SQLite can't roll back every DDL statement if a migration fails halfway.
+New migrations are appended to MIGRATIONS; never edit or reorder old ones.
+Triggers and other DDL are spelled out as they were at that version rather than
+taken from the models, which keep changing.
+"""
+
+from sqlalchemy import inspect
+from extensions import db
+
+
+def unique_activities(connection):
+    """Merge duplicate activities and add the unique (name, category) index."""
+    connection.exec_driver_sql("""
+        UPDATE scan SET activity_id = (
+            SELECT MIN(duplicate.id) FROM activity
+            JOIN activity AS duplicate
+                ON duplicate.name = activity.name
+                AND duplicate.category = activity.category
+            WHERE activity.id = scan.activity_id
+        )
+        WHERE activity_id IN (SELECT id FROM activity)
+        """)
+    connection.exec_driver_sql(
+        "DELETE FROM activity WHERE id NOT IN "
+        "(SELECT MIN(id) FROM activity GROUP BY name, category)"
+    )
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_activity_name_category "
+        "ON activity (name, category)"
+    )
+
+
+def activity_scan_counts(connection):
+    """Add the activity scan counter table, its triggers, and backfill it."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS activity_scan_count (
+            activity_id INTEGER NOT NULL,
+            scan_count INTEGER NOT NULL,
+            PRIMARY KEY (activity_id),
+            FOREIGN KEY(activity_id) REFERENCES activity (id)
+        )
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO activity_scan_count (activity_id, scan_count)
+            VALUES (NEW.activity_id, 1)
+            ON CONFLICT (activity_id) DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE activity_scan_count SET scan_count = scan_count - 1
+            WHERE activity_id = OLD.activity_id;
+        END
+        """)
+    connection.exec_driver_sql("DELETE FROM activity_scan_count")
+    connection.exec_driver_sql(
+        "INSERT INTO activity_scan_count (activity_id, scan_count) "
+        "SELECT activity_id, COUNT(*) FROM scan GROUP BY activity_id"
+    )
+
+
+def scan_indexes(connection):
+    """Index the scan columns used by history lookups and aggregates."""
+    for column in ["user_id", "activity_id", "scanned_at"]:
+        connection.exec_driver_sql(
+            f"CREATE INDEX IF NOT EXISTS ix_scan_{column} ON scan ({column})"
+        )
+
+
+def user_updated_at_index(connection):
+    """Index user.updated_at so the users high-water mark is a single seek."""
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_user_updated_at ON user (updated_at)"
+    )
+
+
+def scan_rollups(connection):
+    """Add the time-bucketed scan rollup table, its triggers, and backfill it."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS scan_rollup (
+            activity_id INTEGER NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            scan_count INTEGER NOT NULL,
+            PRIMARY KEY (activity_id, bucket_start),
+            FOREIGN KEY(activity_id) REFERENCES activity (id)
+        )
+        """)
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_scan_rollup_bucket_start "
+        "ON scan_rollup (bucket_start)"
+    )
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS scan_rollup_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO scan_rollup (activity_id, bucket_start, scan_count)
+            VALUES (
+                NEW.activity_id,
+                CAST(strftime('%s', substr(NEW.scanned_at, 1, 19)) AS INTEGER)
+                    / 300 * 300,
+                1
+            )
+            ON CONFLICT (activity_id, bucket_start)
+            DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS scan_rollup_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE scan_rollup SET scan_count = scan_count - 1
+            WHERE activity_id = OLD.activity_id
+            AND bucket_start =
+                CAST(strftime('%s', substr(OLD.scanned_at, 1, 19)) AS INTEGER)
+                    / 300 * 300;
+        END
+        """)
+    connection.exec_driver_sql("DELETE FROM scan_rollup")
+    connection.exec_driver_sql(
+        "INSERT INTO scan_rollup (activity_id, bucket_start, scan_count) "
+        "SELECT activity_id, "
+        "CAST(strftime('%s', substr(scanned_at, 1, 19)) AS INTEGER) / 300 * 300 "
+        "AS bucket_start, COUNT(*) FROM scan GROUP BY activity_id, bucket_start"
+    )
+
+
+def user_search(connection):
+    """Add the user full-text search index, its triggers, and build it."""
+    connection.exec_driver_sql("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+            name, email, phone, content='user', content_rowid='id', prefix='2 3'
+        )
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_search_insert
+        AFTER INSERT ON user
+        BEGIN
+            INSERT INTO user_search (rowid, name, email, phone)
+            VALUES (NEW.id, NEW.name, NEW.email, NEW.phone);
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_search_delete
+        AFTER DELETE ON user
+        BEGIN
+            INSERT INTO user_search (user_search, rowid, name, email, phone)
+            VALUES ('delete', OLD.id, OLD.name, OLD.email, OLD.phone);
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_search_update
+        AFTER UPDATE OF name, email, phone ON user
+        BEGIN
+            INSERT INTO user_search (user_search, rowid, name, email, phone)
+            VALUES ('delete', OLD.id, OLD.name, OLD.email, OLD.phone);
+            INSERT INTO user_search (rowid, name, email, phone)
+            VALUES (NEW.id, NEW.name, NEW.email, NEW.phone);
+        END
+        """)
+    connection.exec_driver_sql(
+        "INSERT INTO user_search (user_search) VALUES ('rebuild')"
+    )
+
+
+def scan_client_ids(connection):
+    """Add the scan idempotency key column and its unique index."""
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(scan)")}
+    if "client_scan_id" not in columns:
+        connection.exec_driver_sql(
+            "ALTER TABLE scan ADD COLUMN client_scan_id VARCHAR(64)"
+        )
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_scan_client_scan_id "
+        "ON scan (client_scan_id)"
+    )
+
+
+def user_scan_counts(connection):
+    """Add the per-user and per-user-per-category scan counters and backfill them."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user_scan_count (
+            user_id INTEGER NOT NULL,
+            scan_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )
+        """)
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_user_scan_count_rank "
+        "ON user_scan_count (scan_count DESC, user_id)"
+    )
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user_category_scan_count (
+            user_id INTEGER NOT NULL,
+            category VARCHAR(80) NOT NULL,
+            scan_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, category),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )
+        """)
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_user_category_scan_count_rank "
+        "ON user_category_scan_count (category, scan_count DESC, user_id)"
+    )
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO user_scan_count (user_id, scan_count)
+            VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE user_scan_count SET scan_count = scan_count - 1
+            WHERE user_id = OLD.user_id;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_category_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO user_category_scan_count (user_id, category, scan_count)
+            VALUES (
+                NEW.user_id,
+                (SELECT category FROM activity WHERE id = NEW.activity_id),
+                1
+            )
+            ON CONFLICT (user_id, category) DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS user_category_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE user_category_scan_count SET scan_count = scan_count - 1
+            WHERE user_id = OLD.user_id
+            AND category = (SELECT category FROM activity WHERE id = OLD.activity_id);
+        END
+        """)
+    connection.exec_driver_sql("DELETE FROM user_scan_count")
+    connection.exec_driver_sql(
+        "INSERT INTO user_scan_count (user_id, scan_count) "
+        "SELECT user_id, COUNT(*) FROM scan GROUP BY user_id"
+    )
+    connection.exec_driver_sql("DELETE FROM user_category_scan_count")
+    connection.exec_driver_sql(
+        "INSERT INTO user_category_scan_count (user_id, category, scan_count) "
+        "SELECT scan.user_id, activity.category, COUNT(*) FROM scan "
+        "JOIN activity ON activity.id = scan.activity_id "
+        "GROUP BY scan.user_id, activity.category"
+    )
+
+
+def scan_history_index(connection):
+    """Index scans by user and time for the paginated scan history."""
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_scan_user_scanned_at "
+        "ON scan (user_id, scanned_at, id)"
+    )
+
+
+def scan_attendee_index(connection):
+    """Index scans by activity and user to list an activity's attendees."""
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_scan_activity_user "
+        "ON scan (activity_id, user_id)"
+    )
+
+
+def activity_scan_count_versions(connection):
+    """Add the activity scan counter version and switch to triggers that bump it."""
+    columns = {
+        row[1]
+        for row in connection.exec_driver_sql("PRAGMA table_info(activity_scan_count)")
+    }
+    if "version" not in columns:
+        connection.exec_driver_sql(
+            "ALTER TABLE activity_scan_count "
+            "ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+        )
+    for name in ["activity_scan_count_insert", "activity_scan_count_delete"]:
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO activity_scan_count (activity_id, scan_count, version)
+            VALUES (NEW.activity_id, 1, 1)
+            ON CONFLICT (activity_id) DO UPDATE
+            SET scan_count = scan_count + 1, version = version + 1;
+        END
+        """)
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE activity_scan_count
+            SET scan_count = scan_count - 1, version = version + 1
+            WHERE activity_id = OLD.activity_id;
+        END
+        """)
+    connection.exec_driver_sql("UPDATE activity_scan_count SET version = scan_count")
+
+
+def drop_redundant_scan_indexes(connection):
+    """Drop the scan user_id and activity_id indexes, which are prefixes of
+    ix_scan_user_scanned_at and ix_scan_activity_user."""
+    for name in ["ix_scan_user_id", "ix_scan_activity_id"]:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def archive_snapshots(connection):
+    """Add the table recording the archive snapshots whose scans were deleted."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS archive_snapshot (
+            name VARCHAR(255) NOT NULL,
+            scan_count INTEGER NOT NULL,
+            archived_at DATETIME NOT NULL,
+            PRIMARY KEY (name)
+        )
+        """)
+
+
+def user_list_versions(connection):
+    """Add the user list version counter and the triggers that bump it."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user_list_version (
+            id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """)
+    for operation in ["insert", "update", "delete"]:
+        connection.exec_driver_sql(f"""
+            CREATE TRIGGER IF NOT EXISTS user_list_version_{operation}
+            AFTER {operation.upper()} ON user
+            BEGIN
+                INSERT INTO user_list_version (id, version) VALUES (1, 1)
+                ON CONFLICT (id) DO UPDATE SET version = version + 1;
+            END
+            """)
+
+
+def scan_client_ids_per_user(connection):
+    """Make scan idempotency keys unique per user rather than across all users."""
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_scan_user_client_scan_id "
+        "ON scan (user_id, client_scan_id)"
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_scan_client_scan_id")
+
+
+MIGRATIONS = [
+    unique_activities,
+    activity_scan_counts,
+    scan_indexes,
+    user_updated_at_index,
+    scan_rollups,
+    user_search,
+    scan_client_ids,
+    user_scan_counts,
+    scan_history_index,
+    scan_attendee_index,
+    activity_scan_count_versions,
+    drop_redundant_scan_indexes,
+    archive_snapshots,
+    user_list_versions,
+    scan_client_ids_per_user,
+]
+
+
+def current_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def upgrade(engine=None):
+    """Bring a database up to the latest schema version.
+
+    A database without any tables is created straight from the models and
+    stamped with the latest version. Must be called inside an app context.
+
+    Args:
+        engine (Engine, optional): Engine to migrate. Defaults to db.engine.
+
+    Returns:
+        list: Names of the migrations that were applied.
+    """
+    engine = engine or db.engine
+    if not inspect(engine).has_table("user"):
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        return []
+
+    applied = []
+    with engine.connect() as connection:
+        version = current_version(connection)
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with engine.begin() as connection:
+            migration(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+        applied.append(migration.__name__)
+    return applied
+
+
+if __name__ == "__main__":
+    from extensions import app
+
+    with app.app_context():
+        for name in upgrade():
+            print(f"Applied {name}")
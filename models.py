@@ -1,5 +1,6 @@
 from extensions import db
 from flask_restful import fields
+from sqlalchemy import DDL, event
 from datetime import datetime
 
 
@@ -10,7 +11,19 @@ class UserModel(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     phone = db.Column(db.String(20), unique=True, nullable=False)
     badge_code = db.Column(db.String(50), unique=True, nullable=True)
-    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.now, index=True
+    )
+
+    scans = db.relationship("ScanModel", back_populates="user", order_by="ScanModel.id")
+
+    search_fields = {
+        "id": fields.Integer,
+        "name": fields.String,
+        "email": fields.String,
+        "phone": fields.String,
+        "badge_code": fields.String,
+    }
 
     fields = {
         "name": fields.String,
@@ -29,16 +42,97 @@ class UserModel(db.Model):
         ),
     }
 
+    # Full-text index over names, emails and phone numbers. It's an external
+    # content table, so it stores only the index and reads values from user.
+    # The update trigger ignores updated_at, which changes on every scan.
+    search_index = [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+            name, email, phone, content='user', content_rowid='id', prefix='2 3'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_search_insert
+        AFTER INSERT ON user
+        BEGIN
+            INSERT INTO user_search (rowid, name, email, phone)
+            VALUES (NEW.id, NEW.name, NEW.email, NEW.phone);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_search_delete
+        AFTER DELETE ON user
+        BEGIN
+            INSERT INTO user_search (user_search, rowid, name, email, phone)
+            VALUES ('delete', OLD.id, OLD.name, OLD.email, OLD.phone);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_search_update
+        AFTER UPDATE OF name, email, phone ON user
+        BEGIN
+            INSERT INTO user_search (user_search, rowid, name, email, phone)
+            VALUES ('delete', OLD.id, OLD.name, OLD.email, OLD.phone);
+            INSERT INTO user_search (rowid, name, email, phone)
+            VALUES (NEW.id, NEW.name, NEW.email, NEW.phone);
+        END
+        """,
+    ]
+
     def __repr__(self):
         return f"User({self.name}, {self.email})"
 
 
+for statement in UserModel.search_index:
+    event.listen(UserModel.__table__, "after_create", DDL(statement))
+event.listen(
+    UserModel.__table__, "before_drop", DDL("DROP TABLE IF EXISTS user_search")
+)
+
+
+class UserListVersionModel(db.Model):
+    __tablename__ = "user_list_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Bumped inside the transaction of every write to a user, so unlike the
+    # users' updated_at, which is taken before the write lock, it only ever
+    # grows in commit order.
+    triggers = [f"""
+        CREATE TRIGGER IF NOT EXISTS user_list_version_{operation}
+        AFTER {operation.upper()} ON user
+        BEGIN
+            INSERT INTO user_list_version (id, version) VALUES (1, 1)
+            ON CONFLICT (id) DO UPDATE SET version = version + 1;
+        END
+        """ for operation in ["insert", "update", "delete"]]
+
+    def __repr__(self):
+        return f"UserListVersion({self.version})"
+
+
+for trigger in UserListVersionModel.triggers:
+    event.listen(UserListVersionModel.__table__, "after_create", DDL(trigger))
+
+
 class ActivityModel(db.Model):
     __tablename__ = "activity"
+    __table_args__ = (
+        db.Index("ix_activity_name_category", "name", "category", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     category = db.Column(db.String(80), nullable=False)
 
+    scans = db.relationship("ScanModel", back_populates="activity")
+
+    attendance_fields = {
+        "activity_id": fields.Integer,
+        "user_id": fields.Integer,
+        "attended": fields.Boolean,
+        "attendee_count": fields.Integer,
+    }
+
     fields = {
         "activity_name": fields.String,
         "activity_category": fields.String,
@@ -51,10 +145,29 @@ class ActivityModel(db.Model):
 
 class ScanModel(db.Model):
     __tablename__ = "scan"
+    # Serves a user's scan history newest first, with (scanned_at, id) as the
+    # keyset cursor.
+    # ix_scan_activity_user covers the distinct attendees of an activity.
+    # Scanners pick their own keys, so client_scan_id is unique per user.
+    __table_args__ = (
+        db.Index("ix_scan_user_scanned_at", "user_id", "scanned_at", "id"),
+        db.Index("ix_scan_activity_user", "activity_id", "user_id"),
+        db.Index(
+            "ix_scan_user_client_scan_id", "user_id", "client_scan_id", unique=True
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    # Lookups by user_id or activity_id alone use the composite indexes above.
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     activity_id = db.Column(db.Integer, db.ForeignKey("activity.id"), nullable=False)
-    scanned_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    scanned_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.now, index=True
+    )
+    # Idempotency key from the scanner, so replayed scans are only recorded once.
+    client_scan_id = db.Column(db.String(64), nullable=True)
+
+    user = db.relationship("UserModel", back_populates="scans")
+    activity = db.relationship("ActivityModel", back_populates="scans")
 
     fields = {
         "user_id": fields.Integer,
@@ -63,5 +176,214 @@ class ScanModel(db.Model):
         "scanned_at": fields.DateTime(dt_format="iso8601"),
     }
 
+    @property
+    def activity_name(self):
+        return self.activity.name if self.activity else "Unknown"
+
+    @property
+    def activity_category(self):
+        return self.activity.category if self.activity else "Unknown"
+
     def __repr__(self):
         return f"Scan({self.user_id}, {self.activity_id}, {self.scanned_at})"
+
+
+class ActivityScanCountModel(db.Model):
+    __tablename__ = "activity_scan_count"
+    activity_id = db.Column(db.Integer, db.ForeignKey("activity.id"), primary_key=True)
+    scan_count = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped by every insert and delete and never decremented, so a delete
+    # followed by an insert changes it even though scan_count doesn't.
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Keep the counters in step with the scan table inside the same transaction
+    # as every insert or delete, no matter which code path wrote the scans.
+    triggers = [
+        """
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO activity_scan_count (activity_id, scan_count, version)
+            VALUES (NEW.activity_id, 1, 1)
+            ON CONFLICT (activity_id) DO UPDATE
+            SET scan_count = scan_count + 1, version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS activity_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE activity_scan_count
+            SET scan_count = scan_count - 1, version = version + 1
+            WHERE activity_id = OLD.activity_id;
+        END
+        """,
+    ]
+
+    def __repr__(self):
+        return f"ActivityScanCount({self.activity_id}, {self.scan_count})"
+
+
+for trigger in ActivityScanCountModel.triggers:
+    event.listen(ActivityScanCountModel.__table__, "after_create", DDL(trigger))
+
+
+class ScanRollupModel(db.Model):
+    __tablename__ = "scan_rollup"
+    bucket_size = 300
+    activity_id = db.Column(db.Integer, db.ForeignKey("activity.id"), primary_key=True)
+    # Start of the bucket in seconds since the epoch, treating scanned_at as UTC.
+    # The triggers truncate scanned_at to whole seconds before bucketing it.
+    bucket_start = db.Column(db.Integer, primary_key=True, index=True)
+    scan_count = db.Column(db.Integer, nullable=False, default=0)
+
+    fields = {
+        "activity_name": fields.String,
+        "activity_category": fields.String,
+        "bucket_start": fields.DateTime(dt_format="iso8601"),
+        "scan_count": fields.Integer,
+    }
+
+    triggers = [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS scan_rollup_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO scan_rollup (activity_id, bucket_start, scan_count)
+            VALUES (
+                NEW.activity_id,
+                CAST(strftime('%s', substr(NEW.scanned_at, 1, 19)) AS INTEGER)
+                    / {bucket_size} * {bucket_size},
+                1
+            )
+            ON CONFLICT (activity_id, bucket_start)
+            DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS scan_rollup_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE scan_rollup SET scan_count = scan_count - 1
+            WHERE activity_id = OLD.activity_id
+            AND bucket_start =
+                CAST(strftime('%s', substr(OLD.scanned_at, 1, 19)) AS INTEGER)
+                    / {bucket_size} * {bucket_size};
+        END
+        """,
+    ]
+
+    def __repr__(self):
+        return f"ScanRollup({self.activity_id}, {self.bucket_start}, {self.scan_count})"
+
+
+for trigger in ScanRollupModel.triggers:
+    # DDL applies %-formatting to the statement, so escape strftime's format.
+    event.listen(
+        ScanRollupModel.__table__, "after_create", DDL(trigger.replace("%", "%%"))
+    )
+
+
+class UserScanCountModel(db.Model):
+    __tablename__ = "user_scan_count"
+    __table_args__ = (
+        db.Index("ix_user_scan_count_rank", db.text("scan_count DESC"), "user_id"),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    scan_count = db.Column(db.Integer, nullable=False, default=0)
+
+    fields = {
+        "rank": fields.Integer,
+        "user_id": fields.Integer,
+        "name": fields.String,
+        "scan_count": fields.Integer,
+    }
+
+    triggers = [
+        """
+        CREATE TRIGGER IF NOT EXISTS user_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO user_scan_count (user_id, scan_count)
+            VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE user_scan_count SET scan_count = scan_count - 1
+            WHERE user_id = OLD.user_id;
+        END
+        """,
+    ]
+
+    def __repr__(self):
+        return f"UserScanCount({self.user_id}, {self.scan_count})"
+
+
+for trigger in UserScanCountModel.triggers:
+    event.listen(UserScanCountModel.__table__, "after_create", DDL(trigger))
+
+
+class UserCategoryScanCountModel(db.Model):
+    __tablename__ = "user_category_scan_count"
+    __table_args__ = (
+        db.Index(
+            "ix_user_category_scan_count_rank",
+            "category",
+            db.text("scan_count DESC"),
+            "user_id",
+        ),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    category = db.Column(db.String(80), primary_key=True)
+    scan_count = db.Column(db.Integer, nullable=False, default=0)
+
+    triggers = [
+        """
+        CREATE TRIGGER IF NOT EXISTS user_category_scan_count_insert
+        AFTER INSERT ON scan
+        BEGIN
+            INSERT INTO user_category_scan_count (user_id, category, scan_count)
+            VALUES (
+                NEW.user_id,
+                (SELECT category FROM activity WHERE id = NEW.activity_id),
+                1
+            )
+            ON CONFLICT (user_id, category) DO UPDATE SET scan_count = scan_count + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_category_scan_count_delete
+        AFTER DELETE ON scan
+        BEGIN
+            UPDATE user_category_scan_count SET scan_count = scan_count - 1
+            WHERE user_id = OLD.user_id
+            AND category = (SELECT category FROM activity WHERE id = OLD.activity_id);
+        END
+        """,
+    ]
+
+    def __repr__(self):
+        return (
+            f"UserCategoryScanCount({self.user_id}, {self.category}, {self.scan_count})"
+        )
+
+
+for trigger in UserCategoryScanCountModel.triggers:
+    event.listen(UserCategoryScanCountModel.__table__, "after_create", DDL(trigger))
+
+
+class ArchiveSnapshotModel(db.Model):
+    __tablename__ = "archive_snapshot"
+    # Committed in the same transaction that deletes the snapshot's scans, so a
+    # snapshot file still named .partial after a crash can be told apart from
+    # one whose scans were never deleted.
+    name = db.Column(db.String(255), primary_key=True)
+    scan_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f"ArchiveSnapshot({self.name}, {self.scan_count})"
@@ -0,0 +1,1178 @@
+import os
+import re
+from sqlalchemy import event, tuple_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import (
+    Session,
+    contains_eager,
+    make_transient_to_detached,
+    selectinload,
+)
+from archive import archive, publish, write_snapshot
+from caches import activity_cache, attendee_cache, badge_cache, scans_cache
+from extensions import db
+from models import (
+    UserModel,
+    ActivityModel,
+    ActivityScanCountModel,
+    ArchiveSnapshotModel,
+    ScanModel,
+    ScanRollupModel,
+    UserCategoryScanCountModel,
+    UserListVersionModel,
+    UserScanCountModel,
+)
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class ScanEntry(NamedTuple):
+    """A scan to record for a user.
+
+    scanned_at defaults to the time the scan is written when not given. A scan
+    with a client_scan_id is only recorded once per user; repeats are
+    duplicates.
+    """
+
+    user_id: int
+    activity_name: str
+    activity_category: str
+    scanned_at: datetime | None = None
+    client_scan_id: str | None = None
+
+
+class ScanResult(NamedTuple):
+    """The outcome of recording a ScanEntry.
+
+    For a duplicate, scan is the user's scan first recorded with its
+    client_scan_id.
+    """
+
+    scan: ScanModel
+    duplicate: bool = False
+
+
+def _with_scans(query):
+    """Eager load scans and their activities alongside the users in `query`.
+
+    Scans are fetched with a single batched IN query for all users and their
+    activities are joined into that same query, so loading any number of users
+    costs a constant number of round trips.
+    """
+    return query.options(selectinload(UserModel.scans).joinedload(ScanModel.activity))
+
+
+def get_users(limit: int | None = None, after: int | None = None):
+    """Fetch users with their scan history, ordered by ID.
+
+    Args:
+        limit (int, optional): Maximum number of users to return.
+        after (int, optional): Keyset cursor; only users with a greater ID are
+            returned.
+
+    Returns:
+        list: Users ordered by ID, with scans and activities loaded.
+    """
+    query = UserModel.query.order_by(UserModel.id)
+    if after is not None:
+        query = query.filter(UserModel.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return _with_scans(query).all()
+
+
+def get_user_updated_at(user_id: int):
+    """Fetch when a user or their scan history last changed.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        datetime | None: The user's updated_at, or None if the user doesn't exist.
+    """
+    return db.session.scalar(
+        db.select(UserModel.updated_at).where(UserModel.id == user_id)
+    )
+
+
+def get_users_version():
+    """Fetch a counter that changes whenever any user or scan history changes.
+
+    Triggers bump it in the transaction of every insert, update or delete of a
+    user, and recording or archiving scans touches their users, so a writer
+    that waited for the write lock can't commit a change the counter misses.
+
+    Returns:
+        int: The current version of the user list.
+    """
+    return db.session.scalar(db.select(UserListVersionModel.version)) or 0
+
+
+def iter_users(
+    limit: int | None = None, after: int | None = None, batch_size: int = 500
+):
+    """Lazily yield users with their scan history.
+
+    Users are read in keyset batches of `batch_size`, so only one batch is held
+    in memory at a time no matter how many users there are.
+
+    Args:
+        limit (int, optional): Maximum number of users to yield.
+        after (int, optional): Keyset cursor; only users with a greater ID are
+            yielded.
+        batch_size (int): Number of users to load per query batch.
+
+    Yields:
+        UserModel: Users ordered by ID, with scans and activities loaded.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batch = get_users(limit=size, after=after)
+        if not batch:
+            return
+        yield from batch
+        after = batch[-1].id
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+def _filter_scans(query, activity_category, activity_name, start, end):
+    if activity_category:
+        query = query.where(ActivityModel.category == activity_category)
+    if activity_name:
+        query = query.where(ActivityModel.name == activity_name)
+    if start:
+        query = query.where(ScanModel.scanned_at >= start)
+    if end:
+        query = query.where(ScanModel.scanned_at < end)
+    return query
+
+
+SCAN_EXPORT_COLUMNS = [
+    "scan_id",
+    "user_id",
+    "user_name",
+    "user_email",
+    "activity_name",
+    "activity_category",
+    "scanned_at",
+]
+
+
+def iter_scan_rows(
+    activity_category: str | None = None,
+    activity_name: str | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    batch_size: int = 1000,
+):
+    """Stream flat scan rows for an export, ordered by scan ID.
+
+    Rows are fetched from a single cursor `batch_size` at a time rather than
+    loaded up front, so memory use doesn't grow with the number of scans.
+
+    Args:
+        activity_category (str, optional): Only include this category.
+        activity_name (str, optional): Only include activities with this name.
+        start (datetime, optional): Only include scans at or after this time.
+        end (datetime, optional): Only include scans before this time.
+        batch_size (int): Number of rows fetched from the cursor at a time.
+
+    Yields:
+        tuple: Values for SCAN_EXPORT_COLUMNS.
+    """
+    query = (
+        db.select(
+            ScanModel.id,
+            ScanModel.user_id,
+            UserModel.name,
+            UserModel.email,
+            ActivityModel.name,
+            ActivityModel.category,
+            ScanModel.scanned_at,
+        )
+        .join(UserModel, ScanModel.user_id == UserModel.id)
+        .join(ActivityModel, ScanModel.activity_id == ActivityModel.id)
+        .order_by(ScanModel.id)
+    )
+    query = _filter_scans(query, activity_category, activity_name, start, end)
+    yield from db.session.execute(query.execution_options(yield_per=batch_size))
+
+
+USER_EXPORT_COLUMNS = ["id", "name", "email", "phone", "badge_code", "updated_at"]
+
+
+def iter_user_rows(
+    activity_category: str | None = None,
+    activity_name: str | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    batch_size: int = 1000,
+):
+    """Stream flat user rows for an export, ordered by ID.
+
+    With any filter given, only users with a matching scan are included.
+
+    Args:
+        activity_category (str, optional): Only include users who scanned into
+            this category.
+        activity_name (str, optional): Only include users who scanned into an
+            activity with this name.
+        start (datetime, optional): Only include users with scans at or after
+            this time.
+        end (datetime, optional): Only include users with scans before this time.
+        batch_size (int): Number of rows fetched from the cursor at a time.
+
+    Yields:
+        tuple: Values for USER_EXPORT_COLUMNS.
+    """
+    query = db.select(
+        *(getattr(UserModel, column) for column in USER_EXPORT_COLUMNS)
+    ).order_by(UserModel.id)
+    if any([activity_category, activity_name, start, end]):
+        scans = (
+            db.select(ScanModel.id)
+            .join(ActivityModel, ScanModel.activity_id == ActivityModel.id)
+            .where(ScanModel.user_id == UserModel.id)
+        )
+        scans = _filter_scans(scans, activity_category, activity_name, start, end)
+        query = query.where(scans.exists())
+    yield from db.session.execute(query.execution_options(yield_per=batch_size))
+
+
+def get_user(user_id: int):
+    """Fetch a single user with their scan history.
+
+    Args:
+        user_id (int): The ID of the user to fetch.
+
+    Returns:
+        UserModel | None: The user with scans and activities loaded, if found.
+    """
+    return _with_scans(UserModel.query.filter_by(id=user_id)).first()
+
+
+def get_user_scans(
+    user_id: int,
+    limit: int,
+    before: tuple | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    activity_category: str | None = None,
+):
+    """Fetch a page of a user's scan history, newest first.
+
+    Pages are read from the (user_id, scanned_at, id) index, so a page costs
+    the same however many scans the user has.
+
+    Args:
+        user_id (int): The ID of the user.
+        limit (int): Maximum number of scans to return.
+        before (tuple, optional): Keyset cursor; only scans older than this
+            (scanned_at, id) are returned.
+        start (datetime, optional): Only include scans at or after this time.
+        end (datetime, optional): Only include scans before this time.
+        activity_category (str, optional): Only include this category.
+
+    Returns:
+        list: ScanModels with their activities loaded, ordered by scanned_at
+            and ID, newest first.
+    """
+    query = (
+        db.select(ScanModel)
+        .join(ScanModel.activity)
+        .options(contains_eager(ScanModel.activity))
+        .where(ScanModel.user_id == user_id)
+        .order_by(ScanModel.scanned_at.desc(), ScanModel.id.desc())
+        .limit(limit)
+    )
+    if before:
+        query = query.where(tuple_(ScanModel.scanned_at, ScanModel.id) < before)
+    query = _filter_scans(query, activity_category, None, start, end)
+    return db.session.scalars(query).all()
+
+
+def warm_activity_cache():
+    """Load every activity into the activity cache."""
+    activity_cache.warm(
+        db.session.execute(
+            db.select(ActivityModel.id, ActivityModel.name, ActivityModel.category)
+            .order_by(ActivityModel.id)
+            .limit(activity_cache.maxsize)
+        )
+    )
+
+
+def mark_scans_written():
+    """Invalidate cached scan aggregates once the current transaction commits."""
+    db.session.info["scans_written"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _update_caches(session):
+    for (name, category), activity_id in session.info.pop(
+        "new_activity_ids", {}
+    ).items():
+        activity_cache.set(name, category, activity_id)
+    if session.info.pop("scans_written", False):
+        scans_cache.invalidate()
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_cache_updates(session, previous_transaction):
+    session.info.pop("new_activity_ids", None)
+    session.info.pop("scans_written", None)
+
+
+def _attach_activity(activity_id: int, name: str, category: str):
+    """Attach a cached activity to the session without querying for it."""
+    activity = ActivityModel(id=activity_id, name=name, category=category)  # type: ignore
+    make_transient_to_detached(activity)
+    return db.session.merge(activity, load=False)
+
+
+def get_activity_ids(pairs):
+    """Resolve (name, category) pairs to activity IDs, creating missing ones.
+
+    Lookups go through the activity cache. Misses are upserted against the
+    unique (name, category) index, so concurrent workers can't create
+    duplicates, and then read back in a single query. Their IDs are only
+    cached once the transaction commits.
+
+    Args:
+        pairs (iterable): (activity_name, activity_category) tuples.
+
+    Returns:
+        dict: Mapping of (name, category) to activity ID.
+    """
+    if not activity_cache.warmed:
+        warm_activity_cache()
+
+    activity_ids, missing = {}, []
+    for name, category in set(pairs):
+        activity_id = activity_cache.get(name, category)
+        if activity_id is None:
+            missing.append((name, category))
+        else:
+            activity_ids[(name, category)] = activity_id
+
+    if missing:
+        db.session.execute(
+            insert(ActivityModel).on_conflict_do_nothing(
+                index_elements=["name", "category"]
+            ),
+            [{"name": name, "category": category} for name, category in missing],
+        )
+        rows = db.session.execute(
+            db.select(
+                ActivityModel.id, ActivityModel.name, ActivityModel.category
+            ).where(tuple_(ActivityModel.name, ActivityModel.category).in_(missing))
+        )
+        created = {
+            (name, category): activity_id for activity_id, name, category in rows
+        }
+        db.session.info.setdefault("new_activity_ids", {}).update(created)
+        activity_ids.update(created)
+
+    return activity_ids
+
+
+def get_or_create_activities(pairs):
+    """Resolve (name, category) pairs to activities, creating missing ones.
+
+    Args:
+        pairs (iterable): (activity_name, activity_category) tuples.
+
+    Returns:
+        dict: Mapping of (name, category) to ActivityModel.
+    """
+    return {
+        (name, category): _attach_activity(activity_id, name, category)
+        for (name, category), activity_id in get_activity_ids(pairs).items()
+    }
+
+
+def get_user_id_by_badge(badge_code: str):
+    """Resolve a badge code to a user ID, going through the badge cache.
+
+    Args:
+        badge_code (str): The badge code to resolve.
+
+    Returns:
+        int | None: The ID of the user holding the badge, if any.
+    """
+    user_id = badge_cache.get(badge_code)
+    if user_id is None:
+        user_id = db.session.scalar(
+            db.select(UserModel.id).where(UserModel.badge_code == badge_code)
+        )
+        if user_id is not None:
+            badge_cache.set(badge_code, user_id)
+    return user_id
+
+
+def get_badge_holder(badge_code: str):
+    """Resolve a badge code to the user holding it now.
+
+    Unlike get_user_id_by_badge, a cached user ID is checked against the user,
+    so a badge that changed hands is never resolved to its old holder.
+
+    Args:
+        badge_code (str): The badge code to resolve.
+
+    Returns:
+        int | None: The ID of the user holding the badge, if any.
+    """
+    user_id = badge_cache.get(badge_code)
+    if user_id is not None and db.session.scalar(
+        db.select(UserModel.id).where(
+            UserModel.id == user_id, UserModel.badge_code == badge_code
+        )
+    ):
+        return user_id
+    badge_cache.invalidate(badge_code)
+    return get_user_id_by_badge(badge_code)
+
+
+def get_user_by_badge(badge_code: str):
+    """Fetch a user and their scan history by badge code.
+
+    Args:
+        badge_code (str): The badge code of the user to fetch.
+
+    Returns:
+        UserModel | None: The user with scans and activities loaded, if found.
+    """
+    user_id = get_user_id_by_badge(badge_code)
+    if user_id is None:
+        return None
+
+    user = get_user(user_id)
+    if user is None or user.badge_code != badge_code:
+        badge_cache.invalidate(badge_code)
+        user_id = get_user_id_by_badge(badge_code)
+        user = get_user(user_id) if user_id is not None else None
+    return user
+
+
+def _search_match(query: str):
+    """Turn free text into an FTS5 query matching every word as a prefix.
+
+    Each word is quoted, so punctuation such as "@" or "-" can't be read as
+    query syntax; FTS5 splits it into a phrase of consecutive tokens instead.
+    """
+    words = [word for word in query.split() if any(c.isalnum() for c in word)]
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def search_users(query: str, limit: int = 20, offset: int = 0):
+    """Find users by partial name, email or phone number.
+
+    Results are ranked with bm25, weighting name matches over email matches
+    over phone matches, with ties broken by ID so pages are stable.
+
+    Args:
+        query (str): Words to match, each as a prefix of a word in the user's
+            name, email or phone number.
+        limit (int): Maximum number of users to return.
+        offset (int): Number of ranked users to skip.
+
+    Returns:
+        list: Rows with the id, name, email, phone and badge_code of each user.
+    """
+    match = _search_match(query)
+    if not match:
+        return []
+    return db.session.execute(
+        db.text(
+            "SELECT user.id, user.name, user.email, user.phone, user.badge_code "
+            "FROM user_search JOIN user ON user.id = user_search.rowid "
+            "WHERE user_search MATCH :match "
+            "ORDER BY bm25(user_search, 10.0, 5.0, 1.0), user.id "
+            "LIMIT :limit OFFSET :offset"
+        ),
+        {"match": match, "limit": limit, "offset": offset},
+    ).all()
+
+
+def _add_scans(entries):
+    """Add scans for users already known to exist and flush them.
+
+    Scans with a client_scan_id are inserted with one INSERT ... ON CONFLICT
+    DO NOTHING, so the unique (user_id, client_scan_id) index rejects ones
+    already recorded for the same user without a lookup first. The scans they
+    duplicate are loaded with a single query.
+
+    Args:
+        entries (list): ScanEntry tuples.
+
+    Returns:
+        list: A ScanResult for each entry.
+    """
+    entries = [ScanEntry(*entry) for entry in entries]
+    activities = get_or_create_activities(
+        (entry.activity_name, entry.activity_category) for entry in entries
+    )
+    results = [None] * len(entries)
+    scans, keyed = [], {}
+    for index, entry in enumerate(entries):
+        if entry.client_scan_id is not None:
+            keyed.setdefault((entry.user_id, entry.client_scan_id), index)
+            continue
+        scan = ScanModel(
+            user_id=entry.user_id,
+            activity=activities[(entry.activity_name, entry.activity_category)],
+        )  # type: ignore
+        if entry.scanned_at is not None:
+            scan.scanned_at = entry.scanned_at
+        scans.append(scan)
+        results[index] = ScanResult(scan)
+    db.session.add_all(scans)
+    db.session.flush()
+
+    if keyed:
+        now = datetime.now()
+        created = {
+            (scan.user_id, scan.client_scan_id): scan
+            for scan in db.session.scalars(
+                insert(ScanModel)
+                .on_conflict_do_nothing(
+                    index_elements=[ScanModel.user_id, ScanModel.client_scan_id]
+                )
+                .returning(ScanModel),
+                [
+                    {
+                        "user_id": entry.user_id,
+                        "activity_id": activities[
+                            (entry.activity_name, entry.activity_category)
+                        ].id,
+                        "scanned_at": entry.scanned_at or now,
+                        "client_scan_id": entry.client_scan_id,
+                    }
+                    for entry in (entries[index] for index in keyed.values())
+                ],
+            )
+        }
+        scans.extend(created.values())
+        existing = {}
+        duplicates = keyed.keys() - created.keys()
+        if duplicates:
+            existing = {
+                (scan.user_id, scan.client_scan_id): scan
+                for scan in db.session.scalars(
+                    db.select(ScanModel).where(
+                        tuple_(ScanModel.user_id, ScanModel.client_scan_id).in_(
+                            duplicates
+                        )
+                    )
+                )
+            }
+        for index, entry in enumerate(entries):
+            if entry.client_scan_id is None:
+                continue
+            key = (entry.user_id, entry.client_scan_id)
+            if key in created and keyed[key] == index:
+                results[index] = ScanResult(created[key])
+            else:
+                results[index] = ScanResult(created.get(key) or existing[key], True)
+
+    if scans:
+        mark_scans_written()
+    return results
+
+
+def _touch_users(user_ids):
+    """Bump the updated_at of users whose scan history changed."""
+    if user_ids:
+        db.session.execute(
+            update(UserModel)
+            .where(UserModel.id.in_(user_ids))
+            .values(updated_at=datetime.now())
+        )
+
+
+def record_scans(entries):
+    """Record a batch of scans in the current transaction.
+
+    Users are resolved and their updated_at bumped with one statement each, and
+    activities are resolved in bulk, so the cost doesn't grow with a query per
+    scan. Users whose scans were all duplicates keep their updated_at.
+    Changes are flushed but not committed so the caller controls the
+    transaction.
+
+    Args:
+        entries (list): ScanEntry tuples, or plain (user_id, activity_name,
+            activity_category) tuples.
+
+    Returns:
+        list: A ScanResult for each entry, or None where the user doesn't
+            exist.
+    """
+    entries = [ScanEntry(*entry) for entry in entries]
+    user_ids = {entry.user_id for entry in entries}
+    found = set(
+        db.session.scalars(db.select(UserModel.id).where(UserModel.id.in_(user_ids)))
+    )
+
+    results = _add_scans([entry for entry in entries if entry.user_id in found])
+    _touch_users({result.scan.user_id for result in results if not result.duplicate})
+    results = iter(results)
+    return [next(results) if entry.user_id in found else None for entry in entries]
+
+
+def record_badge_scan(
+    badge_code: str,
+    activity_name: str,
+    activity_category: str,
+    scanned_at: datetime | None = None,
+    client_scan_id: str | None = None,
+):
+    """Record a scan for the holder of a badge in the current transaction.
+
+    When the badge is cached and the scan has no client_scan_id, the user's
+    updated_at bump doubles as the check that the badge still belongs to them,
+    so no user query is needed. A keyed scan may be a duplicate, so its user is
+    only touched once it has been recorded.
+
+    Args:
+        badge_code (str): The badge code that was scanned.
+        activity_name (str): Name of the activity.
+        activity_category (str): Category of the activity.
+        scanned_at (datetime, optional): When the scan was taken.
+        client_scan_id (str, optional): Idempotency key for the scan.
+
+    Returns:
+        ScanResult | None: The scan, or None if no user holds the badge.
+    """
+
+    def holds_badge(user_id):
+        owner = (UserModel.id == user_id) & (UserModel.badge_code == badge_code)
+        if client_scan_id is not None:
+            return db.session.scalar(db.select(UserModel.id).where(owner)) is not None
+        result = db.session.execute(
+            update(UserModel).where(owner).values(updated_at=datetime.now())
+        )
+        return result.rowcount == 1
+
+    user_id = badge_cache.get(badge_code)
+    if user_id is None or not holds_badge(user_id):
+        badge_cache.invalidate(badge_code)
+        user_id = get_user_id_by_badge(badge_code)
+        if user_id is None or not holds_badge(user_id):
+            return None
+
+    (result,) = _add_scans(
+        [
+            ScanEntry(
+                user_id, activity_name, activity_category, scanned_at, client_scan_id
+            )
+        ]
+    )
+    if client_scan_id is not None and not result.duplicate:
+        _touch_users({user_id})
+    return result
+
+
+def get_activity_scan_counts(
+    min_frequency: int | None = None,
+    max_frequency: int | None = None,
+    activity_category: str | None = None,
+):
+    """Fetch per-activity scan counts from the maintained counter table.
+
+    Args:
+        min_frequency (int, optional): Minimum number of scans.
+        max_frequency (int, optional): Maximum number of scans.
+        activity_category (str, optional): Only include this category.
+
+    Returns:
+        list: (name, category, scan_count) rows ordered by activity ID.
+    """
+    query = (
+        db.session.query(
+            ActivityModel.name,
+            ActivityModel.category,
+            ActivityScanCountModel.scan_count,
+        )
+        .join(
+            ActivityScanCountModel,
+            ActivityModel.id == ActivityScanCountModel.activity_id,
+        )
+        .filter(ActivityScanCountModel.scan_count > 0)
+        .order_by(ActivityModel.id)
+    )
+
+    if min_frequency:
+        query = query.filter(ActivityScanCountModel.scan_count >= min_frequency)
+    if max_frequency:
+        query = query.filter(ActivityScanCountModel.scan_count <= max_frequency)
+    if activity_category:
+        query = query.filter(ActivityModel.category == activity_category)
+    return query.all()
+
+
+def _add_counts(model, columns, counts):
+    """Add counts onto a counter table, creating the rows that are missing.
+
+    Args:
+        model: The counter model, with a scan_count column.
+        columns (list): The counter's key columns.
+        counts (dict): Scan counts keyed on a key value, or a tuple of them.
+    """
+    if not counts:
+        return
+    statement = insert(model)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=columns,
+            set_={"scan_count": model.scan_count + statement.excluded.scan_count},
+        ),
+        [
+            dict(
+                zip(columns, key if isinstance(key, tuple) else (key,)),
+                scan_count=count,
+            )
+            for key, count in counts.items()
+        ],
+    )
+
+
+def rebuild_activity_scan_counts():
+    """Recompute every activity scan counter from the scan table and archive.
+
+    The counters are reset in place rather than replaced, so their versions
+    keep increasing and cached attendee sets are invalidated.
+    """
+    db.session.execute(
+        update(ActivityScanCountModel).values(
+            scan_count=0, version=ActivityScanCountModel.version + 1
+        )
+    )
+    statement = insert(ActivityScanCountModel).from_select(
+        ["activity_id", "scan_count", "version"],
+        db.select(ScanModel.activity_id, db.func.count(ScanModel.id), db.literal(1))
+        .where(db.true())
+        .group_by(ScanModel.activity_id),
+    )
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=["activity_id"],
+            set_={"scan_count": statement.excluded.scan_count},
+        )
+    )
+    _add_counts(ActivityScanCountModel, ["activity_id"], archive.activity_counts())
+    mark_scans_written()
+    db.session.commit()
+
+
+def get_scan_timeseries(
+    bucket_size: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    activity_category: str | None = None,
+):
+    """Fetch per-activity scan counts in time buckets from the rollup table.
+
+    Args:
+        bucket_size (int): Bucket width in seconds, a multiple of the rollup's
+            bucket size.
+        start (datetime, optional): Only count scans at or after this time.
+        end (datetime, optional): Only count scans before this time.
+        activity_category (str, optional): Only include this category.
+
+    Returns:
+        list: (name, category, bucket_start, scan_count) rows ordered by
+            activity ID and bucket.
+    """
+    bucket = ScanRollupModel.bucket_start // bucket_size * bucket_size
+    query = (
+        db.session.query(
+            ActivityModel.name,
+            ActivityModel.category,
+            bucket,
+            db.func.sum(ScanRollupModel.scan_count),
+        )
+        .join(ScanRollupModel, ActivityModel.id == ScanRollupModel.activity_id)
+        .filter(ScanRollupModel.scan_count > 0)
+        .group_by(ActivityModel.id, bucket)
+        .order_by(ActivityModel.id, bucket)
+    )
+
+    if start:
+        query = query.filter(
+            ScanRollupModel.bucket_start >= (start - EPOCH).total_seconds()
+        )
+    if end:
+        query = query.filter(
+            ScanRollupModel.bucket_start < (end - EPOCH).total_seconds()
+        )
+    if activity_category:
+        query = query.filter(ActivityModel.category == activity_category)
+    return [
+        (name, category, EPOCH + timedelta(seconds=bucket_start), count)
+        for name, category, bucket_start, count in query
+    ]
+
+
+def rebuild_scan_rollups():
+    """Recompute the time-bucketed scan rollups from the scan table and archive."""
+    size = ScanRollupModel.bucket_size
+    # Truncate to whole seconds first: SQLite rounds to milliseconds otherwise.
+    seconds = db.func.strftime("%s", db.func.substr(ScanModel.scanned_at, 1, 19))
+    bucket = db.cast(seconds, db.Integer) // size * size
+    db.session.execute(db.delete(ScanRollupModel))
+    db.session.execute(
+        db.insert(ScanRollupModel).from_select(
+            ["activity_id", "bucket_start", "scan_count"],
+            db.select(
+                ScanModel.activity_id, bucket, db.func.count(ScanModel.id)
+            ).group_by(ScanModel.activity_id, bucket),
+        )
+    )
+    _add_counts(
+        ScanRollupModel, ["activity_id", "bucket_start"], archive.bucket_counts()
+    )
+    mark_scans_written()
+    db.session.commit()
+
+
+def _scan_counter(category: str | None):
+    """Return the counter model and row filter for the overall or a category ranking."""
+    if category is None:
+        return UserScanCountModel, db.true()
+    return (
+        UserCategoryScanCountModel,
+        UserCategoryScanCountModel.category == category,
+    )
+
+
+def get_leaderboard(limit: int = 10, category: str | None = None):
+    """Fetch the users with the most scans from the maintained counters.
+
+    Rows are read in order from the counters' (scan_count DESC, user_id) index,
+    so only `limit` counters are read no matter how many users there are.
+    Users with the same number of scans share a rank.
+
+    Args:
+        limit (int): Number of users to return.
+        category (str, optional): Rank by scans in this activity category.
+
+    Returns:
+        list: Dicts with the rank, user_id, name and scan_count of each user,
+            ordered by rank and then user ID.
+    """
+    counter, in_category = _scan_counter(category)
+    rows = db.session.execute(
+        db.select(counter.user_id, UserModel.name, counter.scan_count)
+        .join(UserModel, UserModel.id == counter.user_id)
+        .where(in_category, counter.scan_count > 0)
+        .order_by(counter.scan_count.desc(), counter.user_id)
+        .limit(limit)
+    )
+    leaderboard = []
+    for position, (user_id, name, scan_count) in enumerate(rows, 1):
+        if leaderboard and leaderboard[-1]["scan_count"] == scan_count:
+            rank = leaderboard[-1]["rank"]
+        else:
+            rank = position
+        leaderboard.append(
+            {"rank": rank, "user_id": user_id, "name": name, "scan_count": scan_count}
+        )
+    return leaderboard
+
+
+def get_user_rank(user_id: int, category: str | None = None):
+    """Fetch a user's position on the leaderboard.
+
+    Args:
+        user_id (int): The ID of the user.
+        category (str, optional): Rank by scans in this activity category.
+
+    Returns:
+        tuple: (rank, scan_count). The rank is one more than the number of
+            users with more scans.
+    """
+    counter, in_category = _scan_counter(category)
+    scan_count = (
+        db.session.scalar(
+            db.select(counter.scan_count).where(in_category, counter.user_id == user_id)
+        )
+        or 0
+    )
+    ahead = db.session.scalar(
+        db.select(db.func.count())
+        .select_from(counter)
+        .where(in_category, counter.scan_count > scan_count)
+    )
+    return ahead + 1, scan_count
+
+
+def rebuild_user_scan_counts():
+    """Recompute the per-user and per-user-per-category counters from the scan
+    table and archive."""
+    db.session.execute(db.delete(UserScanCountModel))
+    db.session.execute(
+        db.insert(UserScanCountModel).from_select(
+            ["user_id", "scan_count"],
+            db.select(ScanModel.user_id, db.func.count(ScanModel.id)).group_by(
+                ScanModel.user_id
+            ),
+        )
+    )
+    db.session.execute(db.delete(UserCategoryScanCountModel))
+    db.session.execute(
+        db.insert(UserCategoryScanCountModel).from_select(
+            ["user_id", "category", "scan_count"],
+            db.select(
+                ScanModel.user_id, ActivityModel.category, db.func.count(ScanModel.id)
+            )
+            .join(ActivityModel, ScanModel.activity_id == ActivityModel.id)
+            .group_by(ScanModel.user_id, ActivityModel.category),
+        )
+    )
+    users, categories = archive.user_counts()
+    _add_counts(UserScanCountModel, ["user_id"], users)
+    _add_counts(UserCategoryScanCountModel, ["user_id", "category"], categories)
+    db.session.commit()
+
+
+def get_attendee_ids(activity_id: int):
+    """Fetch the IDs of every user who scanned into an activity.
+
+    The set is cached per activity along with the activity's scan counter
+    version, which every insert and delete bumps. While the version is
+    unchanged the cached set is returned as is; when the counter has grown by
+    as much as the version, only scans were added, so just those are read to
+    top the set up. Otherwise it's rebuilt from the (activity_id, user_id)
+    index and the archived scans. Archiving leaves the counter alone, so it
+    doesn't invalidate the set.
+
+    Args:
+        activity_id (int): The ID of the activity.
+
+    Returns:
+        frozenset: IDs of the users with at least one scan of the activity.
+    """
+    counter = db.session.execute(
+        db.select(
+            ActivityScanCountModel.version, ActivityScanCountModel.scan_count
+        ).where(ActivityScanCountModel.activity_id == activity_id)
+    ).first()
+    version, scan_count = counter or (0, 0)
+    entry = attendee_cache.get(activity_id)
+    if entry is not None:
+        cached_version, cached_count, last_scan_id, user_ids = entry
+        if cached_version == version:
+            attendee_cache.record(hit=True)
+            return user_ids
+        added = scan_count - cached_count
+        if added > 0 and version - cached_version == added:
+            rows = db.session.execute(
+                db.select(ScanModel.id, ScanModel.user_id).where(
+                    ScanModel.activity_id == activity_id, ScanModel.id > last_scan_id
+                )
+            ).all()
+            if len(rows) == added:
+                attendee_cache.record(hit=True)
+                return attendee_cache.set(
+                    activity_id,
+                    version,
+                    scan_count,
+                    max(scan_id for scan_id, _ in rows),
+                    user_ids.union(user_id for _, user_id in rows),
+                )
+
+    attendee_cache.record(hit=False)
+    rows = db.session.execute(
+        db.select(ScanModel.id, ScanModel.user_id).where(
+            ScanModel.activity_id == activity_id
+        )
+    ).all()
+    return attendee_cache.set(
+        activity_id,
+        version,
+        scan_count,
+        max((scan_id for scan_id, _ in rows), default=0),
+        archive.attendee_ids(activity_id).union(user_id for _, user_id in rows),
+    )
+
+
+def get_attendees(activity_id: int, limit: int, after: int | None = None):
+    """Fetch a page of the users who scanned into an activity, ordered by ID.
+
+    The distinct user IDs for the page are read from the (activity_id, user_id)
+    index without touching the scan rows, and merged with those of archived
+    scans.
+
+    Args:
+        activity_id (int): The ID of the activity.
+        limit (int): Maximum number of users to return.
+        after (int, optional): Keyset cursor; only users with a greater ID are
+            returned.
+
+    Returns:
+        list: Rows with the id, name, email, phone and badge_code of each user.
+    """
+    after = after or 0
+    page = db.session.scalars(
+        db.select(ScanModel.user_id)
+        .where(ScanModel.activity_id == activity_id, ScanModel.user_id > after)
+        .distinct()
+        .order_by(ScanModel.user_id)
+        .limit(limit)
+    ).all()
+    archived = archive.attendee_ids(activity_id)
+    if archived:
+        page = sorted(set(page).union(u for u in archived if u > after))[:limit]
+    if not page:
+        return []
+    return db.session.execute(
+        db.select(
+            UserModel.id,
+            UserModel.name,
+            UserModel.email,
+            UserModel.phone,
+            UserModel.badge_code,
+        )
+        .where(UserModel.id.in_(page))
+        .order_by(UserModel.id)
+    ).all()
+
+
+_DELETE_TRIGGER = re.compile(
+    r"CREATE TRIGGER IF NOT EXISTS (\w+)\s+AFTER DELETE ON scan"
+)
+
+
+def _delete_triggers():
+    """Return the name and DDL of every counter trigger that fires on scan deletes."""
+    models = (
+        ActivityScanCountModel,
+        ScanRollupModel,
+        UserScanCountModel,
+        UserCategoryScanCountModel,
+    )
+    return [
+        (match.group(1), trigger)
+        for model in models
+        for trigger in model.triggers
+        if (match := _DELETE_TRIGGER.search(trigger))
+    ]
+
+
+def _iter_archive_rows(archived, activity_ids, batch_size: int = 1000):
+    """Stream the scans to archive an activity at a time, in snapshot order."""
+    for activity_id in activity_ids:
+        yield from db.session.execute(
+            db.select(
+                ScanModel.id,
+                ScanModel.user_id,
+                ScanModel.activity_id,
+                ScanModel.scanned_at,
+            )
+            .where(archived, ScanModel.activity_id == activity_id)
+            .order_by(ScanModel.scanned_at, ScanModel.id)
+            .execution_options(yield_per=batch_size)
+        )
+
+
+def archive_scans(before: datetime):
+    """Move the scans taken before a cutoff into a new archive snapshot.
+
+    The snapshot is written first, streaming the scans an activity at a time,
+    then the scans are deleted in one transaction with the counter delete
+    triggers dropped, so the activity, rollup and leaderboard counters keep
+    counting archived scans. Their users' updated_at is bumped since their scan
+    history changes. The transaction is rolled back if the scans changed in
+    between.
+
+    The snapshot is recorded in archive_snapshot in the same transaction and
+    only gets its final name once it commits. If the process dies before the
+    rename, recover_archive publishes the snapshot, so the deleted scans are
+    never lost.
+
+    Args:
+        before (datetime): Archive scans taken before this time.
+
+    Returns:
+        tuple: The snapshot's path and the number of scans archived, or
+            (None, 0) if there were none.
+    """
+    count, last_id = db.session.execute(
+        db.select(db.func.count(ScanModel.id), db.func.max(ScanModel.id)).where(
+            ScanModel.scanned_at < before
+        )
+    ).one()
+    if not count:
+        db.session.rollback()
+        return None, 0
+
+    # Scans recorded from here on are left for the next run.
+    archived = (ScanModel.scanned_at < before) & (ScanModel.id <= last_id)
+    activities = {
+        activity.id: (activity.name, activity.category)
+        for activity in db.session.execute(
+            db.select(ActivityModel.id, ActivityModel.name, ActivityModel.category)
+            .where(
+                ActivityModel.id.in_(db.select(ScanModel.activity_id).where(archived))
+            )
+            .order_by(ActivityModel.id)
+        )
+    }
+    path = archive.new_path(before)
+    partial = path + ".partial"
+    try:
+        written = write_snapshot(
+            partial, _iter_archive_rows(archived, activities), activities
+        )
+        db.session.execute(
+            update(UserModel)
+            .where(UserModel.id.in_(db.select(ScanModel.user_id).where(archived)))
+            .values(updated_at=datetime.now())
+        )
+        connection = db.session.connection()
+        triggers = _delete_triggers()
+        for name, _ in triggers:
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+        deleted = db.session.execute(db.delete(ScanModel).where(archived)).rowcount
+        for _, trigger in triggers:
+            connection.exec_driver_sql(trigger)
+        if not deleted == written == count:
+            raise RuntimeError(
+                f"{deleted} scans matched the cutoff, but {written} were archived"
+            )
+        db.session.add(
+            ArchiveSnapshotModel(name=os.path.basename(path), scan_count=count)  # type: ignore
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    publish(partial, path)
+    return path, count
+
+
+def recover_archive():
+    """Publish the snapshots whose scans were archived but which kept their
+    .partial name because the process died before renaming them.
+
+    Snapshots that were never recorded in archive_snapshot are left alone:
+    their scans are still in the database.
+
+    Returns:
+        list: Paths of the recovered snapshots.
+    """
+    if not archive.directory:
+        return []
+    recovered = []
+    for name in db.session.scalars(db.select(ArchiveSnapshotModel.name)):
+        path = os.path.join(archive.directory, name)
+        if not os.path.exists(path) and os.path.exists(path + ".partial"):
+            publish(path + ".partial", path)
+            recovered.append(path)
+    return recovered
@@ -0,0 +1,149 @@
+"""Precompiled JSON encoders for flask_restful field specs.
+
+`marshal` walks the field spec dicts for every object it serializes. The
+encoders here walk each spec once, when it is first used, and build a function
+per field that writes its JSON fragment directly. The output is byte-identical
+to marshalling the object and dumping it with flask_restful's JSON
+representation.
+
+Strings are escaped with the json module's C string encoder, the same routine
+`json.dumps` uses, so output matches exactly. Field types without a specialized
+encoder fall back to the field's own `output` method.
+"""
+
+from json import dumps
+from json.encoder import encode_basestring_ascii
+from flask import Response, current_app
+from flask_restful import fields as restful_fields, marshal
+from extensions import api
+
+_encoders = {}
+
+
+def _make(field):
+    return field() if isinstance(field, type) else field
+
+
+def _value_encoder(field):
+    """Build a function encoding a value already fetched for `field`.
+
+    Returns None when the field has no specialized encoder.
+    """
+    default = dumps(field.default)
+    kind = type(field)
+
+    if kind is restful_fields.String:
+        return lambda value: (
+            default if value is None else encode_basestring_ascii(str(value))
+        )
+    if kind is restful_fields.Integer:
+        return lambda value: default if value is None else int.__repr__(int(value))
+    if kind is restful_fields.DateTime and field.dt_format == "iso8601":
+        return lambda value: (
+            default if value is None else encode_basestring_ascii(value.isoformat())
+        )
+    if kind is restful_fields.List and type(field.container) is restful_fields.Nested:
+        nested = field.container
+        if nested.attribute is not None:
+            return None
+        encode_item = _object_encoder(nested.nested)
+        allow_null = nested.allow_null or nested.default is not None
+
+        def encode_list(value):
+            if value is None:
+                return default
+            if isinstance(value, (str, dict)) or not hasattr(value, "__iter__"):
+                return "[" + encode_item(value) + "]"
+            if allow_null and any(item is None for item in value):
+                return dumps(field.format(value))
+            return "[" + ", ".join([encode_item(item) for item in value]) + "]"
+
+        return encode_list
+    return None
+
+
+def _field_encoder(key, field):
+    """Build a function encoding `key` of an object as a JSON fragment."""
+    if isinstance(field, dict):
+        return _object_encoder(field)
+
+    field = _make(field)
+    encode_value = _value_encoder(field) if field.attribute is None else None
+    if encode_value is None:
+        return lambda obj: dumps(field.output(key, obj))
+
+    def encode(obj):
+        if isinstance(obj, dict):
+            return encode_value(obj.get(key))
+        return encode_value(getattr(obj, key, None))
+
+    return encode
+
+
+def _object_encoder(spec):
+    """Build a function encoding an object with the fields in `spec`."""
+    parts = [
+        (encode_basestring_ascii(key) + ": ", _field_encoder(key, field))
+        for key, field in spec.items()
+    ]
+
+    def encode(obj):
+        return "{" + ", ".join([prefix + field(obj) for prefix, field in parts]) + "}"
+
+    return encode
+
+
+def compile_fields(spec):
+    """Return the cached encoder for a field spec, compiling it on first use.
+
+    Args:
+        spec (dict): flask_restful field spec, e.g. UserModel.fields.
+
+    Returns:
+        callable: Encodes an object, dict or list of them as a JSON string.
+    """
+    encoder = _encoders.get(id(spec))
+    if encoder is None:
+        encode_object = _object_encoder(spec)
+
+        def encoder(data):
+            if isinstance(data, (list, tuple)):
+                return "[" + ", ".join([encode_object(item) for item in data]) + "]"
+            return encode_object(data)
+
+        _encoders[id(spec)] = encoder
+    return encoder
+
+
+def encode(data, spec):
+    """Serialize data with a field spec, exactly like json.dumps(marshal(...)).
+
+    Args:
+        data: Object, dict, or list of them to serialize.
+        spec (dict): flask_restful field spec.
+
+    Returns:
+        str: The JSON document.
+    """
+    return compile_fields(spec)(data)
+
+
+def respond(data, spec, status: int = 200, headers=None):
+    """Build a JSON response for data serialized with a field spec.
+
+    Falls back to marshal and flask_restful's representation when the app is
+    in debug mode or RESTFUL_JSON is set, since those change the formatting.
+
+    Args:
+        data: Object, dict, or list of them to serialize.
+        spec (dict): flask_restful field spec.
+        status (int): HTTP status code.
+        headers (dict, optional): Extra response headers.
+
+    Returns:
+        Response: The JSON response.
+    """
+    if current_app.debug or current_app.config.get("RESTFUL_JSON"):
+        return api.make_response(marshal(data, spec), status, headers=headers)
+    body = (encode(data, spec) + "\n").encode()
+    return Response(body, status, headers, mimetype="application/json")
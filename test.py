@@ -1,6 +1,70 @@
 import pytest
 import json
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
 from app import app, db, UserModel, ActivityModel, ScanModel
+from models import (
+    ActivityScanCountModel,
+    ScanRollupModel,
+    UserCategoryScanCountModel,
+    UserScanCountModel,
+)
+from datetime import datetime, timedelta, timezone
+from archive import Snapshot, archive
+from caches import QueryCache, activity_cache, attendee_cache, badge_cache, scans_cache
+from flask_restful import fields, marshal
+from flask_restful.representations.json import output_json
+import bench
+import csv
+import exports
+import gzip
+import helpers
+import io
+import sqlite3
+import threading
+import time
+import metrics
+import migrations
+import repository
+import serializers
+from write_behind import ScanQueue, scan_queue
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def seed_scan_history(users=5, scans_per_user=4):
+    with app.app_context():
+        activities = ActivityModel.query.filter_by(category="workshop").all()
+        if not activities:
+            activities = [
+                ActivityModel(name=f"activity{i}", category="workshop")  # type: ignore
+                for i in range(3)
+            ]
+            db.session.add_all(activities)
+        offset = UserModel.query.count()
+        for i in range(offset, offset + users):
+            user = UserModel(name=f"User {i}", email=f"user{i}@example.com", phone=f"555-000-{i:04}")  # type: ignore
+            db.session.add(user)
+            for j in range(scans_per_user):
+                db.session.add(ScanModel(user=user, activity=activities[j % 3]))  # type: ignore
+        db.session.commit()
 
 
 @pytest.fixture
@@ -8,6 +72,11 @@ def client():
     app.config["TESTING"] = True
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
     client = app.test_client()
+    badge_cache.clear()
+    activity_cache.clear()
+    attendee_cache.clear()
+    scans_cache.clear()
+    metrics.registry.reset()
 
     with app.app_context():
         db.create_all()
@@ -30,6 +99,102 @@ class TestUsersResource:
         assert data[0]["name"] == "Test User"
         assert data[0]["scans"] == []
 
+    def test_user_list_query_count_is_constant(self, client):
+        seed_scan_history(users=2)
+        with count_queries() as small:
+            client.get("/users")
+
+        seed_scan_history(users=20)
+        with count_queries() as large:
+            response = client.get("/users")
+
+        data = json.loads(response.data)
+        assert len(data) == 23
+        assert data[-1]["scans"][0]["activity_name"] == "activity0"
+        assert len(large) == len(small) <= 3
+
+    def test_user_list_pagination(self, client):
+        seed_scan_history(users=4)
+
+        response = client.get("/users?limit=2")
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert [user["name"] for user in data] == ["Test User", "User 1"]
+        assert response.headers["X-Next-Cursor"] == "2"
+
+        response = client.get("/users?limit=2&after=2")
+        data = json.loads(response.data)
+        assert [user["name"] for user in data] == ["User 2", "User 3"]
+        assert response.headers["X-Next-Cursor"] == "4"
+
+        response = client.get("/users?limit=2&after=4")
+        data = json.loads(response.data)
+        assert [user["name"] for user in data] == ["User 4"]
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_user_list_etag(self, client):
+        response = client.get("/users")
+        etag = response.headers["ETag"]
+
+        with count_queries() as statements:
+            response = client.get("/users", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert len(statements) == 1
+
+        response = client.get("/users?limit=1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+        client.put(
+            "/users/1",
+            data=json.dumps({"name": "Updated Name"}),
+            content_type="application/json",
+        )
+        response = client.get("/users", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert json.loads(response.data)[0]["name"] == "Updated Name"
+
+    def test_user_list_etag_with_older_timestamp(self, client):
+        with app.app_context():
+            db.session.add(UserModel(name="Other", email="other@example.com", phone="555-0100"))  # type: ignore
+            db.session.commit()
+        etag = client.get("/users").headers["ETag"]
+
+        # A writer that took its timestamp before waiting for the write lock
+        # commits an updated_at older than one already visible.
+        with app.app_context():
+            db.session.execute(
+                db.update(UserModel)
+                .where(UserModel.id == 1)
+                .values(name="Updated Name", updated_at=datetime(2000, 1, 1))
+            )
+            db.session.commit()
+        response = client.get("/users", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json[0]["name"] == "Updated Name"
+
+    def test_user_list_invalid_limit(self, client):
+        response = client.get("/users?limit=0")
+        assert response.status_code == 400
+
+    def test_user_list_stream(self, client):
+        seed_scan_history(users=3)
+
+        response = client.get("/users?format=ndjson")
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        assert lines == json.loads(client.get("/users").data)
+
+        response = client.get("/users?format=ndjson&after=1&limit=2")
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        assert lines == client.get("/users?after=1&limit=2").json
+        assert [user["email"] for user in lines] == [
+            user["email"] for user in client.get("/users").json[1:3]
+        ]
+        with app.app_context():
+            users = repository.iter_users(limit=3, after=1, batch_size=2)
+            assert [user.id for user in users] == [2, 3, 4]
+
 
 class TestUserResource:
     def test_get_valid_user(self, client):
@@ -39,6 +204,39 @@ class TestUserResource:
         assert data["name"] == "Test User"
         assert data["email"] == "test@example.com"
 
+    def test_get_user_query_count_is_constant(self, client):
+        seed_scan_history(users=1, scans_per_user=1)
+        with count_queries() as small:
+            client.get("/users/2")
+
+        seed_scan_history(users=1, scans_per_user=30)
+        with count_queries() as large:
+            response = client.get("/users/3")
+
+        data = json.loads(response.data)
+        assert len(data["scans"]) == 30
+        assert len(large) == len(small) <= 3
+
+    def test_get_user_etag(self, client):
+        response = client.get("/users/1")
+        etag = response.headers["ETag"]
+
+        with count_queries() as statements:
+            response = client.get("/users/1", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+        assert len(statements) == 1
+
+        client.put(
+            "/scan/1",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        response = client.get("/users/1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert len(json.loads(response.data)["scans"]) == 1
+
     def test_get_invalid_user(self, client):
         response = client.get("/users/999")
         assert response.status_code == 404
@@ -115,6 +313,25 @@ class TestScanResource:
             assert ActivityModel.query.count() == 1
             assert ScanModel.query.count() == 1
 
+    def test_scan_single_commit(self, client):
+        commits = []
+        with app.app_context():
+            engine = db.engine
+        listener = lambda conn: commits.append(conn)
+        event.listen(engine, "commit", listener)
+        try:
+            response = client.put(
+                "/scan/1",
+                data=json.dumps(
+                    {"activity_name": "lunch", "activity_category": "meal"}
+                ),
+                content_type="application/json",
+            )
+        finally:
+            event.remove(engine, "commit", listener)
+        assert response.status_code == 200
+        assert len(commits) == 1
+
     def test_scan_invalid_user(self, client):
         response = client.put(
             "/scan/999",
@@ -141,6 +358,352 @@ class TestScanResource:
         assert response.status_code == 400
 
 
+class TestBadgeResources:
+    def test_get_user_by_badge(self, client):
+        response = client.get("/users/badge/TEST123")
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data["name"] == "Test User"
+
+    def test_get_user_by_invalid_badge(self, client):
+        response = client.get("/users/badge/NOPE")
+        assert response.status_code == 404
+
+    def test_scan_by_badge(self, client):
+        response = client.put(
+            "/scan/badge/TEST123",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data["user_id"] == 1
+        assert data["activity_name"] == "lunch"
+
+        with app.app_context():
+            assert ScanModel.query.count() == 1
+
+    def test_cached_scan_by_badge_skips_user_query(self, client):
+        body = json.dumps({"activity_name": "lunch", "activity_category": "meal"})
+        client.put("/scan/badge/TEST123", data=body, content_type="application/json")
+
+        with count_queries() as statements:
+            client.put(
+                "/scan/badge/TEST123", data=body, content_type="application/json"
+            )
+        assert not any(statement.startswith("SELECT user.") for statement in statements)
+
+    def test_scan_by_invalid_badge(self, client):
+        response = client.put(
+            "/scan/badge/NOPE",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 404
+
+    def test_badge_change_invalidates_cache(self, client):
+        client.get("/users/badge/TEST123")
+        client.put(
+            "/users/1",
+            data=json.dumps({"badge_code": "NEW456"}),
+            content_type="application/json",
+        )
+
+        assert client.get("/users/badge/TEST123").status_code == 404
+        response = client.put(
+            "/scan/badge/TEST123",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 404
+        assert client.get("/users/badge/NEW456").status_code == 200
+
+    def test_stale_badge_cache_entry_is_ignored(self, client):
+        badge_cache.set("TEST123", 999)
+        response = client.put(
+            "/scan/badge/TEST123",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        assert badge_cache.get("TEST123") == 1
+
+
+class TestActivityCache:
+    def test_scan_uses_activity_cache(self, client):
+        body = json.dumps({"activity_name": "lunch", "activity_category": "meal"})
+        client.put("/scan/1", data=body, content_type="application/json")
+        assert activity_cache.stats()["misses"] == 1
+
+        with count_queries() as statements:
+            response = client.put("/scan/1", data=body, content_type="application/json")
+        assert response.status_code == 200
+        assert json.loads(response.data)["activity_name"] == "lunch"
+        assert activity_cache.stats()["hits"] == 1
+        assert not any("FROM activity" in statement for statement in statements)
+
+        with app.app_context():
+            assert ActivityModel.query.count() == 1
+            assert ScanModel.query.count() == 2
+
+    def test_upsert_does_not_duplicate_uncached_activity(self, client):
+        with app.app_context():
+            activity_cache.warmed = True
+            db.session.add(ActivityModel(name="lunch", category="meal"))  # type: ignore
+            db.session.commit()
+
+            activities = repository.get_or_create_activities([("lunch", "meal")])
+            db.session.commit()
+            assert activities[("lunch", "meal")].id == 1
+            assert ActivityModel.query.count() == 1
+            assert activity_cache.get("lunch", "meal") == 1
+
+    def test_rolled_back_activity_is_not_cached(self, client):
+        with app.app_context():
+            repository.get_or_create_activities([("lunch", "meal")])
+            db.session.rollback()
+            assert activity_cache.get("lunch", "meal") is None
+            assert ActivityModel.query.count() == 0
+
+
+class TestScansCache:
+    def test_scans_cache_hit_and_invalidation(self, client):
+        body = json.dumps({"activity_name": "lunch", "activity_category": "meal"})
+        client.put("/scan/1", data=body, content_type="application/json")
+
+        response = client.get("/scans?activity_category=meal")
+        assert response.headers["X-Cache"] == "MISS"
+        with count_queries() as statements:
+            response = client.get("/scans?min_frequency=0&activity_category=meal")
+        assert response.headers["X-Cache"] == "HIT"
+        assert statements == []
+        assert json.loads(response.data)[0]["scan_count"] == 1
+
+        client.put("/scan/1", data=body, content_type="application/json")
+        response = client.get("/scans?activity_category=meal")
+        assert response.headers["X-Cache"] == "MISS"
+        assert json.loads(response.data)[0]["scan_count"] == 2
+        assert scans_cache.stats()["hit_ratio"] == 1 / 3
+
+    def test_failed_scan_does_not_invalidate(self, client):
+        client.get("/scans")
+        client.put(
+            "/scan/999",
+            data=json.dumps({"activity_name": "lunch", "activity_category": "meal"}),
+            content_type="application/json",
+        )
+        assert client.get("/scans").headers["X-Cache"] == "HIT"
+
+    def test_memory_backend_ttl_and_lru(self):
+        cache = QueryCache(None)
+        cache.configure("memory", ttl=60, maxsize=2)
+        for key in ["a", "b", "c"]:
+            cache.get_or_compute([key], lambda: key)
+        assert cache.get_or_compute(["a"], lambda: "new a") == ("new a", False)
+        assert cache.get_or_compute(["c"], lambda: "new c") == ("c", True)
+
+        cache.ttl = -1
+        cache.get_or_compute(["d"], lambda: "d")
+        assert cache.get_or_compute(["d"], lambda: "new d") == ("new d", False)
+
+    def test_sqlite_backend_is_shared(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'cache.db'}"
+        first, second = QueryCache(None), QueryCache(None)
+        first.configure(url, ttl=60, maxsize=2)
+        second.configure(url, ttl=60, maxsize=2)
+
+        first.get_or_compute(["a"], lambda: [{"scan_count": 1}])
+        assert second.get_or_compute(["a"], lambda: None) == ([{"scan_count": 1}], True)
+
+        second.invalidate()
+        assert first.get_or_compute(["a"], lambda: [{"scan_count": 2}]) == (
+            [{"scan_count": 2}],
+            False,
+        )
+
+        first.get_or_compute(["b"], lambda: "b")
+        first.get_or_compute(["c"], lambda: "c")
+        assert second.get_or_compute(["a"], lambda: "new a") == ("new a", False)
+
+    def test_sqlite_backend_hits_do_not_write(self, tmp_path):
+        cache = QueryCache(None)
+        cache.configure(f"sqlite:///{tmp_path / 'cache.db'}", ttl=60)
+        cache.get_or_compute(["a"], lambda: "a")
+        statements = []
+        cache.backend._connection().set_trace_callback(statements.append)
+        assert cache.get_or_compute(["a"], lambda: "new a") == ("a", True)
+        assert all(statement.startswith("SELECT") for statement in statements)
+
+        cache.ttl = -1
+        cache.get_or_compute(["b"], lambda: "b")
+        assert cache.get_or_compute(["b"], lambda: "new b") == ("new b", False)
+
+
+class TestScanTimeseriesResource:
+    @pytest.fixture
+    def scans(self, client):
+        with app.app_context():
+            lunch = ActivityModel(name="lunch", category="meal")  # type: ignore
+            workshop = ActivityModel(name="workshop1", category="workshop")  # type: ignore
+            db.session.add_all([lunch, workshop])
+            db.session.commit()
+            for activity, times in [
+                (lunch, ["12:01", "12:04", "12:07", "13:30"]),
+                (workshop, ["12:59:59.999999"]),
+            ]:
+                db.session.add_all(
+                    ScanModel(
+                        user_id=1,
+                        activity_id=activity.id,
+                        scanned_at=datetime.fromisoformat(f"2025-01-18T{time}"),
+                    )  # type: ignore
+                    for time in times
+                )
+            db.session.commit()
+
+    def test_timeseries_hourly(self, client, scans):
+        response = client.get("/scans/timeseries")
+        assert response.status_code == 200
+        assert json.loads(response.data) == [
+            {
+                "activity_name": "lunch",
+                "activity_category": "meal",
+                "bucket_start": "2025-01-18T12:00:00",
+                "scan_count": 3,
+            },
+            {
+                "activity_name": "lunch",
+                "activity_category": "meal",
+                "bucket_start": "2025-01-18T13:00:00",
+                "scan_count": 1,
+            },
+            {
+                "activity_name": "workshop1",
+                "activity_category": "workshop",
+                "bucket_start": "2025-01-18T12:00:00",
+                "scan_count": 1,
+            },
+        ]
+
+    def test_timeseries_filters(self, client, scans):
+        response = client.get(
+            "/scans/timeseries?bucket=5m&activity_category=meal"
+            "&start=2025-01-18T12:00:00&end=2025-01-18T13:00:00"
+        )
+        data = json.loads(response.data)
+        assert [(item["bucket_start"], item["scan_count"]) for item in data] == [
+            ("2025-01-18T12:00:00", 2),
+            ("2025-01-18T12:05:00", 1),
+        ]
+
+    def test_timeseries_utc_offsets(self, client, scans):
+        def utc(time):
+            return time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        start, end = utc(datetime(2025, 1, 18, 12)), utc(datetime(2025, 1, 18, 13))
+        response = client.get(
+            f"/scans/timeseries?bucket=5m&activity_category=meal&start={start}&end={end}"
+        )
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert [(item["bucket_start"], item["scan_count"]) for item in data] == [
+            ("2025-01-18T12:00:00", 2),
+            ("2025-01-18T12:05:00", 1),
+        ]
+
+    def test_timeseries_invalid_params(self, client):
+        assert client.get("/scans/timeseries?bucket=7m").status_code == 400
+        assert client.get("/scans/timeseries?start=yesterday").status_code == 400
+
+    def test_rebuild_scan_rollups(self, client, scans):
+        expected = json.loads(client.get("/scans/timeseries").data)
+        with app.app_context():
+            db.session.execute(db.delete(ScanRollupModel))
+            db.session.commit()
+            assert json.loads(client.get("/scans/timeseries").data) == []
+            repository.rebuild_scan_rollups()
+        assert json.loads(client.get("/scans/timeseries").data) == expected
+
+
+class TestScanBatchResource:
+    def test_batch_scan(self, client):
+        response = client.post(
+            "/scans/batch",
+            data=json.dumps(
+                [
+                    {
+                        "user_id": 1,
+                        "activity_name": "lunch",
+                        "activity_category": "meal",
+                    },
+                    {
+                        "user_id": 999,
+                        "activity_name": "lunch",
+                        "activity_category": "meal",
+                    },
+                    {"user_id": 1, "activity_name": "lunch"},
+                    {
+                        "user_id": 1,
+                        "activity_name": "dinner",
+                        "activity_category": "meal",
+                    },
+                ]
+            ),
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        data = json.loads(response.data)
+
+        assert [item["status"] for item in data] == [
+            "created",
+            "error",
+            "error",
+            "created",
+        ]
+        assert data[0]["scan"]["user_id"] == 1
+        assert data[0]["scan"]["activity_name"] == "lunch"
+        assert data[1]["message"] == "User not found"
+        assert data[3]["scan"]["activity_name"] == "dinner"
+
+        with app.app_context():
+            assert ActivityModel.query.count() == 2
+            assert ScanModel.query.count() == 2
+
+    def test_batch_scan_single_commit(self, client):
+        commits = []
+        with app.app_context():
+            engine = db.engine
+        listener = lambda conn: commits.append(conn)
+        event.listen(engine, "commit", listener)
+        try:
+            response = client.post(
+                "/scans/batch",
+                data=json.dumps(
+                    [
+                        {
+                            "user_id": 1,
+                            "activity_name": f"workshop{i}",
+                            "activity_category": "workshop",
+                        }
+                        for i in range(10)
+                    ]
+                ),
+                content_type="application/json",
+            )
+        finally:
+            event.remove(engine, "commit", listener)
+        assert response.status_code == 200
+        assert len(commits) == 1
+
+    def test_batch_scan_invalid_body(self, client):
+        response = client.post(
+            "/scans/batch",
+            data=json.dumps({"user_id": 1}),
+            content_type="application/json",
+        )
+        assert response.status_code == 400
+
+
 class TestScansResource:
     def test_scans_without_filters(self, client):
         with app.app_context():
@@ -248,3 +811,1589 @@ class TestScansResource:
         assert data[0]["activity_name"] == "workshop2"
         assert data[0]["activity_category"] == "workshop"
         assert data[0]["scan_count"] == 2
+
+    def test_scans_reads_counter_table(self, client):
+        for name in ["lunch", "lunch", "dinner"]:
+            client.put(
+                "/scan/1",
+                data=json.dumps({"activity_name": name, "activity_category": "meal"}),
+                content_type="application/json",
+            )
+
+        with count_queries() as statements:
+            response = client.get("/scans")
+        data = json.loads(response.data)
+        assert {item["activity_name"]: item["scan_count"] for item in data} == {
+            "lunch": 2,
+            "dinner": 1,
+        }
+        assert not any("FROM scan" in statement for statement in statements)
+
+    def test_rebuild_scan_counters(self, client):
+        with app.app_context():
+            activity = ActivityModel(name="workshop1", category="workshop")  # type: ignore
+            db.session.add(activity)
+            db.session.commit()
+            db.session.add_all([ScanModel(user_id=1, activity_id=activity.id) for _ in range(3)])  # type: ignore
+            db.session.commit()
+
+            db.session.execute(db.update(ActivityScanCountModel).values(scan_count=99))
+            db.session.commit()
+            repository.rebuild_activity_scan_counts()
+
+        data = json.loads(client.get("/scans").data)
+        assert data[0]["scan_count"] == 3
+
+    def test_deleted_scans_decrement_counters(self, client):
+        with app.app_context():
+            activity = ActivityModel(name="workshop1", category="workshop")  # type: ignore
+            db.session.add(activity)
+            db.session.commit()
+            db.session.add_all([ScanModel(user_id=1, activity_id=activity.id) for _ in range(3)])  # type: ignore
+            db.session.commit()
+            db.session.delete(ScanModel.query.first())
+            db.session.commit()
+
+        data = json.loads(client.get("/scans").data)
+        assert data[0]["scan_count"] == 2
+
+
+LOADER_RECORDS = [
+    {
+        "name": f"Loaded User {i}",
+        "email": f"loaded{i}@example.com",
+        "phone": f"555-111-{i:04}",
+        "badge_code": f"badge-{i}" if i % 2 else "",
+        "scans": [
+            {
+                "activity_name": "opening_ceremony",
+                "activity_category": "activity",
+                "scanned_at": "2025-01-17T04:07:35.311375",
+            },
+            {
+                "activity_name": f"workshop{i % 3}",
+                "activity_category": "workshop",
+                "scanned_at": "2025-01-19T03:00:27.836055",
+            },
+        ],
+    }
+    for i in range(10)
+]
+
+
+class TestLoader:
+    def test_iter_records_json_array(self):
+        f = io.StringIO(json.dumps(LOADER_RECORDS, indent=4))
+        assert list(helpers.iter_records(f, chunk_size=64)) == LOADER_RECORDS
+
+    def test_iter_records_ndjson(self):
+        f = io.StringIO("\n".join(json.dumps(record) for record in LOADER_RECORDS))
+        assert list(helpers.iter_records(f, chunk_size=64)) == LOADER_RECORDS
+
+    def test_iter_records_truncated(self):
+        f = io.StringIO(json.dumps(LOADER_RECORDS)[:-20])
+        with pytest.raises(json.JSONDecodeError):
+            list(helpers.iter_records(f, chunk_size=64))
+
+    def test_populate_db(self, client, tmp_path):
+        path = tmp_path / "data.json"
+        path.write_text(json.dumps(LOADER_RECORDS))
+        helpers.populate_db(str(path), batch_size=4)
+
+        with app.app_context():
+            assert UserModel.query.count() == 11
+            assert ActivityModel.query.count() == 4
+            assert ScanModel.query.count() == 20
+            assert UserModel.query.filter_by(badge_code=None).count() == 5
+
+        data = json.loads(client.get("/scans?activity_category=activity").data)
+        assert data[0]["scan_count"] == 10
+
+    def test_populate_db_resume(self, client, tmp_path):
+        path = tmp_path / "data.ndjson"
+        path.write_text("\n".join(json.dumps(record) for record in LOADER_RECORDS))
+        helpers.populate_db(str(path), batch_size=4, start_at=6)
+
+        with app.app_context():
+            assert UserModel.query.count() == 5
+            assert ScanModel.query.count() == 8
+            assert UserModel.query.filter_by(email="loaded5@example.com").count() == 0
+
+
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE user (
+        id INTEGER NOT NULL, name VARCHAR(80) NOT NULL, email VARCHAR(120) NOT NULL,
+        phone VARCHAR(20) NOT NULL, badge_code VARCHAR(50), updated_at DATETIME NOT NULL,
+        PRIMARY KEY (id), UNIQUE (email), UNIQUE (phone), UNIQUE (badge_code)
+    )
+    """,
+    """
+    CREATE TABLE activity (
+        id INTEGER NOT NULL, name VARCHAR(80) NOT NULL, category VARCHAR(80) NOT NULL,
+        PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE scan (
+        id INTEGER NOT NULL, user_id INTEGER NOT NULL, activity_id INTEGER NOT NULL,
+        scanned_at DATETIME NOT NULL, PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id),
+        FOREIGN KEY(activity_id) REFERENCES activity (id)
+    )
+    """,
+    "INSERT INTO user VALUES (1, 'A', 'a@example.com', '1', 'badge', '2025-01-17 00:00:00')",
+    "INSERT INTO activity VALUES (1, 'lunch', 'meal'), (2, 'lunch', 'meal'), (3, 'dinner', 'meal')",
+    """
+    INSERT INTO scan (user_id, activity_id, scanned_at) VALUES
+        (1, 1, '2025-01-17 12:00:00'), (1, 2, '2025-01-18 12:00:00'),
+        (1, 3, '2025-01-18 18:00:00')
+    """,
+]
+
+
+def query_plans(statements):
+    with app.app_context(), db.engine.connect() as connection:
+        return [
+            detail
+            for statement, parameters in statements
+            if statement.startswith("SELECT")
+            for *_, detail in connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            )
+        ]
+
+
+class TestMigrations:
+    def test_upgrade_baseline_database(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+        with engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.exec_driver_sql(statement)
+
+        assert migrations.upgrade(engine) == [
+            migration.__name__ for migration in migrations.MIGRATIONS
+        ]
+        assert migrations.upgrade(engine) == []
+
+        with engine.connect() as connection:
+            assert migrations.current_version(connection) == len(migrations.MIGRATIONS)
+            assert connection.exec_driver_sql(
+                "SELECT id, name FROM activity ORDER BY id"
+            ).all() == [(1, "lunch"), (3, "dinner")]
+            assert connection.exec_driver_sql(
+                "SELECT activity_id, scan_count FROM activity_scan_count ORDER BY activity_id"
+            ).all() == [(1, 2), (3, 1)]
+            assert connection.exec_driver_sql(
+                "SELECT bucket_start, scan_count FROM scan_rollup WHERE activity_id = 1"
+            ).all() == [(1737115200, 1), (1737201600, 1)]
+            indexes = {
+                name
+                for (name,) in connection.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                )
+            }
+            assert {
+                "ix_activity_name_category",
+                "ix_scan_user_scanned_at",
+                "ix_scan_activity_user",
+                "ix_scan_scanned_at",
+                "ix_scan_user_client_scan_id",
+            } <= indexes
+            assert (
+                not {
+                    "ix_scan_user_id",
+                    "ix_scan_activity_id",
+                    "ix_scan_client_scan_id",
+                }
+                & indexes
+            )
+            assert connection.exec_driver_sql(
+                "SELECT rowid FROM user_search WHERE user_search MATCH 'email:example'"
+            ).all() == [(1,)]
+
+            connection.exec_driver_sql(
+                "INSERT INTO scan (user_id, activity_id, scanned_at) "
+                "VALUES (1, 3, '2025-01-19 18:00:00')"
+            )
+            assert connection.exec_driver_sql(
+                "SELECT scan_count, version FROM activity_scan_count WHERE activity_id = 3"
+            ).one() == (2, 2)
+
+    def test_scans_recorded_between_migrations(self, tmp_path, monkeypatch):
+        engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+        with engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.exec_driver_sql(statement)
+
+        all_migrations = migrations.MIGRATIONS
+        for number in range(1, len(all_migrations) + 1):
+            # Stop after each migration, like an upgrade interrupted there.
+            monkeypatch.setattr(migrations, "MIGRATIONS", all_migrations[:number])
+            migrations.upgrade(engine)
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "INSERT INTO scan (user_id, activity_id, scanned_at) "
+                    "VALUES (1, 3, '2025-01-19 18:00:00')"
+                )
+
+        created = create_engine(f"sqlite:///{tmp_path / 'created.db'}")
+        with app.app_context():
+            migrations.upgrade(created)
+
+        def triggers(engine):
+            with engine.connect() as connection:
+                return {
+                    name: " ".join(sql.split())
+                    for name, sql in connection.exec_driver_sql(
+                        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"
+                    )
+                }
+
+        # Migrations end with the same triggers as a database created from the models.
+        assert triggers(engine) == triggers(created)
+
+    def test_upgrade_empty_database(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+        with app.app_context():
+            assert migrations.upgrade(engine) == []
+        with engine.connect() as connection:
+            assert migrations.current_version(connection) == len(migrations.MIGRATIONS)
+
+    def test_hot_queries_use_indexes(self, client):
+        seed_scan_history(users=3)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        with app.app_context():
+            repository.warm_activity_cache()
+            engines = list(db.engines.values())
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            client.get("/users/2")
+            client.get("/users/badge/TEST123")
+            client.put(
+                "/scan/1",
+                data=json.dumps(
+                    {"activity_name": "lunch", "activity_category": "meal"}
+                ),
+                content_type="application/json",
+            )
+        finally:
+            for engine in engines:
+                event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+        plans = query_plans(statements)
+        assert any("ix_scan_user_scanned_at" in detail for detail in plans)
+        assert any("ix_activity_name_category" in detail for detail in plans)
+        assert not [
+            detail
+            for detail in plans
+            if detail.startswith(("SCAN scan", "SCAN activity", "SCAN user"))
+        ]
+
+
+def restful_json(data, spec):
+    with app.test_request_context():
+        return output_json(marshal(data, spec), 200).get_data()
+
+
+class TestSerializerParity:
+    @pytest.fixture
+    def history(self, client):
+        with app.app_context():
+            user = db.session.get(UserModel, 1)
+            user.name = 'Zoë "Z" O\'Brien'
+            user.badge_code = None
+            db.session.commit()
+        seed_scan_history(users=3)
+        body = json.dumps({"activity_name": "déjeuner", "activity_category": "meal"})
+        client.put("/scan/1", data=body, content_type="application/json")
+
+    def test_users_parity(self, client, history):
+        response = client.get("/users")
+        assert response.content_type == "application/json"
+        with app.app_context():
+            assert response.data == restful_json(
+                repository.get_users(), UserModel.fields
+            )
+
+    def test_user_parity(self, client, history):
+        response = client.get("/users/1")
+        with app.app_context():
+            assert response.data == restful_json(
+                repository.get_user(1), UserModel.fields
+            )
+
+        response = client.put(
+            "/users/2",
+            data=json.dumps({"phone": "☎"}),
+            content_type="application/json",
+        )
+        with app.app_context():
+            assert response.data == restful_json(
+                repository.get_user(2), UserModel.fields
+            )
+
+    def test_scan_parity(self, client, history):
+        response = client.put(
+            "/scan/2",
+            data=json.dumps(
+                {"activity_name": "activity1", "activity_category": "workshop"}
+            ),
+            content_type="application/json",
+        )
+        with app.app_context():
+            scan = ScanModel.query.order_by(ScanModel.id.desc()).first()
+            assert response.data == restful_json(scan, ScanModel.fields)
+
+    def test_scans_parity(self, client, history):
+        response = client.get("/scans")
+        with app.app_context():
+            expected = [
+                {
+                    "activity_name": name,
+                    "activity_category": category,
+                    "scan_count": count,
+                }
+                for name, category, count in repository.get_activity_scan_counts()
+            ]
+            assert response.data == restful_json(expected, ActivityModel.fields)
+
+    def test_unspecialized_fields_fall_back(self):
+        spec = {
+            "id": fields.Raw,
+            "ratio": fields.Float,
+            "when": fields.DateTime(dt_format="rfc822"),
+            "nested": {"name": fields.String(attribute="label")},
+            "items": fields.List(
+                fields.Nested({"value": fields.Integer}, allow_null=True)
+            ),
+        }
+        data = {
+            "id": [1, "two"],
+            "ratio": 0.5,
+            "when": datetime(2025, 1, 18, 12, 0),
+            "label": "x",
+            "items": [{"value": "3"}, None],
+        }
+        with app.test_request_context():
+            assert serializers.encode(data, spec) == json.dumps(marshal(data, spec))
+            assert serializers.encode([data], spec) == json.dumps(marshal([data], spec))
+
+    def test_debug_mode_uses_marshal(self, client):
+        app.debug = True
+        try:
+            response = client.get("/users/1")
+        finally:
+            app.debug = False
+        assert response.data.startswith(b"{\n    ")
+
+
+class TestBench:
+    def test_generate_dataset_is_reproducible(self, tmp_path):
+        first, second = tmp_path / "first.ndjson", tmp_path / "second.ndjson"
+        scans = bench.generate_dataset(str(first), 20, 10, 100, seed=1)
+        bench.generate_dataset(str(second), 20, 10, 100, seed=1)
+        assert first.read_text() == second.read_text()
+
+        with open(first) as f:
+            records = list(helpers.iter_records(f))
+        assert len(records) == 20
+        assert sum(len(record["scans"]) for record in records) == scans
+        assert all(10 <= len(record["scans"]) <= 100 for record in records)
+
+    def test_summarize(self):
+        summary = bench.summarize([i / 1000 for i in range(1, 101)], 2.0, 300)
+        assert summary["p50_ms"] == 51
+        assert summary["p99_ms"] == 100
+        assert summary["requests_per_second"] == 50
+        assert summary["queries_per_request"] == 3
+
+
+class TestMetrics:
+    def test_request_metrics(self, client):
+        client.get("/users/1")
+        client.get("/users/1")
+        client.get("/users/999")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.content_type.startswith("text/plain")
+        text = response.data.decode()
+        labels = 'method="GET",endpoint="/users/<int:user_id>"'
+        assert f"http_request_duration_seconds_count{{{labels}}} 3" in text
+        assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3' in text
+        assert f"http_request_sql_queries_count{{{labels}}} 3" in text
+        assert f"http_request_sql_queries_sum{{{labels}}} 7.0" in text
+        assert f"http_request_sql_seconds_total{{{labels}}}" in text
+        assert "scans_cache_hit_ratio 0.0" in text
+        assert 'endpoint="/metrics"' not in text
+
+    def test_sampling(self, client):
+        app.config["METRICS_SAMPLE_RATE"] = 0.0
+        try:
+            client.get("/users/1")
+        finally:
+            app.config["METRICS_SAMPLE_RATE"] = 1.0
+        assert (
+            "http_request_duration_seconds_count"
+            not in client.get("/metrics").data.decode()
+        )
+
+    def test_slow_request_log(self, client, caplog):
+        app.config["SLOW_REQUEST_SECONDS"] = 0.0
+        try:
+            client.get("/users/1")
+        finally:
+            app.config["SLOW_REQUEST_SECONDS"] = 1.0
+        assert "Slow request GET /users/1?" in caplog.text
+        assert "FROM user" in caplog.text
+
+    def test_failed_statement_is_not_left_timing(self, client):
+        with app.test_request_context(), db.engine.connect() as conn:
+            metrics.g.request_stats = metrics.RequestStats()
+            with pytest.raises(Exception):
+                conn.exec_driver_sql("SELECT * FROM missing_table")
+            assert not conn.info.get("query_started")
+            conn.exec_driver_sql("SELECT 1")
+            assert metrics.g.request_stats.queries == 1
+
+    def test_slow_log_keeps_slowest_statements(self):
+        stats = metrics.RequestStats()
+        for i in range(metrics.MAX_LOGGED_STATEMENTS + 5):
+            stats.add(i / 1000, f"SELECT {i}")
+        slowest = stats.slowest()
+        assert len(slowest) == metrics.MAX_LOGGED_STATEMENTS
+        assert slowest[0] == (0.024, "SELECT 24")
+        assert slowest[-1] == (0.005, "SELECT 5")
+        assert stats.queries == 25
+
+
+class TestWriteBehind:
+    @pytest.fixture
+    def queue(self, client):
+        scan_queue.configure(app, True, 3, 500)
+        try:
+            yield scan_queue
+        finally:
+            scan_queue.stop()
+            scan_queue.configure(app, False, 10000, 500)
+
+    def scan(self, client, user_id=1, name="Lunch"):
+        return client.put(
+            f"/scan/{user_id}",
+            json={"activity_name": name, "activity_category": "meal"},
+        )
+
+    def test_enqueue_and_write(self, client, queue):
+        response = self.scan(client)
+        assert response.status_code == 202
+        assert response.json["activity_name"] == "Lunch"
+        assert response.json["scanned_at"]
+        with app.app_context():
+            assert ScanModel.query.count() == 0
+
+        queue.start()
+        assert queue.flush(timeout=5)
+        with app.app_context():
+            scan = ScanModel.query.one()
+            assert scan.activity_name == "Lunch"
+            assert scan.scanned_at.isoformat() == response.json["scanned_at"]
+
+    def test_unknown_user(self, client, queue):
+        assert self.scan(client, user_id=999).status_code == 404
+        assert queue.depth() == 0
+
+    def test_invalid_activity(self, client, queue):
+        for body in [
+            {"activity_name": None, "activity_category": "meal"},
+            {"activity_name": "Lunch", "activity_category": ["meal"]},
+            {"activity_name": "", "activity_category": "meal"},
+        ]:
+            assert client.put("/scan/1", json=body).status_code == 400
+            assert client.put("/scan/badge/TEST123", json=body).status_code == 400
+        assert queue.depth() == 0
+
+    def test_badge_scan_is_queued(self, client, queue):
+        body = {"activity_name": "Lunch", "activity_category": "meal"}
+        response = client.put("/scan/badge/TEST123", json=body)
+        assert response.status_code == 202
+        assert response.json["user_id"] == 1
+        assert client.put("/scan/badge/NOPE", json=body).status_code == 404
+        assert queue.depth() == 1
+
+        queue.start()
+        assert queue.flush(timeout=5)
+        with app.app_context():
+            assert ScanModel.query.one().user_id == 1
+
+    def test_badge_scan_after_reassignment(self, client, queue):
+        body = {"activity_name": "Lunch", "activity_category": "meal"}
+        client.put("/scan/badge/TEST123", json=body)
+        with app.app_context():
+            db.session.add(UserModel(name="Other", email="other@example.com", phone="555-0100"))  # type: ignore
+            db.session.execute(db.update(UserModel).values(badge_code=None))
+            db.session.execute(
+                db.update(UserModel)
+                .where(UserModel.name == "Other")
+                .values(badge_code="TEST123")
+            )
+            db.session.commit()
+        # The cached holder no longer has the badge, so the scan goes to the new one.
+        assert client.put("/scan/badge/TEST123", json=body).json["user_id"] == 2
+        queue.start()
+        assert queue.flush(timeout=5)
+
+    def test_backpressure(self, client, queue):
+        for _ in range(3):
+            assert self.scan(client).status_code == 202
+        response = self.scan(client)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+
+        queue.start()
+        assert queue.flush(timeout=5)
+        assert self.scan(client).status_code == 202
+
+    def test_group_commit(self, client, queue):
+        written = queue.written
+        for name in ["Breakfast", "Lunch", "Dinner"]:
+            self.scan(client, name=name)
+        with count_queries() as statements:
+            queue.start()
+            assert queue.flush(timeout=5)
+        # One batch: users are checked and touched once for all three scans.
+        assert sum(statement.startswith("UPDATE user") for statement in statements) == 1
+        assert queue.written == written + 3
+
+    def test_read_your_writes(self, client, queue):
+        etag = client.get("/users/1").headers["ETag"]
+        self.scan(client)
+        queue.start()
+
+        response = client.get(
+            "/users/1?consistent=true", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert [scan["activity_name"] for scan in response.json["scans"]] == ["Lunch"]
+
+    def test_consistent_read_times_out(self, client, queue, monkeypatch):
+        monkeypatch.setitem(app.config, "SCAN_CONSISTENT_TIMEOUT", 0.05)
+        self.scan(client)
+        # The writer was never started, so the scan can't become visible.
+        for url in ["/users/1?consistent=true", "/users/1/scans?consistent=true"]:
+            response = client.get(url)
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+
+        queue.start()
+        assert queue.flush(timeout=5)
+        assert client.get("/users/1?consistent=true").status_code == 200
+
+    def test_stop_drains_queue(self, client, queue):
+        self.scan(client)
+        self.scan(client, name="Dinner")
+        queue.start()
+        queue.stop()
+        assert queue.depth() == 0
+        with app.app_context():
+            assert ScanModel.query.count() == 2
+
+    def test_failed_scan_does_not_lose_batch(self, client):
+        queue = ScanQueue()
+        queue.configure(app, True, 10, 10)
+        queue.submit(repository.ScanEntry(1, "Lunch", "meal", datetime.now()))
+        queue.submit(repository.ScanEntry(1, None, "meal", datetime.now()))  # type: ignore
+        queue.submit(repository.ScanEntry(1, "Dinner", "meal", datetime.now()))
+        queue.start()
+        queue.stop()
+        assert (queue.written, queue.failed) == (2, 1)
+        with app.app_context():
+            assert ScanModel.query.count() == 2
+
+    def test_busy_database_is_retried(self, client, monkeypatch):
+        record_scans = repository.record_scans
+        attempts = []
+
+        def locked_record_scans(entries):
+            attempts.append(len(entries))
+            if len(attempts) <= 2:
+                raise OperationalError(
+                    "INSERT INTO scan",
+                    {},
+                    sqlite3.OperationalError("database is locked"),
+                )
+            return record_scans(entries)
+
+        monkeypatch.setattr(repository, "record_scans", locked_record_scans)
+        queue = ScanQueue()
+        queue.configure(app, True, 10, 10)
+        queue.retry_delay = 0.01
+        for name in ["Breakfast", "Lunch", "Dinner"]:
+            queue.submit(repository.ScanEntry(1, name, "meal", datetime.now()))
+        queue.start()
+        assert queue.flush(timeout=5)
+        queue.stop()
+        # The whole batch is retried rather than split up and dropped.
+        assert attempts == [3, 3, 3]
+        assert (queue.written, queue.failed) == (3, 0)
+        with app.app_context():
+            assert ScanModel.query.count() == 3
+
+    def test_other_database_errors_fail_the_batch(self, client, monkeypatch):
+        record_scans = repository.record_scans
+        attempts = []
+
+        def broken_record_scans(entries):
+            attempts.append(len(entries))
+            if len(attempts) == 1:
+                raise OperationalError(
+                    "INSERT INTO scan",
+                    {},
+                    sqlite3.OperationalError("disk I/O error"),
+                )
+            return record_scans(entries)
+
+        monkeypatch.setattr(repository, "record_scans", broken_record_scans)
+        queue = ScanQueue()
+        queue.configure(app, True, 10, 10)
+        queue.retry_delay = 0.01
+        for name in ["Breakfast", "Lunch"]:
+            queue.submit(repository.ScanEntry(1, name, "meal", datetime.now()))
+        queue.start()
+        assert queue.flush(timeout=5)
+        queue.submit(repository.ScanEntry(1, "Dinner", "meal", datetime.now()))
+        assert queue.flush(timeout=5)
+        queue.stop()
+        # The failed batch isn't retried, and later scans are still written.
+        assert attempts == [2, 1]
+        assert (queue.written, queue.failed) == (1, 2)
+        with app.app_context():
+            assert ScanModel.query.one().activity_name == "Dinner"
+
+
+class TestExports:
+    @pytest.fixture
+    def scans(self, client):
+        with app.app_context():
+            lunch = ActivityModel(name="Lunch", category="meal")  # type: ignore
+            talk = ActivityModel(name="Keynote", category="talk")  # type: ignore
+            other = UserModel(name="Other User", email="other@example.com", phone="555-0100")  # type: ignore
+            db.session.add_all([lunch, talk, other])
+            db.session.flush()
+            for user_id, activity, time in [
+                (1, lunch, "2025-01-18T12:00:00"),
+                (2, lunch, "2025-01-18T12:30:00"),
+                (1, talk, "2025-01-18T15:00:00"),
+            ]:
+                db.session.add(ScanModel(user_id=user_id, activity=activity, scanned_at=datetime.fromisoformat(time)))  # type: ignore
+            db.session.commit()
+
+    def test_scans_csv(self, client, scans):
+        response = client.get("/export/scans")
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.mimetype == "text/csv"
+        assert 'filename="scans.csv"' in response.headers["Content-Disposition"]
+        rows = list(csv.reader(io.StringIO(response.data.decode())))
+        assert rows[0] == repository.SCAN_EXPORT_COLUMNS
+        assert rows[1] == [
+            "1",
+            "1",
+            "Test User",
+            "test@example.com",
+            "Lunch",
+            "meal",
+            "2025-01-18T12:00:00",
+        ]
+        assert len(rows) == 4
+
+    def test_scans_filters(self, client, scans):
+        response = client.get(
+            "/export/scans?format=ndjson&activity_category=meal&start=2025-01-18T12:15:00"
+        )
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [(line["user_name"], line["activity_name"]) for line in lines] == [
+            ("Other User", "Lunch")
+        ]
+
+        response = client.get(
+            "/export/scans?format=ndjson&activity_name=Keynote&end=2025-01-18T15:00:00"
+        )
+        assert response.data == b""
+
+    def test_utc_offsets(self, client, scans):
+        start = datetime(2025, 1, 18, 12, 15).astimezone(timezone(timedelta(hours=5)))
+        response = client.get(
+            "/export/scans",
+            query_string={"format": "ndjson", "start": start.isoformat()},
+        )
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [line["scanned_at"] for line in lines] == [
+            "2025-01-18T12:30:00",
+            "2025-01-18T15:00:00",
+        ]
+
+    def test_users(self, client, scans):
+        response = client.get("/export/users?format=ndjson")
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [line["name"] for line in lines] == ["Test User", "Other User"]
+        assert lines[0]["badge_code"] == "TEST123"
+
+        response = client.get("/export/users?activity_name=Keynote")
+        rows = list(csv.reader(io.StringIO(response.data.decode())))
+        assert rows[0] == repository.USER_EXPORT_COLUMNS
+        assert [row[1] for row in rows[1:]] == ["Test User"]
+
+    def test_gzip(self, client, scans):
+        plain = client.get("/export/scans").data
+        response = client.get("/export/scans", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.data) == plain
+
+    def test_invalid_params(self, client):
+        assert client.get("/export/scans?format=xml").status_code == 400
+        assert client.get("/export/users?start=yesterday").status_code == 400
+
+    def test_streams_from_cursor(self, client):
+        seed_scan_history(users=5, scans_per_user=4)
+        with app.app_context():
+            rows = repository.iter_scan_rows(batch_size=3)
+            first = next(rows)
+            assert first[0] == 1
+            assert len(list(rows)) == 19
+        chunks = list(exports.iter_csv(["n"], [(n,) for n in range(5)], chunk_rows=2))
+        assert chunks == ["n\r\n0\r\n1\r\n", "2\r\n3\r\n", "4\r\n"]
+
+
+class TestUserSearch:
+    @pytest.fixture
+    def users(self, client):
+        with app.app_context():
+            db.session.add_all(
+                [
+                    UserModel(name="James Graves", email="jgraves@example.com", phone="555-0101"),  # type: ignore
+                    UserModel(name="James Graves", email="james.g@example.org", phone="555-0102"),  # type: ignore
+                    UserModel(name="Gravesend Smith", email="smith@example.com", phone="555-0103"),  # type: ignore
+                    UserModel(name="Amy Lee", email="amy.graves@example.com", phone="555-0104"),  # type: ignore
+                ]
+            )
+            db.session.commit()
+
+    def search(self, client, query):
+        response = client.get("/users/search", query_string={"q": query})
+        assert response.status_code == 200
+        return [(user["id"], user["name"]) for user in response.json]
+
+    def test_ranked_prefix_search(self, client, users):
+        results = self.search(client, "grav")
+        assert {name for _, name in results} == {
+            "James Graves",
+            "Gravesend Smith",
+            "Amy Lee",
+        }
+        # Name matches rank above the email-only match.
+        assert results[-1] == (5, "Amy Lee")
+        assert sorted(self.search(client, "james gra")) == [
+            (2, "James Graves"),
+            (3, "James Graves"),
+        ]
+
+    def test_email_and_phone(self, client, users):
+        assert self.search(client, "jgraves@") == [(2, "James Graves")]
+        assert self.search(client, "example.org") == [(3, "James Graves")]
+        assert self.search(client, "555-0104") == [(5, "Amy Lee")]
+        assert self.search(client, 'amy" OR "x') == []
+        assert self.search(client, "*") == []
+
+    def test_index_follows_updates(self, client, users):
+        client.put("/users/5", json={"name": "Amy Chen"})
+        assert self.search(client, "chen") == [(5, "Amy Chen")]
+        assert self.search(client, "lee") == []
+        with app.app_context():
+            db.session.delete(db.session.get(UserModel, 5))
+            db.session.commit()
+        assert self.search(client, "chen") == []
+
+    def test_pagination(self, client, users):
+        ranked = [user_id for user_id, _ in self.search(client, "graves")]
+        response = client.get("/users/search?q=graves&limit=3")
+        assert [user["id"] for user in response.json] == ranked[:3]
+        assert (
+            response.headers["Link"]
+            == '</users/search?q=graves&limit=3&offset=3>; rel="next"'
+        )
+        response = client.get("/users/search?q=graves&limit=3&offset=3")
+        assert [user["id"] for user in response.json] == ranked[3:] == [5]
+        assert "Link" not in response.headers
+
+    def test_invalid_params(self, client):
+        assert client.get("/users/search").status_code == 400
+        assert client.get("/users/search?q=a&limit=0").status_code == 400
+        assert client.get("/users/search?q=a&limit=500").status_code == 400
+
+    def test_uses_index(self, client, users):
+        with count_queries() as statements:
+            self.search(client, "graves")
+        with app.app_context():
+            plan = (
+                db.session.connection()
+                .exec_driver_sql("EXPLAIN QUERY PLAN " + statements[-1], ("x", 1, 0))
+                .all()
+            )
+        assert any("VIRTUAL TABLE INDEX" in row[-1] for row in plan)
+
+
+class TestIdempotentScans:
+    def scan(self, client, client_scan_id, scanned_at="2025-01-18T12:00:00", user_id=1):
+        return client.put(
+            f"/scan/{user_id}",
+            json={
+                "activity_name": "Lunch",
+                "activity_category": "meal",
+                "scanned_at": scanned_at,
+                "client_scan_id": client_scan_id,
+            },
+        )
+
+    def test_replay_is_recorded_once(self, client):
+        first = self.scan(client, "scanner-1:1")
+        assert first.status_code == 200
+        assert first.json["scanned_at"] == "2025-01-18T12:00:00"
+        assert "Idempotent-Replayed" not in first.headers
+
+        replay = self.scan(client, "scanner-1:1", scanned_at="2025-01-18T12:05:00")
+        assert replay.status_code == 200
+        assert replay.headers["Idempotent-Replayed"] == "true"
+        assert replay.json == first.json
+
+        assert client.get("/scans").json == [
+            {"activity_name": "Lunch", "activity_category": "meal", "scan_count": 1}
+        ]
+        with app.app_context():
+            assert ScanModel.query.count() == 1
+
+    def test_keys_are_scoped_to_the_user(self, client):
+        with app.app_context():
+            db.session.add(UserModel(name="Other", email="other@example.com", phone="555-0100"))  # type: ignore
+            db.session.commit()
+        self.scan(client, "scanner-1:1")
+        other = self.scan(client, "scanner-1:1", user_id=2)
+        assert "Idempotent-Replayed" not in other.headers
+        assert other.json["user_id"] == 2
+
+        response = client.post(
+            "/scans/batch",
+            json=[
+                {
+                    "user_id": user_id,
+                    "activity_name": "Lunch",
+                    "activity_category": "meal",
+                    "client_scan_id": "scanner-1:1",
+                }
+                for user_id in [2, 1]
+            ],
+        )
+        assert [
+            (item["status"], item["scan"]["user_id"]) for item in response.json
+        ] == [
+            ("duplicate", 2),
+            ("duplicate", 1),
+        ]
+        with app.app_context():
+            assert ScanModel.query.count() == 2
+
+    def test_scans_without_key_are_not_deduplicated(self, client):
+        for _ in range(2):
+            client.put(
+                "/scan/1", json={"activity_name": "Lunch", "activity_category": "meal"}
+            )
+        with app.app_context():
+            assert ScanModel.query.count() == 2
+
+    def test_badge_replay(self, client):
+        body = {
+            "activity_name": "Lunch",
+            "activity_category": "meal",
+            "client_scan_id": "b-1",
+        }
+        assert (
+            "Idempotent-Replayed"
+            not in client.put("/scan/badge/TEST123", json=body).headers
+        )
+        assert (
+            client.put("/scan/badge/TEST123", json=body).headers["Idempotent-Replayed"]
+            == "true"
+        )
+
+    def test_replay_keeps_etag(self, client):
+        self.scan(client, "scanner-1:1")
+        etag = client.get("/users/1").headers["ETag"]
+        self.scan(client, "scanner-1:1")
+        client.post(
+            "/scans/batch",
+            json=[
+                {
+                    "user_id": 1,
+                    "activity_name": "Lunch",
+                    "activity_category": "meal",
+                    "client_scan_id": "scanner-1:1",
+                }
+            ],
+        )
+        client.put(
+            "/scan/badge/TEST123",
+            json={
+                "activity_name": "Lunch",
+                "activity_category": "meal",
+                "client_scan_id": "scanner-1:1",
+            },
+        )
+        assert (
+            client.get("/users/1", headers={"If-None-Match": etag}).status_code == 304
+        )
+
+        self.scan(client, "scanner-1:2")
+        assert (
+            client.get("/users/1", headers={"If-None-Match": etag}).status_code == 200
+        )
+
+    def test_badge_scan_with_new_key_touches_user(self, client):
+        etag = client.get("/users/1").headers["ETag"]
+        body = {
+            "activity_name": "Lunch",
+            "activity_category": "meal",
+            "client_scan_id": "b-2",
+        }
+        assert client.put("/scan/badge/TEST123", json=body).status_code == 200
+        assert (
+            client.get("/users/1", headers={"If-None-Match": etag}).status_code == 200
+        )
+
+    def test_utc_offset(self, client):
+        response = self.scan(client, "tz", scanned_at="2025-01-18T12:00:00+00:00")
+        expected = (
+            datetime.fromisoformat("2025-01-18T12:00:00+00:00")
+            .astimezone()
+            .replace(tzinfo=None)
+        )
+        assert response.json["scanned_at"] == expected.isoformat()
+
+    def test_invalid_options(self, client):
+        assert self.scan(client, "x", scanned_at="noon").status_code == 400
+        assert self.scan(client, "x" * 65).status_code == 400
+        assert self.scan(client, 7).status_code == 400
+
+    def test_batch_replay(self, client):
+        def item(key, minute):
+            return {
+                "user_id": 1,
+                "activity_name": "Lunch",
+                "activity_category": "meal",
+                "scanned_at": f"2025-01-18T12:{minute:02}:00",
+                "client_scan_id": key,
+            }
+
+        self.scan(client, "a")
+        with count_queries() as statements:
+            response = client.post(
+                "/scans/batch",
+                json=[
+                    item("a", 1),
+                    item("b", 2),
+                    item("b", 3),
+                    item("c", 4),
+                    item("d", 99),
+                ],
+            )
+        assert [result["status"] for result in response.json] == [
+            "duplicate",
+            "created",
+            "duplicate",
+            "created",
+            "error",
+        ]
+        assert response.json[0]["scan"]["scanned_at"] == "2025-01-18T12:00:00"
+        assert response.json[2]["scan"] == response.json[1]["scan"]
+        assert (
+            sum(statement.startswith("INSERT INTO scan ") for statement in statements)
+            == 1
+        )
+        with app.app_context():
+            assert ScanModel.query.count() == 3
+
+
+class TestLeaderboard:
+    @pytest.fixture
+    def scans(self, client):
+        with app.app_context():
+            db.session.add_all(
+                [
+                    UserModel(name=f"User {i}", email=f"u{i}@example.com", phone=f"555-010{i}")  # type: ignore
+                    for i in range(2, 5)
+                ]
+            )
+            db.session.commit()
+        # User 1: 1 meal, 2 talks. User 2: 3 meals. User 3: 1 talk. User 4: none.
+        for user_id, category, count in [
+            (1, "meal", 1),
+            (1, "talk", 2),
+            (2, "meal", 3),
+            (3, "talk", 1),
+        ]:
+            for _ in range(count):
+                client.put(
+                    f"/scan/{user_id}",
+                    json={
+                        "activity_name": category.title(),
+                        "activity_category": category,
+                    },
+                )
+
+    def test_overall(self, client, scans):
+        response = client.get("/leaderboard")
+        assert response.status_code == 200
+        assert response.json == [
+            {"rank": 1, "user_id": 1, "name": "Test User", "scan_count": 3},
+            {"rank": 1, "user_id": 2, "name": "User 2", "scan_count": 3},
+            {"rank": 3, "user_id": 3, "name": "User 3", "scan_count": 1},
+        ]
+        assert [row["user_id"] for row in client.get("/leaderboard?limit=1").json] == [
+            1
+        ]
+
+    def test_category(self, client, scans):
+        response = client.get("/leaderboard?activity_category=talk")
+        assert [
+            (row["rank"], row["user_id"], row["scan_count"]) for row in response.json
+        ] == [(1, 1, 2), (2, 3, 1)]
+
+    def test_user_rank(self, client, scans):
+        assert client.get("/leaderboard/users/3").json == {
+            "rank": 3,
+            "user_id": 3,
+            "name": "User 3",
+            "scan_count": 1,
+        }
+        assert (
+            client.get("/leaderboard/users/2?activity_category=meal").json["rank"] == 1
+        )
+        assert (
+            client.get("/leaderboard/users/1?activity_category=meal").json["rank"] == 2
+        )
+        assert client.get("/leaderboard/users/4").json["rank"] == 4
+        assert client.get("/leaderboard/users/999").status_code == 404
+
+    def test_invalid_limit(self, client):
+        assert client.get("/leaderboard?limit=0").status_code == 400
+        assert client.get("/leaderboard?limit=101").status_code == 400
+
+    def test_deletes_update_counters(self, client, scans):
+        with app.app_context():
+            for scan in ScanModel.query.filter_by(user_id=2).limit(2):
+                db.session.delete(scan)
+            db.session.commit()
+        assert client.get("/leaderboard/users/2").json["scan_count"] == 1
+        assert (
+            client.get("/leaderboard/users/2?activity_category=meal").json["scan_count"]
+            == 1
+        )
+
+    def test_rebuild(self, client, scans):
+        with app.app_context():
+            db.session.execute(db.update(UserScanCountModel).values(scan_count=100))
+            db.session.execute(db.delete(UserCategoryScanCountModel))
+            db.session.commit()
+            repository.rebuild_user_scan_counts()
+        assert client.get("/leaderboard").json[0]["scan_count"] == 3
+        assert client.get("/leaderboard?activity_category=meal").json[0]["user_id"] == 2
+
+    def test_reads_in_index_order(self, client, scans):
+        for category in [None, "talk"]:
+            with count_queries() as statements, app.app_context():
+                repository.get_leaderboard(10, category)
+                parameters = (0, 10, 0) if category is None else (category, 0, 10, 0)
+                plan = (
+                    db.session.connection()
+                    .exec_driver_sql("EXPLAIN QUERY PLAN " + statements[0], parameters)
+                    .all()
+                )
+            details = " ".join(row[-1] for row in plan)
+            assert "_rank" in details
+            assert "TEMP B-TREE" not in details
+
+
+class TestUserScans:
+    @pytest.fixture
+    def scans(self, client):
+        with app.app_context():
+            meal = ActivityModel(name="Lunch", category="meal")  # type: ignore
+            talk = ActivityModel(name="Keynote", category="talk")  # type: ignore
+            for hour, activity in [
+                (9, talk),
+                (12, meal),
+                (12, meal),
+                (15, talk),
+                (18, meal),
+            ]:
+                db.session.add(ScanModel(user_id=1, activity=activity, scanned_at=datetime(2025, 1, 18, hour)))  # type: ignore
+            db.session.commit()
+
+    def times(self, response):
+        return [
+            (scan["scanned_at"][11:13], scan["activity_category"])
+            for scan in response.json
+        ]
+
+    def test_latest_first(self, client, scans):
+        response = client.get("/users/1/scans?limit=2")
+        assert response.status_code == 200
+        assert self.times(response) == [("18", "meal"), ("15", "talk")]
+        assert response.headers["X-Next-Cursor"] == "2025-01-18T15:00:00_4"
+
+    def test_keyset_pages(self, client, scans):
+        pages, url = [], "/users/1/scans?limit=2"
+        while url:
+            response = client.get(url)
+            pages.append([scan["scanned_at"][11:13] for scan in response.json])
+            link = response.headers.get("Link")
+            url = link[1 : link.index(">")] if link else None
+        # Both 12:00 scans are returned once, split across pages by scan ID.
+        assert pages == [["18", "15"], ["12", "12"], ["09"]]
+
+    def test_filters(self, client, scans):
+        response = client.get(
+            "/users/1/scans?activity_category=meal&start=2025-01-18T12:00:00&end=2025-01-18T18:00:00"
+        )
+        assert self.times(response) == [("12", "meal"), ("12", "meal")]
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_etag(self, client, scans):
+        response = client.get("/users/1/scans")
+        etag = response.headers["ETag"]
+        assert (
+            client.get("/users/1/scans", headers={"If-None-Match": etag}).status_code
+            == 304
+        )
+        client.put(
+            "/scan/1", json={"activity_name": "Dinner", "activity_category": "meal"}
+        )
+        assert (
+            client.get("/users/1/scans", headers={"If-None-Match": etag}).status_code
+            == 200
+        )
+
+    def test_invalid_params(self, client):
+        assert client.get("/users/999/scans").status_code == 404
+        assert client.get("/users/1/scans?limit=0").status_code == 400
+        assert client.get("/users/1/scans?cursor=nope").status_code == 400
+        assert client.get("/users/1/scans?start=today").status_code == 400
+
+    def test_truncated_user(self, client, scans):
+        full = client.get("/users/1")
+        response = client.get("/users/1?scans_limit=2")
+        assert response.json == {**full.json, "scans": full.json["scans"][-2:]}
+        assert response.headers["ETag"] != full.headers["ETag"]
+        assert client.get("/users/1?scans_limit=0").json["scans"] == []
+        assert client.get("/users/1?scans_limit=-1").status_code == 400
+
+    def test_history_orders(self, client, scans):
+        # A replayed scan taken before the ones already recorded.
+        client.put(
+            "/scan/1",
+            json={
+                "activity_name": "Breakfast",
+                "activity_category": "meal",
+                "scanned_at": "2025-01-17T08:00:00",
+            },
+        )
+        # The full history stays in the order the scans were recorded.
+        full = client.get("/users/1").json["scans"]
+        assert full[-1]["activity_name"] == "Breakfast"
+        by_time = sorted(full, key=lambda scan: scan["scanned_at"])
+        assert client.get("/users/1?scans_limit=3").json["scans"] == by_time[-3:]
+        page = client.get("/users/1/scans?limit=100").json
+        assert [scan["scanned_at"] for scan in page] == [
+            scan["scanned_at"] for scan in by_time[::-1]
+        ]
+
+    def test_page_uses_index(self, client, scans):
+        with count_queries() as statements:
+            client.get(
+                "/users/1/scans?limit=2&cursor=2025-01-18T15:00:00_4&activity_category=meal"
+            )
+        with app.app_context():
+            plan = (
+                db.session.connection()
+                .exec_driver_sql(
+                    "EXPLAIN QUERY PLAN " + statements[-1],
+                    (1, "2025-01-18 15:00:00.000000", 4, "meal", 2, 0),
+                )
+                .all()
+            )
+        details = " ".join(row[-1] for row in plan)
+        assert "ix_scan_user_scanned_at" in details
+        assert "TEMP B-TREE" not in details
+
+
+class TestConcurrency:
+    def test_connection_pragmas(self, client):
+        with app.app_context():
+            connection = db.session.connection()
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+            assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+    def test_get_requests_use_read_only_engine(self, client):
+        with app.test_request_context("/users", method="GET"):
+            app.preprocess_request()
+            assert db.session.get_bind() is db.engines["read_only"]
+            with pytest.raises(Exception, match="readonly"):
+                db.session.execute(db.text("DELETE FROM user"))
+            db.session.rollback()
+        with app.test_request_context("/scan/1", method="PUT"):
+            app.preprocess_request()
+            assert db.session.get_bind() is db.engine
+
+    def test_reads_proceed_while_writer_holds_lock(self, client):
+        with app.app_context():
+            path = db.engine.url.database
+        writer = sqlite3.connect(path, isolation_level=None)
+        try:
+            writer.execute("BEGIN EXCLUSIVE")
+            writer.execute("UPDATE user SET name = 'Locked' WHERE id = 1")
+            started = time.perf_counter()
+            assert client.get("/users/1").json["name"] == "Test User"
+            assert client.get("/users").status_code == 200
+            assert client.get("/scans").status_code == 200
+            assert time.perf_counter() - started < 1
+        finally:
+            writer.execute("ROLLBACK")
+            writer.close()
+
+    def test_reads_during_sustained_writes(self, client):
+        writing = threading.Event()
+        done = threading.Event()
+        write_statuses = []
+
+        def write():
+            writer = app.test_client()
+            for i in range(200):
+                response = writer.put(
+                    "/scan/1",
+                    json={
+                        "activity_name": f"Talk {i % 5}",
+                        "activity_category": "talk",
+                    },
+                )
+                write_statuses.append(response.status_code)
+                writing.set()
+            done.set()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        writing.wait(timeout=5)
+        read_statuses = []
+        while not done.is_set():
+            read_statuses.append(client.get("/scans").status_code)
+            read_statuses.append(client.get("/users?limit=10").status_code)
+        thread.join()
+
+        assert set(write_statuses) == {200} and len(write_statuses) == 200
+        assert read_statuses and set(read_statuses) == {200}
+        assert sum(row["scan_count"] for row in client.get("/scans").json) == 200
+
+
+class TestActivityAttendees:
+    @pytest.fixture
+    def workshop(self, client):
+        seed_scan_history(users=4, scans_per_user=3)
+        with app.app_context():
+            return ActivityModel.query.filter_by(name="activity0").one().id
+
+    def test_list_attendees(self, client, workshop):
+        response = client.get(f"/activities/{workshop}/attendees")
+        assert response.status_code == 200
+        assert [user["id"] for user in response.json] == [2, 3, 4, 5]
+        assert response.json[0]["name"] == "User 1"
+        assert response.headers["X-Total-Count"] == "4"
+
+    def test_keyset_pages(self, client, workshop):
+        response = client.get(f"/activities/{workshop}/attendees?limit=3")
+        assert [user["id"] for user in response.json] == [2, 3, 4]
+        assert response.headers["X-Next-Cursor"] == "4"
+        response = client.get(f"/activities/{workshop}/attendees?limit=3&after=4")
+        assert [user["id"] for user in response.json] == [5]
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_membership(self, client, workshop):
+        response = client.get(f"/activities/{workshop}/attendees/2")
+        assert response.json == {
+            "activity_id": workshop,
+            "user_id": 2,
+            "attended": True,
+            "attendee_count": 4,
+        }
+        assert (
+            client.get(f"/activities/{workshop}/attendees/1").json["attended"] is False
+        )
+        assert client.get(f"/activities/{workshop}/attendees/999").status_code == 404
+        assert client.get("/activities/999/attendees/1").status_code == 404
+        assert client.get("/activities/999/attendees").status_code == 404
+
+    def test_cache_follows_counter(self, client, workshop):
+        client.get(f"/activities/{workshop}/attendees/1")
+        with count_queries() as statements:
+            assert (
+                client.get(f"/activities/{workshop}/attendees/1").json["attended"]
+                is False
+            )
+        assert not [statement for statement in statements if "FROM scan" in statement]
+
+        client.put(
+            "/scan/1",
+            json={"activity_name": "activity0", "activity_category": "workshop"},
+        )
+        with count_queries() as statements:
+            response = client.get(f"/activities/{workshop}/attendees/1")
+        assert response.json["attended"] is True
+        assert response.json["attendee_count"] == 5
+        # Only the new scan is read to top up the cached set.
+        assert any("scan.id >" in statement for statement in statements)
+
+        with app.app_context():
+            for scan in ScanModel.query.filter_by(user_id=1):
+                db.session.delete(scan)
+            db.session.commit()
+        assert (
+            client.get(f"/activities/{workshop}/attendees/1").json["attended"] is False
+        )
+        assert attendee_cache.stats()["misses"] == 2
+
+    def test_cache_sees_delete_then_insert(self, client, workshop):
+        assert (
+            client.get(f"/activities/{workshop}/attendees/1").json["attended"] is False
+        )
+        with app.app_context():
+            db.session.delete(
+                ScanModel.query.filter_by(user_id=2, activity_id=workshop).first()
+            )
+            db.session.add(ScanModel(user_id=1, activity_id=workshop))  # type: ignore
+            db.session.commit()
+        # The scan counter is back where it was, but its version moved on.
+        response = client.get(f"/activities/{workshop}/attendees/1")
+        assert response.json["attended"] is True
+        assert response.json["attendee_count"] == 4
+
+    def test_page_uses_covering_index(self, client, workshop):
+        with count_queries() as statements:
+            client.get(f"/activities/{workshop}/attendees?limit=2&after=1")
+        page = next(statement for statement in statements if "DISTINCT" in statement)
+        with app.app_context():
+            plan = (
+                db.session.connection()
+                .exec_driver_sql("EXPLAIN QUERY PLAN " + page, (workshop, 1, 2, 0))
+                .all()
+            )
+        assert any("COVERING INDEX ix_scan_activity_user" in row[-1] for row in plan)
+
+
+class TestArchive:
+    CUTOFF = datetime(2025, 1, 20)
+
+    @pytest.fixture
+    def scans(self, client, tmp_path):
+        archive.configure(str(tmp_path))
+        with app.app_context():
+            workshop = ActivityModel(name="activity0", category="workshop")  # type: ignore
+            lunch = ActivityModel(name="lunch", category="food")  # type: ignore
+            users = [
+                UserModel(name=f"User {i}", email=f"user{i}@example.com", phone=f"555-000-{i:04}")  # type: ignore
+                for i in range(3)
+            ]
+            db.session.add_all([workshop, lunch, *users])
+            for i, user in enumerate(users):
+                for day in (18, 19):
+                    scanned_at = datetime(2025, 1, day, 10, i, 30, 250)
+                    db.session.add(ScanModel(user=user, activity=[workshop, lunch][i % 2], scanned_at=scanned_at))  # type: ignore
+            db.session.add(ScanModel(user=users[0], activity=workshop, scanned_at=datetime(2025, 1, 21, 9)))  # type: ignore
+            db.session.commit()
+            rows = db.session.execute(
+                db.select(
+                    ScanModel.id,
+                    ScanModel.user_id,
+                    ScanModel.activity_id,
+                    ScanModel.scanned_at,
+                )
+                .where(ScanModel.scanned_at < self.CUTOFF)
+                .order_by(ScanModel.activity_id, ScanModel.scanned_at)
+            ).all()
+            workshop_id = workshop.id
+        yield workshop_id, [tuple(row) for row in rows]
+        archive.configure(app.config["ARCHIVE_DIR"])
+
+    def aggregates(self, client):
+        scans_cache.clear()
+        return [
+            client.get(url).json
+            for url in [
+                "/scans",
+                "/scans/timeseries?bucket=5m",
+                "/leaderboard",
+                "/leaderboard?activity_category=food",
+            ]
+        ]
+
+    def test_snapshot_holds_archived_scans(self, client, scans):
+        _, rows = scans
+        with app.app_context():
+            path, count = repository.archive_scans(self.CUTOFF)
+            assert count == 6
+            assert ScanModel.query.count() == 1
+
+        snapshot = Snapshot(path)
+        assert list(snapshot.rows()) == rows
+        assert [
+            (segment["activity_id"], segment["day"], segment["count"])
+            for segment in snapshot.segments
+        ] == [
+            (1, "2025-01-18", 2),
+            (1, "2025-01-19", 2),
+            (2, "2025-01-18", 1),
+            (2, "2025-01-19", 1),
+        ]
+        assert snapshot.activities == {
+            1: ("activity0", "workshop"),
+            2: ("lunch", "food"),
+        }
+        snapshot.close()
+
+        with app.app_context():
+            assert repository.archive_scans(self.CUTOFF) == (None, 0)
+
+    def test_aggregates_keep_archived_counts(self, client, scans):
+        before = self.aggregates(client)
+        with app.app_context():
+            repository.archive_scans(self.CUTOFF)
+        assert self.aggregates(client) == before
+
+        helpers.rebuild_counters()
+        assert self.aggregates(client) == before
+
+    def test_attendees_include_archived_users(self, client, scans):
+        workshop, _ = scans
+        client.get(f"/activities/{workshop}/attendees/4")
+        with app.app_context():
+            repository.archive_scans(self.CUTOFF)
+        # The counter is unchanged, so the cached set stays valid.
+        assert (
+            client.get(f"/activities/{workshop}/attendees/4").json["attended"] is True
+        )
+
+        attendee_cache.clear()
+        response = client.get(f"/activities/{workshop}/attendees/4")
+        assert response.json["attended"] is True
+        assert response.json["attendee_count"] == 2
+        response = client.get(f"/activities/{workshop}/attendees?limit=1")
+        assert [user["id"] for user in response.json] == [2]
+        response = client.get(f"/activities/{workshop}/attendees?after=2")
+        assert [user["id"] for user in response.json] == [4]
+
+    def test_history_moves_out_and_etag_changes(self, client, scans):
+        response = client.get("/users/3")
+        assert len(response.json["scans"]) == 2
+        with app.app_context():
+            repository.archive_scans(self.CUTOFF)
+        response = client.get(
+            "/users/3", headers={"If-None-Match": response.headers["ETag"]}
+        )
+        assert response.status_code == 200
+        assert response.json["scans"] == []
+
+    def test_rolls_back_when_scans_change(self, client, scans, monkeypatch, tmp_path):
+        with app.app_context():
+            path = db.engine.url.database
+
+        def write_snapshot(*args):
+            written = repository_write_snapshot(*args)
+            writer = sqlite3.connect(path, isolation_level=None)
+            writer.execute("DELETE FROM scan WHERE id = 1")
+            writer.close()
+            return written
+
+        repository_write_snapshot = repository.write_snapshot
+        monkeypatch.setattr(repository, "write_snapshot", write_snapshot)
+        with app.app_context():
+            with pytest.raises(RuntimeError):
+                repository.archive_scans(self.CUTOFF)
+            assert ScanModel.query.count() == 6
+        assert list(tmp_path.iterdir()) == []
+
+    def test_failed_write_leaves_no_partial_snapshot(
+        self, client, scans, monkeypatch, tmp_path
+    ):
+        def write_snapshot(path, rows, activities):
+            open(path, "wb").close()
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(repository, "write_snapshot", write_snapshot)
+        with app.app_context():
+            with pytest.raises(OSError):
+                repository.archive_scans(self.CUTOFF)
+            assert ScanModel.query.count() == 7
+        assert list(tmp_path.iterdir()) == []
+
+    def test_crash_before_rename_is_recovered(
+        self, client, scans, monkeypatch, tmp_path
+    ):
+        workshop, rows = scans
+
+        def crash(partial, path):
+            raise KeyboardInterrupt
+
+        with monkeypatch.context() as patch:
+            patch.setattr(repository, "publish", crash)
+            with app.app_context():
+                with pytest.raises(KeyboardInterrupt):
+                    repository.archive_scans(self.CUTOFF)
+        # The scans are gone from the database and the snapshot isn't published.
+        (partial,) = tmp_path.iterdir()
+        assert partial.name.endswith(".snap.partial")
+        assert archive.snapshots() == []
+
+        with app.app_context():
+            assert ScanModel.query.count() == 1
+            (path,) = repository.recover_archive()
+            assert repository.recover_archive() == []
+        assert [str(name) for name in tmp_path.iterdir()] == [path]
+        assert list(archive.snapshots()[0].rows()) == rows
+        assert client.get(f"/activities/{workshop}/attendees").json[0]["id"] == 2
+
+    def test_unrecorded_partial_is_not_published(self, client, scans, tmp_path):
+        (tmp_path / "scans-before-x.snap.partial").write_bytes(b"")
+        with app.app_context():
+            assert repository.recover_archive() == []
+        assert archive.snapshots() == []
+
+    def test_delete_triggers_work_after_archiving(self, client, scans):
+        workshop, _ = scans
+        with app.app_context():
+            repository.archive_scans(self.CUTOFF)
+            db.session.delete(ScanModel.query.one())
+            db.session.commit()
+            rollups = db.session.execute(
+                db.select(ScanRollupModel.bucket_start, ScanRollupModel.scan_count)
+                .where(ScanRollupModel.activity_id == workshop)
+                .order_by(ScanRollupModel.bucket_start)
+            ).all()
+            assert [count for _, count in rollups] == [2, 2, 0]
+            assert db.session.get(ActivityScanCountModel, workshop).scan_count == 4
+            assert db.session.get(UserScanCountModel, 2).scan_count == 2
+        scans_cache.clear()
+        response = client.get("/scans/timeseries?bucket=1d&activity_category=workshop")
+        assert [bucket["scan_count"] for bucket in response.json] == [2, 2]
@@ -0,0 +1,219 @@
+"""Write-behind queue that takes scan writes off the request path.
+
+When SCAN_WRITE_BEHIND is set, `PUT /scan/<id>` and `PUT /scan/badge/<code>`
+validate the scan, put it on a bounded in-process queue and return 202 without
+touching the database write lock. A single writer thread drains the queue and records whatever has piled up,
+up to SCAN_QUEUE_BATCH scans, in one transaction, so a burst of scanners costs
+a handful of commits instead of one each. When the queue is full, submitting
+raises ScanQueueFull so the request can be rejected with 429 rather than
+waiting on the database.
+
+Every submitted scan gets a sequence number. The writer publishes the sequence
+number it has committed up to, so a reader can wait until a user's queued scans
+are visible. The queue is drained before the process exits.
+
+A batch that finds the database locked or busy, e.g. while another process
+holds the write lock past busy_timeout, is kept and retried with backoff. Any
+other database error, such as a missing table or a disk I/O error, fails the
+batch so it can't hold up the queue. Scans that fail for other reasons are
+retried one by one, and only those that still fail on their own are dropped.
+"""
+
+import atexit
+import time
+from collections import deque
+from threading import Condition, Thread
+from sqlalchemy.exc import OperationalError
+from extensions import db
+import repository
+
+
+def _is_busy(error: OperationalError) -> bool:
+    """Return whether an error means another connection holds a lock."""
+    message = str(error.orig).lower()
+    return "locked" in message or "busy" in message
+
+
+class ScanQueueFull(Exception):
+    """Raised when a scan is submitted to a full queue."""
+
+
+class ScanQueue:
+    """Bounded queue of ScanEntry tuples drained by a background writer."""
+
+    def __init__(self, maxsize: int = 10000, batch_size: int = 500):
+        self.enabled = False
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.app = None
+        self._pending = deque()
+        self._cond = Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._last_by_user = {}
+        self._thread = None
+        self._stopping = False
+        self.written = 0
+        self.failed = 0
+        self.retry_delay = 0.1
+        self.max_retry_delay = 5.0
+        # Attempts per batch once stopping, so a locked database can't hang exit.
+        self.stop_attempts = 5
+
+    def configure(self, app, enabled: bool, maxsize: int, batch_size: int):
+        """Set the queue up for an app. The writer starts on `start()`."""
+        self.app = app
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+
+    def start(self):
+        """Start the writer thread and drain the queue when the process exits."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = Thread(target=self._run, name="scan-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, entry: repository.ScanEntry) -> int:
+        """Queue a scan to be written.
+
+        Args:
+            entry (ScanEntry): The scan, with scanned_at set.
+
+        Returns:
+            int: The scan's sequence number.
+
+        Raises:
+            ScanQueueFull: If maxsize scans are already waiting.
+        """
+        with self._cond:
+            if len(self._pending) >= self.maxsize:
+                raise ScanQueueFull()
+            self._submitted += 1
+            self._pending.append((self._submitted, entry))
+            self._last_by_user[entry.user_id] = self._submitted
+            self._cond.notify_all()
+            return self._submitted
+
+    def depth(self) -> int:
+        """Return the number of scans waiting to be written."""
+        return len(self._pending)
+
+    def _wait_for(self, sequence: int, timeout: float | None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._committed >= sequence, timeout=timeout
+            )
+
+    def wait_for_user(self, user_id: int, timeout: float | None = None) -> bool:
+        """Wait until every scan queued so far for a user has been written.
+
+        Args:
+            user_id (int): The user whose scans should be visible.
+            timeout (float, optional): Seconds to wait at most.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self._cond:
+            sequence = self._last_by_user.get(user_id)
+        return sequence is None or self._wait_for(sequence, timeout)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until every scan queued so far has been written.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self._cond:
+            sequence = self._submitted
+        return self._wait_for(sequence, timeout)
+
+    def stop(self, timeout: float | None = None):
+        """Write the remaining scans and stop the writer thread."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopping)
+                if not self._pending:
+                    return
+                batch = [
+                    self._pending.popleft()
+                    for _ in range(min(self.batch_size, len(self._pending)))
+                ]
+
+            self._write([entry for _, entry in batch])
+
+            with self._cond:
+                self._committed = batch[-1][0]
+                for _, entry in batch:
+                    if self._last_by_user.get(entry.user_id, 0) <= self._committed:
+                        self._last_by_user.pop(entry.user_id, None)
+                self._cond.notify_all()
+
+    def _commit(self, entries):
+        """Record entries in one transaction, retrying while the database is busy.
+
+        Raises:
+            OperationalError: If the database is still busy after
+                stop_attempts attempts while the queue is stopping, or fails
+                for any other reason.
+        """
+        delay = self.retry_delay
+        attempts = 0
+        while True:
+            try:
+                repository.record_scans(entries)
+                db.session.commit()
+                return
+            except OperationalError as error:
+                db.session.rollback()
+                attempts += 1
+                if not _is_busy(error) or (
+                    self._stopping and attempts >= self.stop_attempts
+                ):
+                    raise
+                self.app.logger.warning(
+                    "Database busy, retrying %d scans in %.1fs", len(entries), delay
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _write(self, entries):
+        """Record a batch in one transaction, or one by one if that fails.
+
+        Falling back to single scans means one bad scan doesn't lose the rest
+        of the batch. Scans that still can't be written are logged.
+        """
+        with self.app.app_context():
+            try:
+                self._commit(entries)
+                self.written += len(entries)
+                return
+            except OperationalError:
+                self.failed += len(entries)
+                self.app.logger.exception("Gave up on %d scans", len(entries))
+                return
+            except Exception:
+                if len(entries) == 1:
+                    self.failed += 1
+                    self.app.logger.exception("Failed to write scan %s", entries[0])
+                    return
+        for entry in entries:
+            self._write([entry])
+
+
+scan_queue = ScanQueue()
@@ -0,0 +1,31 @@
+"""Production entry point for prefork servers such as gunicorn.
+
+Each worker process calls create_app() after it has been forked, so database
+connections, the activity cache and the write-behind writer thread all belong
+to the worker that uses them. Run the migrations once before starting the
+workers, e.g. from the server's on_starting hook in gunicorn.conf.py.
+"""
+
+from app import app
+from extensions import db
+from write_behind import scan_queue
+import repository
+
+
+def create_app():
+    """Prepare the app to serve requests in this process.
+
+    Returns:
+        Flask: The app, with the activity cache warmed, any snapshot left
+            unpublished by an interrupted archive run recovered, and the
+            write-behind writer started if SCAN_WRITE_BEHIND is set.
+    """
+    with app.app_context():
+        # Don't reuse connections opened by a parent process before the fork.
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+        repository.warm_activity_cache()
+        repository.recover_archive()
+    if scan_queue.enabled:
+        scan_queue.start()
+    return app